@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+ASGI entry point of the game (e.g. uvicorn asgi:app), needs asgiref and an ASGI server (pip install asgiref uvicorn)
+
+The Flask app is served through asgiref's WsgiToAsgi. The event loop only receives and sends the HTTP messages,
+ the game logic (ContextBank lookups and the guesser calls) runs in its own thread for each request, so the loop
+ never blocks and one worker process serves as many concurrent games (e.g. waiting for the guesser service)
+ as the ASGI_THREADS environment variable allows (the rest wait without blocking the loop).
+ Set pool_size in guesser_config accordingly, as it bounds the parallel requests to the guesser service.
+"""
+
+from os import environ
+from asyncio import Semaphore
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from main import app as flask_app
+
+
+class AsgiGameApp:
+    def __init__(self, wsgi_app, max_threads: int = 256):
+        """
+        Serve the (WSGI) Flask app over ASGI with at most max_threads requests processed at once
+
+        WsgiToAsgi runs every request in the one thread shared by the thread sensitive code of the process,
+         in a ThreadSensitiveContext each request gets a thread of its own.
+
+        :param wsgi_app: The WSGI application (see main.create_app())
+        :param max_threads: The number of requests processed at once (the rest wait without blocking the loop)
+        """
+
+        self._asgi_app = WsgiToAsgi(wsgi_app)
+        self._max_threads = max_threads
+        self._semaphore = None  # Created in the event loop of the server
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if self._semaphore is None:
+            self._semaphore = Semaphore(self._max_threads)
+        async with self._semaphore, ThreadSensitiveContext():
+            await self._asgi_app(scope, receive, send)
+
+    @staticmethod
+    async def _lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = AsgiGameApp(flask_app, int(environ.get('ASGI_THREADS', 256)))
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Load-testing and latency benchmark for the game endpoint
+
+1. Build a synthetic lines database (with the schema of create_database/create_sqldb.py)
+2. Start a local stub guesser server (with configurable latency)
+3. Drive realistic game sessions (new_game -> next_line/guess... -> give_up) concurrently
+    against main.create_app() through the Flask test client or against a live server (e.g. gunicorn)
+4. Report throughput and p50/p95/p99 latency per action (as text and optionally as JSON with the git commit)
+
+Example:
+    python3 benchmarks/bench_game.py --rows 240000 --sessions 200 --concurrency 8 -o bench_output.json
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import logging
+import subprocess
+from time import perf_counter, sleep, time
+from pathlib import Path
+from random import Random
+from threading import Thread
+from urllib.parse import urlparse, parse_qs
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser, FileType
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(REPO_DIR / 'create_database'))
+
+from create_sqldb import create_db, create_deferred_indexes, do_insert  # noqa: E402
+
+STATE_RE = re.compile(r'name="state" value="([^"]+)"')
+PREV_GUESSES_OTHER_RE = re.compile(r'name="previous_guesses_other\[\]" value="([^"]*)"')
+OTHER_GUESS_STATE_RE = re.compile(r'name="other_guess_state" value="([^"]*)"')
+
+
+def build_synthetic_db(db_filename, rows, contexts_per_word=30, seed=12345, left_size=None, right_size=None):
+    """Create a lines database with random words and contexts (rows in total)"""
+
+    rng = Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyzáéíóöőúüű'
+    vocabulary = [''.join(rng.choices(letters, k=rng.randint(2, 10))) for _ in range(5000)]
+
+    def gen_rows():
+        for i in range(rows):
+            word_no = i // contexts_per_word
+            word = f'{vocabulary[word_no % len(vocabulary)]}{word_no}'
+            left = ' '.join(rng.choices(vocabulary, k=5))
+            right = ' '.join(rng.choices(vocabulary, k=5))
+            row = {'left': left, 'word': word, 'right': right, 'freq': contexts_per_word + word_no % 1000,
+                   'sent': f'{left} {word} {right}'}
+            if left_size is not None:
+                row.update(left_trunc=left, right_trunc=right)
+            yield row
+
+    engine, sqlite_table = create_db(db_filename, left_size, right_size, fast_load=True)
+    do_insert(gen_rows(), engine, sqlite_table)
+    create_deferred_indexes(engine, sqlite_table)
+    engine.dispose()
+
+
+class StubGuesserHandler(BaseHTTPRequestHandler):
+    """Answers the guesser API with fixed values after a configurable delay (latency)"""
+
+    latency = 0.0
+
+    def log_message(self, *_):
+        pass
+
+    def _params(self):
+        parsed_url = urlparse(self.path)
+        if self.command == 'POST':
+            return parsed_url.path, json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        return parsed_url.path, {key: val if key.endswith('[]') else val[0]
+                                 for key, val in parse_qs(parsed_url.query).items()}
+
+    def do_GET(self):
+        path, params = self._params()
+        sleep(self.latency)
+        if path == '/no_of_subwords':
+            out = {'no_of_subwords': 1}
+        elif path == '/guess':
+            out = {'guesses': [f'guess{len(params.get("prev_guesses[]", []))}'] + ['_'] * 2}
+        elif path == '/guess_batch':
+            out = {'guesses': [[f'guess{len(req.get("prev_guesses[]", []))}', '_', '_']
+                               for req in params['requests']]}
+        elif path == '/word_similarity':
+            out = {'word_similarity': '0.5'}
+        elif path == '/word_similarity_batch':
+            out = {'word_similarities': ['0.5' for _ in params['words2[]']]}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(out).encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+
+def start_stub_guesser(latency):
+    """Start the stub guesser server in a daemon thread and return its base URL"""
+
+    handler = type('Handler', (StubGuesserHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def write_config(config_filename, db_filename, guesser_url, extra_contextbank_config=()):
+    """Write a config.yaml for the benchmark based on the config.yaml of the repository"""
+
+    with open(REPO_DIR / 'config.yaml', encoding='UTF-8') as fh:
+        config = fh.read()
+    config = re.sub(r'(?m)^    database_name: .*$', f'    database_name: {db_filename}', config)
+    for key, val in extra_contextbank_config:
+        config = re.sub(rf'(?m)^    {key}: .*$\n', '', config)
+        config = config.replace('contextbank_config:\n', f'contextbank_config:\n    {key}: {val}\n')
+    if guesser_url is not None:
+        for key, val in (('baseurl', guesser_url), ('guesser', 'stub'), ('similarity', 'stub'),
+                         ('retry_wrong', 'false'), ('top_n', '3')):
+            config = re.sub(rf'(?m)^    {key}: .*$', f'    {key}: {val}', config)
+    with open(config_filename, 'w', encoding='UTF-8') as fh:
+        fh.write(config)
+
+
+class FlaskClient:
+    def __init__(self, app):
+        """Send the requests to the app through the Flask test client (one client for each thread)"""
+
+        self._app = app
+
+    def session(self):
+        test_client = self._app.test_client()
+        return lambda query: test_client.get('/', query_string=query).get_data(as_text=True)
+
+
+class HTTPClient:
+    def __init__(self, url):
+        """Send the requests to a live server (e.g. gunicorn main:app)"""
+
+        from requests import Session  # Only needed for live servers
+        self._url = url
+        self._session_class = Session
+
+    def session(self):
+        http_session = self._session_class()
+        return lambda query: http_session.get(self._url, params=query).text
+
+
+def play_game(send, rng, next_lines, guesses, vs_other):
+    """Play one game and return [(action, seconds), ...]"""
+
+    timings = []
+
+    def timed(action, query):
+        start = perf_counter()
+        html = send(query)
+        timings.append((action, perf_counter() - start))
+        state = STATE_RE.search(html)
+        if state is None:
+            raise ValueError(f'No game state in the response for {action}!')
+        return html, state.group(1)
+
+    html, state = timed('new_game', {'new_game_vs_other' if vs_other else 'new_game': ''})
+    prev_guesses = []
+    for _ in range(next_lines):
+        html, state = timed('next_line', {'next_line': '', 'state': state})
+    for i in range(guesses):
+        guessed_word = f'wrong{rng.randrange(1000)}'
+        query = {'guess': '', 'guessed_word': guessed_word, 'state': state, 'previous_guesses[]': prev_guesses,
+                 'previous_guesses_other[]': PREV_GUESSES_OTHER_RE.findall(html),
+                 'other_guess_state': OTHER_GUESS_STATE_RE.search(html).group(1)}
+        html, state = timed('guess', query)
+        prev_guesses.append(guessed_word)
+    timed('give_up', {'give_up': '', 'state': state})
+
+    return timings
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile"""
+
+    if len(sorted_values) == 0:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values) + 0.5) - 1))]
+
+
+def run_benchmark(client, sessions, concurrency, next_lines, guesses, vs_other, seed=12345):
+    """Play the games concurrently and return the statistics per action"""
+
+    def worker(worker_no):
+        rng = Random(seed + worker_no)
+        send = client.session()
+        worker_timings = []
+        for _ in range(worker_no, sessions, concurrency):
+            worker_timings.extend(play_game(send, rng, next_lines, guesses, vs_other))
+        return worker_timings
+
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        all_timings = [timing for worker_timings in executor.map(worker, range(concurrency))
+                       for timing in worker_timings]
+    elapsed = perf_counter() - start
+
+    results = {'elapsed_s': elapsed, 'requests': len(all_timings), 'throughput_rps': len(all_timings) / elapsed,
+               'actions': {}}
+    for action in ('new_game', 'next_line', 'guess', 'give_up', 'all'):
+        values = sorted(seconds for act, seconds in all_timings if act == action or action == 'all')
+        if len(values) > 0:
+            results['actions'][action] = {'count': len(values), 'mean_ms': 1000 * sum(values) / len(values),
+                                          **{f'p{pct}_ms': 1000 * percentile(values, pct) for pct in (50, 95, 99)}}
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', '-C', str(REPO_DIR), 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, out_fh=sys.stdout):
+    print(f'Commit: {results["commit"]}', file=out_fh)
+    print(f'Requests: {results["requests"]} in {results["elapsed_s"]:.2f} s'
+          f' ({results["throughput_rps"]:.1f} requests/s)', file=out_fh)
+    print('action', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', sep='\t', file=out_fh)
+    for action, stats in results['actions'].items():
+        print(action, stats['count'], *(f'{stats[key]:.2f}' for key in ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms')),
+              sep='\t', file=out_fh)
+
+
+class _chdir:
+    """Change the working directory temporarily (contextlib.chdir is only available from Python 3.11)"""
+
+    def __init__(self, path):
+        self._path = path
+        self._prev_path = None
+
+    def __enter__(self):
+        self._prev_path = Path.cwd()
+        os.chdir(self._path)
+
+    def __exit__(self, *_):
+        os.chdir(self._prev_path)
+
+
+def main():
+    parser = ArgumentParser(description='Load-testing and latency benchmark for the game endpoint')
+    parser.add_argument('--rows', type=int, default=240000, help='Number of lines in the synthetic database')
+    parser.add_argument('--contexts-per-word', type=int, default=30, help='Number of lines for each word')
+    parser.add_argument('--db', default=None, help='Use this database instead of building a synthetic one')
+    parser.add_argument('--sessions', type=int, default=100, help='Number of games to play')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of games played at the same time')
+    parser.add_argument('--next-lines', type=int, default=3, help='Number of next_line actions in each game')
+    parser.add_argument('--guesses', type=int, default=5, help='Number of (wrong) guess actions in each game')
+    parser.add_argument('--no-guesser', action='store_true', help='Play without the (stub) guesser')
+    parser.add_argument('--guesser-latency', type=float, default=0.005, help='Latency of the stub guesser in s')
+    parser.add_argument('--preload', action='store_true', help='Set contextbank_config/preload')
+    parser.add_argument('--url', default=None, help='Benchmark a live server at this URL instead of the Flask'
+                                                    ' test client (it must be configured with the same database)')
+    parser.add_argument('-o', '--output', type=FileType('w', encoding='UTF-8'), default=None,
+                        help='Write the results as JSON into this file')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        if args.db is not None:
+            db_filename = Path(args.db).resolve()
+        else:
+            db_filename = work_dir / 'bench_conts.db'
+            start = perf_counter()
+            build_synthetic_db(db_filename, args.rows, args.contexts_per_word)
+            print(f'Synthetic database with {args.rows} rows built in {perf_counter() - start:.1f} s',
+                  file=sys.stderr)
+
+        vs_other = not args.no_guesser
+        if args.url is not None:
+            client = HTTPClient(args.url)
+        else:
+            guesser_url = start_stub_guesser(args.guesser_latency) if vs_other else None
+            extra_contextbank_config = [('preload', 'true')] if args.preload else []
+            write_config(work_dir / 'config.yaml', db_filename, guesser_url, extra_contextbank_config)
+            # create_app() reads logging.cfg and the templates from the working directory
+            shutil.copy(REPO_DIR / 'logging.cfg', work_dir / 'logging.cfg')
+            (work_dir / 'templates').symlink_to(REPO_DIR / 'templates')
+            with _chdir(work_dir):
+                from main import create_app
+                app = create_app(work_dir / 'config.yaml')
+            logging.getLogger(app.name).setLevel(logging.WARNING)
+            client = FlaskClient(app)
+
+        results = run_benchmark(client, args.sessions, args.concurrency, args.next_lines, args.guesses, vs_other)
+
+    results.update(commit=git_commit(), timestamp=time(), params=dict(vars(args), output=None))
+    print_results(results)
+    if args.output is not None:
+        json.dump(results, args.output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
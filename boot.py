@@ -0,0 +1,87 @@
+import os
+import json
+from time import perf_counter
+from pathlib import Path
+from hashlib import sha256
+from contextlib import contextmanager
+
+
+class BootCache:
+    def __init__(self, cache_dir: str = None):
+        """
+        JSON cache of the slow, rarely changing results of the startup (e.g. the validated config and the reflected
+         table schema) shared by the worker processes and kept between the restarts of the server
+
+        The entries are keyed by the contents or the state (mtime and size) of their source files,
+         so a changed file is never read from the cache. Stale entries are not removed.
+
+        :param cache_dir: The directory of the cache files (None to disable the cache)
+        """
+
+        self._cache_dir = None
+        if cache_dir is not None:
+            self._cache_dir = Path(cache_dir)
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def files_key(*filenames):
+        """The key of the contents of the files"""
+
+        digest = sha256()
+        for filename in filenames:
+            with open(filename, 'rb') as fh:
+                digest.update(fh.read())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_state_key(filename, *extra):
+        """The key of the path and the state (mtime, size) of the (large) file and the extra values"""
+
+        file_stat = os.stat(filename)
+        return repr((str(Path(filename).resolve()), file_stat.st_mtime_ns, file_stat.st_size, *extra))
+
+    def cached(self, name, key, compute_fun):
+        """Return the cached value (JSON serializable) of the name and key or compute and store it"""
+
+        if self._cache_dir is None:
+            return compute_fun()
+
+        cache_filename = self._cache_dir / f'{name}_{sha256(key.encode("UTF-8")).hexdigest()[:32]}.json'
+        try:
+            with open(cache_filename, encoding='UTF-8') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            pass
+
+        value = compute_fun()
+        tmp_filename = cache_filename.with_suffix(f'.tmp{os.getpid()}')
+        with open(tmp_filename, 'w', encoding='UTF-8') as fh:
+            json.dump(value, fh, ensure_ascii=False)
+        os.replace(tmp_filename, cache_filename)  # Atomic for the concurrently starting workers
+
+        return value
+
+
+class BootTimer:
+    def __init__(self):
+        """The durations of the phases of the startup (e.g. imports, config, database, warm-up) in order"""
+
+        self.timings = []  # [(phase, seconds), ...]
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the enclosed block as the phase"""
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, perf_counter() - start))
+
+    def record(self, name, seconds):
+        self.timings.append((name, seconds))
+
+    def __str__(self):
+        return ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in self.timings) + \
+            f' total={sum(seconds for _, seconds in self.timings) * 1000:.1f}ms'
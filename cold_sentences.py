@@ -0,0 +1,164 @@
+import zlib
+from collections import Counter
+
+from sqlalchemy import select, Table, Column, Integer, LargeBinary, MetaData
+from sqlalchemy.exc import NoResultFound
+
+SENT_DICT_TABLE = 'sent_dict'
+SENT_BLOCKS_TABLE = 'sent_blocks'
+
+
+def sent_tables(metadata: MetaData):
+    """The tables of the compressed sentences (cold storage, never read by the game unless asked for):
+        sent_dict holds the shared dictionary of the blocks (one row), sent_blocks holds the zlib compressed blocks
+        of consecutive lines keyed by their first line ID (the block of a line is the last one starting before it)
+    """
+
+    dict_table = Table(SENT_DICT_TABLE, metadata,
+                       Column('id', Integer, primary_key=True),
+                       Column('zdict', LargeBinary))
+    blocks_table = Table(SENT_BLOCKS_TABLE, metadata,
+                         Column('first_id', Integer, primary_key=True),
+                         Column('data', LargeBinary))
+    return dict_table, blocks_table
+
+
+def train_zdict(sentences, max_size=32 * 1024):
+    """The shared dictionary of the blocks from the sample of the sentences: their most frequent tokens
+        (the most frequent ones last, as zlib refers to them with shorter distances)
+    """
+
+    token_freqs = Counter(token for sent in sentences if sent is not None for token in sent.split(' '))
+    zdict, size = [], 0
+    for token, freq in token_freqs.most_common():
+        token = f'{token} '.encode('UTF-8')
+        if freq < 2 or size + len(token) > max_size:
+            break
+        zdict.append(token)
+        size += len(token)
+
+    return b''.join(reversed(zdict))
+
+
+def compress_block(lines, zdict, level=9):
+    """Compress the (line_id, sent) pairs into one block (line ID TAB sentence NEWLINE for each line,
+        line ID NEWLINE without TAB for a NULL sentence)
+    """
+
+    compressor = zlib.compressobj(level, zdict=zdict)
+    text = ''.join(f'{line_id}\t{sent}\n' if sent is not None else f'{line_id}\n' for line_id, sent in lines)
+    return compressor.compress(text.encode('UTF-8')) + compressor.flush()
+
+
+def decompress_block(data, zdict):
+    """Return the line ID -> sentence (None for NULL) dictionary of the block"""
+
+    decompressor = zlib.decompressobj(zdict=zdict)
+    text = (decompressor.decompress(data) + decompressor.flush()).decode('UTF-8')
+    sentences = {}
+    for line in text.split('\n')[:-1]:
+        line_id, tab, sent = line.partition('\t')
+        sentences[int(line_id)] = sent if len(tab) > 0 else None
+    return sentences
+
+
+def iter_sentences(conn):
+    """Yield (line_id, sent) for all lines in line ID order"""
+
+    dict_table, blocks_table = sent_tables(MetaData())
+    zdict = conn.execute(select(dict_table.c.zdict)).scalar_one()
+    for data, in conn.execute(select(blocks_table.c.data).order_by(blocks_table.c.first_id)):
+        yield from decompress_block(data, zdict).items()
+
+
+class SentenceBlockWriter:
+    def __init__(self, conn, block_size: int = 64, sample_size: int = 10000, level: int = 9):
+        """
+        Write the sentences into the compressed blocks of the cold storage (see sent_tables())
+
+        The sentences must be added in line ID order. The first sample_size sentences are kept in memory
+         to train the shared dictionary (see train_zdict()) before the first block is written.
+
+        :param conn: The SQLAlchemy connection of the database (the tables must exist, the caller commits)
+        :param block_size: The number of sentences in one block (a lookup decompresses one block)
+        :param sample_size: The number of sentences to train the dictionary on
+        :param level: The zlib compression level
+        """
+
+        self._conn = conn
+        self._dict_table, self._blocks_table = sent_tables(MetaData())
+        self._block_size = block_size
+        self._sample_size = sample_size
+        self._level = level
+        self._zdict = None
+        self._pending = []  # (line_id, sent) not yet written
+        self.no_of_blocks = 0
+        self.compressed_size = 0
+
+    def add(self, line_id, sent):
+        self._pending.append((line_id, sent))
+        if self._zdict is None and len(self._pending) >= self._sample_size:
+            self._write_zdict()
+        if self._zdict is not None and len(self._pending) >= 1000 * self._block_size:
+            self._write_blocks(full_only=True)
+
+    def flush(self):
+        """Write the remaining sentences (call after the last one)"""
+
+        if self._zdict is None:
+            self._write_zdict()
+        self._write_blocks(full_only=False)
+
+    def _write_zdict(self):
+        self._zdict = train_zdict(sent for _, sent in self._pending)
+        self._conn.execute(self._dict_table.insert(), [{'id': 0, 'zdict': self._zdict}])
+
+    def _write_blocks(self, full_only):
+        end = len(self._pending) - len(self._pending) % self._block_size if full_only else len(self._pending)
+        blocks = [{'first_id': self._pending[start][0],
+                   'data': compress_block(self._pending[start:start + self._block_size], self._zdict, self._level)}
+                  for start in range(0, end, self._block_size)]
+        if len(blocks) > 0:
+            self._conn.execute(self._blocks_table.insert(), blocks)  # executemany
+            self.no_of_blocks += len(blocks)
+            self.compressed_size += sum(len(block['data']) for block in blocks)
+        del self._pending[:end]
+
+
+class SentenceBlockReader:
+    def __init__(self, engine):
+        """
+        Look up the sentences of the lines in the compressed blocks of the cold storage (see sent_tables())
+
+        :param engine: The SQLAlchemy engine of the database
+        """
+
+        self._engine = engine
+        self._dict_table, self._blocks_table = sent_tables(MetaData())
+        self._zdict = None  # Read on the first lookup
+
+    def sentences(self, line_ids):
+        """Return the sentences (None for NULL) of the line IDs in the given order (each block is decompressed once)
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+        """
+
+        block_query = select(self._blocks_table.c.first_id, self._blocks_table.c.data). \
+            order_by(self._blocks_table.c.first_id.desc()).limit(1)
+        sentences, blocks = {}, {}
+        with self._engine.connect() as conn:
+            if self._zdict is None:
+                self._zdict = conn.execute(select(self._dict_table.c.zdict)).scalar_one()
+            for line_id in line_ids:
+                if line_id in sentences:
+                    continue
+                block = conn.execute(block_query.where(self._blocks_table.c.first_id <= line_id)).first()
+                if block is not None:
+                    first_id, data = block
+                    if first_id not in blocks:
+                        blocks[first_id] = decompress_block(data, self._zdict)
+                    if line_id in blocks[first_id]:
+                        sentences[line_id] = blocks[first_id][line_id]
+                        continue
+                raise NoResultFound(f'No sentence found for ID {line_id} !')
+
+        return [sentences[line_id] for line_id in line_ids]
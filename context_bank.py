@@ -1,28 +1,144 @@
+import sys
+import json
+import struct
+from os import stat, getpid, register_at_fork
+from mmap import mmap, ACCESS_READ
+from time import monotonic, sleep
+from zlib import crc32
+from heapq import merge
+from array import array
 from pathlib import Path
-from random import randrange, shuffle
+from logging import getLogger
+from operator import itemgetter
+from bisect import bisect, bisect_left
+from threading import Lock, Thread
+from itertools import islice
+from random import Random, random, randrange, shuffle, choice
 
-from sqlalchemy import select, func, Table, create_engine, MetaData
+from sqlalchemy import select, func, inspect, text, Table, Column, create_engine, MetaData
+from sqlalchemy.types import NullType
+from sqlalchemy.exc import NoResultFound
 
+from cold_sentences import SENT_BLOCKS_TABLE, SentenceBlockReader
 
-class ContextBank:
-    def __init__(self, db_config: dict, left_size: int = 5, right_size: int = 5, hide_char: str = '#'):
+WORD_FILTER_KEYS = ('min_len', 'max_len', 'min_freq', 'max_freq', 'prefix')
+
+_engines = {}  # Database path -> engine shared by the stores of the same database (see shared_engine())
+_engines_lock = Lock()
+
+
+def shared_engine(database_path: Path):
+    """Return the engine (and its connection pool) of the database shared by all stores in the process"""
+
+    with _engines_lock:
+        engine = _engines.get(database_path)
+        if engine is None:
+            engine = create_engine(f'sqlite:///{str(database_path)}')
+            _engines[database_path] = engine
+        return engine
+
+
+def _dispose_engines_after_fork():
+    """The pooled connections of the parent (e.g. opened by the warm-up before gunicorn --preload forks the workers)
+        must not be used in the child, the child opens its own connections
+    """
+
+    for engine in _engines.values():
+        engine.dispose(close=False)
+
+
+register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+def dispose_engine(database_path: Path):
+    """Close the pooled connections of the database which is not used anymore (see VersionedContextBank)
+        The connections in use are closed when they are returned (the stores still using the engine reconnect)
+    """
+
+    with _engines_lock:
+        engine = _engines.pop(database_path, None)
+    if engine is not None:
+        engine.dispose()
+
+
+def read_manifest(manifest_path: Path):
+    """Read the manifest of the versions of the database (see create_database/publish_db_version.py)
+        Returns the current version and the version -> database path dictionary (the paths in the manifest
+        are relative to it)
+    """
+
+    with open(manifest_path, encoding='UTF-8') as fh:
+        manifest = json.load(fh)
+    versions = {version: (Path(manifest_path).parent / database_name).resolve()
+                for version, database_name in manifest['versions'].items()}
+    if manifest['current'] not in versions:
+        raise ValueError(f'The current version ({manifest["current"]}) is not among the versions'
+                         f' in {manifest_path} !')
+
+    return manifest['current'], versions
+
+
+def word_shard(word, no_of_shards):
+    """The shard of the word in the database sharded by the hash of the words (see ShardedLineStore)"""
+
+    return crc32(word.encode('UTF-8')) % no_of_shards
+
+
+def sharded_line_id(local_id, shard, no_of_shards):
+    """The line ID of the local_id-th (from 1) line of the shard (the shard of a line ID is line_id % no_of_shards)"""
+
+    return local_id * no_of_shards + shard
+
+
+def word_matches(word_filter, word, freq):
+    """Check the word (and its freq) against the filter (min_len, max_len, min_freq, max_freq, prefix keys)"""
+
+    return (word_filter.get('min_len') is None or len(word) >= word_filter['min_len']) and \
+        (word_filter.get('max_len') is None or len(word) <= word_filter['max_len']) and \
+        (word_filter.get('min_freq') is None or freq >= word_filter['min_freq']) and \
+        (word_filter.get('max_freq') is None or freq <= word_filter['max_freq']) and \
+        word.startswith(word_filter.get('prefix') or '')
+
+
+class SQLiteLineStore:
+    def __init__(self, db_config: dict, boot_cache=None):
         """
-        Interface for selecting words and appropriate contexts for them
+        Read the lines table through SQLAlchemy (one query per request)
+
+        If the table has left_trunc and right_trunc columns (see create_database/create_sqldb.py) they are read
+         instead of the full contexts and truncated_sizes holds the (left_size, right_size) they were truncated to.
+        If the database has a TABLE_NAME_fts full-text index (see create_database/create_sqldb.py --fts)
+         lines_with_tokens() can search the contexts by tokens (has_fts is True).
+        If the table has a rank column (see create_database/rank_contexts.py) next_ranked_line_id() can select
+         the next line of a word in rank order (has_rank is True).
+        The full sentences are never read by the game, only by sentences() from the compressed cold storage
+         (see cold_sentences.py) or from the sent column of the databases created before it.
 
         :param db_config: A dictionary containing the database configuration. Mandatory keys:  database_name,
             table_name, id_name, left_name, word_name, right_name, freq_name
-        :param left_size: the size of left context
-        :param left_size: the size of right context
-        :param hide_char: Character to use when hiding word
+        :param boot_cache: The BootCache (see boot.py) of the reflected schema (None to reflect it every time)
         """
 
         if 'database_name' in db_config:
             # SQLAlchemy 2.0 needs abspath here
-            self._engine = create_engine(f'sqlite:///{str(Path(db_config["database_name"]).resolve())}').engine
+            self.database_path = Path(db_config['database_name']).resolve()
+            if not self.database_path.is_file():  # SQLite would create an empty database
+                raise FileNotFoundError(f'The database ({self.database_path}) does not exist!')
+            self._engine = shared_engine(self.database_path)
         else:
             raise ValueError('db_config[\'database_name\'] or db from flask_sqlalchemy.SQLAlchemy must be set!')
 
-        self._table_obj = Table(db_config['table_name'], MetaData(), autoload_with=self._engine)
+        if boot_cache is not None:
+            schema = boot_cache.cached('schema', boot_cache.file_state_key(self.database_path, db_config['table_name']),
+                                       lambda: self._reflect_schema(db_config['table_name']))
+        else:
+            schema = self._reflect_schema(db_config['table_name'])
+
+        ischema_names = self._engine.dialect.ischema_names
+        self._table_obj = Table(db_config['table_name'], MetaData(),
+                                *(Column(name, ischema_names.get(type_name.split('(')[0].upper(), NullType)(),
+                                         primary_key=primary_key)
+                                  for name, type_name, primary_key in schema['columns']))
         col_objs = {col_obj.key: col_obj for col_obj in self._table_obj.c}
         self._id_obj = col_objs[db_config['id_name']]
         self._left_obj = col_objs[db_config['left_name']]
@@ -30,15 +146,810 @@ class ContextBank:
         self._right_obj = col_objs[db_config['right_name']]
         self._freq = col_objs[db_config['freq_name']]
 
-        if left_size < 0:
-            left_size = 1_000_000  # Extremely big to include full sentence
-        if right_size < 0:
-            right_size = 1_000_000  # Extremely big to include full sentence
+        self.truncated_sizes = None
+        if 'left_trunc' in col_objs and 'right_trunc' in col_objs and schema['meta'] is not None:
+            self.truncated_sizes = (int(schema['meta']['left_size']), int(schema['meta']['right_size']))
+            self._left_obj = col_objs['left_trunc']
+            self._right_obj = col_objs['right_trunc']
+
+        self._fts_name = f'{db_config["table_name"]}_fts'
+        self.has_fts = schema['has_fts']
+
+        self.has_rank = 'rank' in col_objs
+        self._rank_obj = col_objs.get('rank')
+
+        self.meta = schema['meta'] or {}
+
+        self._sent_obj = col_objs.get('sent')
+        self._sent_reader = None
+        if schema.get('has_cold_sent', False):
+            self._sent_reader = SentenceBlockReader(self._engine)
+
+    def _reflect_schema(self, table_name):
+        """Reflect the columns of the table (name, type, primary key), the meta table, the full-text index
+            and the cold storage of the sentences into a JSON serializable dictionary
+        """
+
+        inspector = inspect(self._engine)
+        columns = [[col_obj.name, str(col_obj.type), col_obj.primary_key]
+                   for col_obj in Table(table_name, MetaData(), autoload_with=self._engine).c]
+        meta = self.read_meta() if inspector.has_table('meta') else None
+        return {'columns': columns, 'meta': meta, 'has_fts': inspector.has_table(f'{table_name}_fts'),
+                'has_cold_sent': inspector.has_table(SENT_BLOCKS_TABLE)}
+
+    def read_meta(self):
+        """Read the key-value pairs of the meta table (written by create_database/create_sqldb.py)"""
+
+        meta_table_obj = Table('meta', MetaData(), autoload_with=self._engine)
+        with self._engine.connect() as conn:
+            return dict(conn.execute(select(meta_table_obj.c.key, meta_table_obj.c.value)).all())
+
+    def lines_for_word(self, word):
+        """Yield (line_id, left, word, right) for all lines of the word"""
+
+        with self._engine.connect() as conn:
+            yield from conn.execute(select(self._id_obj, self._left_obj, self._word_obj, self._right_obj).
+                                    where(self._word_obj == word))
+
+    def line(self, line_id):
+        """Return (line_id, left, word, right) for the line ID
+            Raises sqlalchemy.exc.NoResultFound if the query selects no rows
+        """
+
+        with self._engine.connect() as conn:
+            return tuple(conn.execute(select(self._id_obj, self._left_obj, self._word_obj, self._right_obj).
+                                      where(self._id_obj == line_id)).one())
+
+    def lines(self, line_ids):
+        """Return (line_id, left, word, right) for the line IDs in the given order
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+        """
+
+        with self._engine.connect() as conn:
+            lines = {line_id: (line_id, left, word, right) for line_id, left, word, right in
+                     conn.execute(select(self._id_obj, self._left_obj, self._word_obj, self._right_obj).
+                                  where(self._id_obj.in_(line_ids)))}
+        try:
+            return [lines[line_id] for line_id in line_ids]
+        except KeyError as err:
+            raise NoResultFound(f'No line found for ID {err.args[0]} !')
+
+    def line_ids_for_word_of(self, line_id):
+        """Return the sorted line IDs of the word of the line ID"""
+
+        word_query = select(self._word_obj).where(self._id_obj == line_id).scalar_subquery()
+        with self._engine.connect() as conn:
+            return list(conn.execute(select(self._id_obj).where(self._word_obj == word_query).
+                                     order_by(self._id_obj)).scalars())
+
+    def next_ranked_line_id(self, line_id, displayed_line_ids):
+        """Return the line ID of the word of the line ID with the lowest rank which is not displayed
+            (one index lookup on (word, rank)) or None if all lines are displayed
+        """
+
+        word_query = select(self._word_obj).where(self._id_obj == line_id).scalar_subquery()
+        with self._engine.connect() as conn:
+            return conn.execute(select(self._id_obj).where(self._word_obj == word_query,
+                                                           self._id_obj.not_in(displayed_line_ids)).
+                                order_by(self._rank_obj, self._id_obj).limit(1)).scalar()
+
+    def word_and_freq(self, line_id):
+        """Return (word, freq) for the line ID
+            Raises sqlalchemy.exc.NoResultFound if the query selects no rows
+        """
+
+        with self._engine.connect() as conn:
+            word, freq = conn.execute(select(self._word_obj, self._freq).where(self._id_obj == line_id)).one()
+
+        return word, freq
+
+    def sampling_rows(self):
+        """Yield (line_id, word, freq) for all lines ordered by word and line ID"""
+
+        with self._engine.connect() as conn:
+            yield from conn.execute(select(self._id_obj, self._word_obj, self._freq).
+                                    order_by(self._word_obj, self._id_obj))
+
+    def lines_with_tokens(self, tokens, limit=100, start_id=0):
+        """Return (line_id, left, word, right, freq) for at most limit lines (in line ID order, from start_id)
+            which contain all tokens in their contexts (using the full-text index)
+            Raises ValueError if there is no full-text index
+        """
+
+        if not self.has_fts:
+            raise ValueError(f'No full-text index ({self._fts_name}) in the database,'
+                             f' see create_database/create_sqldb.py --fts !')
+
+        # Each token is a quoted string (implicit AND between them), so tokens can not contain FTS5 operators
+        match = ' '.join('"{0}"'.format(token.replace('"', '""')) for token in tokens)
+        fts_query = text(f'SELECT rowid FROM "{self._fts_name}" WHERE "{self._fts_name}" MATCH :match'
+                         f' AND rowid >= :start_id ORDER BY rowid LIMIT :limit')
+        with self._engine.connect() as conn:
+            line_ids = conn.execute(fts_query, {'match': match, 'start_id': start_id, 'limit': limit}).scalars().all()
+            return [tuple(row) for row in
+                    conn.execute(select(self._id_obj, self._left_obj, self._word_obj, self._right_obj, self._freq).
+                                 where(self._id_obj.in_(line_ids)).order_by(self._id_obj))]
+
+    def sentences(self, line_ids):
+        """Return the full sentences (None for NULL) of the line IDs in the given order (not used by the game)
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+            Raises ValueError if the database has no sentences
+        """
+
+        if self._sent_reader is not None:
+            return self._sent_reader.sentences(line_ids)
+        elif self._sent_obj is None:
+            raise ValueError(f'No sentences in the database ({self.database_path}) !')
+
+        with self._engine.connect() as conn:
+            sentences = dict(conn.execute(select(self._id_obj, self._sent_obj).where(self._id_obj.in_(line_ids))).all())
+        try:
+            return [sentences[line_id] for line_id in line_ids]
+        except KeyError as err:
+            raise NoResultFound(f'No line found for ID {err.args[0]} !')
+
+    def word_id_ranges(self):
+        """Yield (word, first line ID, number of lines, last line ID, freq) for all words ordered by word"""
+
+        with self._engine.connect() as conn:
+            # The bare freq column is read from the row of the first line ID
+            yield from conn.execute(select(self._word_obj, func.min(self._id_obj), func.count(), func.max(self._id_obj),
+                                           self._freq).group_by(self._word_obj).order_by(self._word_obj))
+
+    def all_lines(self):
+        """Yield (line_id, left, word, right, freq) for all lines ordered by word and rank (if present) and line ID"""
+
+        order = [self._word_obj, self._id_obj]
+        if self.has_rank:
+            order.insert(1, self._rank_obj)
+        with self._engine.connect() as conn:
+            yield from conn.execute(select(self._id_obj, self._left_obj, self._word_obj, self._right_obj,
+                                           self._freq).order_by(*order))
+
+
+class InMemoryLineStore:
+    def __init__(self, rows, has_rank: bool = False):
+        """
+        Read-only in-memory index of the lines table to serve every read without touching the database
+
+        Lines are ordered by (word, line_id) or (word, rank, line_id). Each word owns a contiguous range of positions
+         in that order, line IDs are mapped to their position and word offset by two arrays indexed by line ID.
+         Contexts are stored in one shared string buffer. Identical contexts are stored only once.
+
+        :param rows: (line_id, left, word, right, freq) tuples ordered by word and line ID
+            or by word, rank and line ID (see SQLiteLineStore.all_lines())
+        :param has_rank: The rows of each word are in rank order (see next_ranked_line_id())
+        """
+
+        self.has_rank = has_rank
+
+        self._words = []  # Word offset -> word
+        self._word_ranges = {}  # Word -> (first position, last position + 1)
+        self._line_ids = array('q')  # Position -> line ID
+        self._freqs = array('q')  # Position -> freq
+        self._spans = array('q')  # Position -> left start, left end, right start, right end in the buffer
+        buffer_parts, buffer_len, seen_contexts = [], 0, {}
+
+        for line_id, left, word, right, freq in rows:
+            pos = len(self._line_ids)
+            if len(self._words) == 0 or self._words[-1] != word:
+                self._word_ranges[word] = (pos, pos)
+                self._words.append(word)
+            self._word_ranges[word] = (self._word_ranges[word][0], pos + 1)
+            self._line_ids.append(line_id)
+            self._freqs.append(freq)
+            for context in (left, right):
+                span = seen_contexts.get(context)
+                if span is None:
+                    span = (buffer_len, buffer_len + len(context))
+                    seen_contexts[context] = span
+                    buffer_parts.append(context)
+                    buffer_len += len(context)
+                self._spans.extend(span)
+
+        self._buffer = ''.join(buffer_parts)
+
+        # Line ID -> position and line ID -> word offset (-1 for missing IDs)
+        max_id = max(self._line_ids, default=0)
+        self._id_to_pos = array('q', [-1]) * (max_id + 1)
+        self._id_to_word = array('l', [-1]) * (max_id + 1)
+        for word_offset, word in enumerate(self._words):
+            start, end = self._word_ranges[word]
+            for pos in range(start, end):
+                line_id = self._line_ids[pos]
+                self._id_to_pos[line_id] = pos
+                self._id_to_word[line_id] = word_offset
+
+    def _pos_for_id(self, line_id):
+        if 0 <= line_id < len(self._id_to_pos):
+            pos = self._id_to_pos[line_id]
+            if pos >= 0:
+                return pos
+        raise NoResultFound(f'No line found for ID {line_id} !')
+
+    def _line_at(self, pos, word):
+        left_start, left_end, right_start, right_end = self._spans[4 * pos:4 * pos + 4]
+        return self._line_ids[pos], self._buffer[left_start:left_end], word, self._buffer[right_start:right_end]
+
+    def lines_for_word(self, word):
+        """Yield (line_id, left, word, right) for all lines of the word"""
+
+        start, end = self._word_ranges.get(word, (0, 0))
+        for pos in range(start, end):
+            yield self._line_at(pos, word)
+
+    def line(self, line_id):
+        """Return (line_id, left, word, right) for the line ID
+            Raises sqlalchemy.exc.NoResultFound if there is no such line
+        """
+
+        pos = self._pos_for_id(line_id)
+        return self._line_at(pos, self._words[self._id_to_word[line_id]])
+
+    def lines(self, line_ids):
+        """Return (line_id, left, word, right) for the line IDs in the given order
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+        """
+
+        return [self.line(line_id) for line_id in line_ids]
+
+    def line_ids_for_word_of(self, line_id):
+        """Return the sorted line IDs of the word of the line ID"""
+
+        if not 0 <= line_id < len(self._id_to_word) or self._id_to_word[line_id] < 0:
+            return []
+        start, end = self._word_ranges[self._words[self._id_to_word[line_id]]]
+        return sorted(self._line_ids[start:end])
+
+    def next_ranked_line_id(self, line_id, displayed_line_ids):
+        """Return the line ID of the word of the line ID with the lowest rank which is not displayed
+            (the lines of each word are stored in rank order) or None if all lines are displayed
+        """
+
+        if not 0 <= line_id < len(self._id_to_word) or self._id_to_word[line_id] < 0:
+            return None
+        start, end = self._word_ranges[self._words[self._id_to_word[line_id]]]
+        displayed_line_ids_set = set(displayed_line_ids)
+        for pos in range(start, end):
+            if self._line_ids[pos] not in displayed_line_ids_set:
+                return self._line_ids[pos]
+
+        return None
+
+    def word_and_freq(self, line_id):
+        """Return (word, freq) for the line ID
+            Raises sqlalchemy.exc.NoResultFound if there is no such line
+        """
+
+        pos = self._pos_for_id(line_id)
+        return self._words[self._id_to_word[line_id]], self._freqs[pos]
+
+    def sampling_rows(self):
+        """Yield (line_id, word, freq) for all lines ordered by word and line ID"""
+
+        for word in self._words:
+            start, end = self._word_ranges[word]
+            for pos in range(start, end):
+                yield self._line_ids[pos], word, self._freqs[pos]
+
+
+class _WordRangeLineIds:
+    def __init__(self, word_starts, first_line_ids, step):
+        """Sequence of the line IDs grouped by word where the line IDs of each word are
+            first line ID, first line ID + step, ... (computed on access instead of stored)
+        """
+
+        self._word_starts = word_starts
+        self._first_line_ids = first_line_ids
+        self._step = step
+
+    def __len__(self):
+        return self._word_starts[-1]
+
+    def __getitem__(self, pos):
+        if not 0 <= pos < len(self):
+            raise IndexError('Position out of range!')
+        word_offset = bisect(self._word_starts, pos) - 1
+        return self._first_line_ids[word_offset] + (pos - self._word_starts[word_offset]) * self._step
+
+
+class ShardedLineStore:
+    def __init__(self, stores):
+        """
+        Read the lines of the database sharded by the hash of the words (see create_database/create_sqldb.py --shards)
+
+        All lines of a word are in its shard (see word_shard()) and the shard of a line is encoded in its ID
+         (see sharded_line_id()), so the reads by word or by line ID are routed to one shard without storing
+         a map. Only the full-text search and the full scans read every shard (merged in order).
+        If the line IDs of each word are consecutive in its shard (the input of create_sqldb.py is grouped by word)
+         the random lines are selected by the ranges of the words (see sampling_arrays())
+         instead of the list of all line IDs.
+
+        :param stores: The SQLiteLineStores of the shards in shard order
+        """
+
+        for shard, store in enumerate(stores):
+            if store.meta.get('shard') != str(shard) or store.meta.get('shards') != str(len(stores)):
+                raise ValueError(f'The database ({store.database_path}) is not shard {shard} of {len(stores)}'
+                                 f' shards (see create_database/create_sqldb.py --shards) !')
+            if store.truncated_sizes != stores[0].truncated_sizes:
+                raise ValueError(f'The contexts of the shards are truncated to different sizes'
+                                 f' ({store.database_path}) !')
+
+        self._stores = stores
+        self._no_of_shards = len(stores)
+        self.database_path = None  # The shards are never refreshed by LineSampler
+        self.database_paths = [store.database_path for store in stores]
+        self.truncated_sizes = stores[0].truncated_sizes
+        self.has_fts = all(store.has_fts for store in stores)
+        self.has_rank = all(store.has_rank for store in stores)
+
+    def _store_of(self, line_id):
+        return self._stores[line_id % self._no_of_shards]
+
+    def lines_for_word(self, word):
+        """Yield (line_id, left, word, right) for all lines of the word"""
+
+        yield from self._stores[word_shard(word, self._no_of_shards)].lines_for_word(word)
+
+    def line(self, line_id):
+        """Return (line_id, left, word, right) for the line ID
+            Raises sqlalchemy.exc.NoResultFound if the query selects no rows
+        """
+
+        return self._store_of(line_id).line(line_id)
+
+    def lines(self, line_ids):
+        """Return (line_id, left, word, right) for the line IDs in the given order (one query for each shard)
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+        """
+
+        shard_line_ids = {}
+        for line_id in line_ids:
+            shard_line_ids.setdefault(line_id % self._no_of_shards, []).append(line_id)
+        lines = {}
+        for shard, ids in shard_line_ids.items():
+            lines.update((line[0], line) for line in self._stores[shard].lines(ids))
+
+        return [lines[line_id] for line_id in line_ids]
+
+    def line_ids_for_word_of(self, line_id):
+        """Return the sorted line IDs of the word of the line ID"""
+
+        return self._store_of(line_id).line_ids_for_word_of(line_id)
+
+    def next_ranked_line_id(self, line_id, displayed_line_ids):
+        """Return the line ID of the word of the line ID with the lowest rank which is not displayed
+            or None if all lines are displayed
+        """
+
+        return self._store_of(line_id).next_ranked_line_id(line_id, displayed_line_ids)
+
+    def word_and_freq(self, line_id):
+        """Return (word, freq) for the line ID
+            Raises sqlalchemy.exc.NoResultFound if the query selects no rows
+        """
+
+        return self._store_of(line_id).word_and_freq(line_id)
+
+    def sentences(self, line_ids):
+        """Return the full sentences of the line IDs in the given order (one lookup for each shard)
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+            Raises ValueError if the database has no sentences
+        """
+
+        shard_line_ids = {}
+        for line_id in line_ids:
+            shard_line_ids.setdefault(line_id % self._no_of_shards, []).append(line_id)
+        sentences = {}
+        for shard, ids in shard_line_ids.items():
+            sentences.update(zip(ids, self._stores[shard].sentences(ids)))
+
+        return [sentences[line_id] for line_id in line_ids]
+
+    def sampling_rows(self):
+        """Yield (line_id, word, freq) for all lines ordered by word and line ID (the shards have no common words)"""
+
+        return merge(*(store.sampling_rows() for store in self._stores), key=itemgetter(1))
+
+    def sampling_arrays(self):
+        """Return the arrays of LineSampler with the line IDs stored as the ranges of the words
+            (see LineSampler._build()) or None if the line IDs of a word are not consecutive in its shard
+        """
+
+        word_starts, first_line_ids, cum_weights, words, word_freqs = array('q'), array('q'), array('d'), [], array('q')
+        no_of_lines, total_weight = 0, 0.0
+        for word, first_line_id, count, last_line_id, freq in \
+                merge(*(store.word_id_ranges() for store in self._stores), key=itemgetter(0)):
+            if last_line_id - first_line_id != (count - 1) * self._no_of_shards:
+                return None
+            word_starts.append(no_of_lines)
+            first_line_ids.append(first_line_id)
+            total_weight += freq
+            cum_weights.append(total_weight)
+            words.append(word)
+            word_freqs.append(freq)
+            no_of_lines += count
+        word_starts.append(no_of_lines)
+
+        return _WordRangeLineIds(word_starts, first_line_ids, self._no_of_shards), word_starts, cum_weights, words, \
+            word_freqs
+
+    def lines_with_tokens(self, tokens, limit=100, start_id=0):
+        """Return (line_id, left, word, right, freq) for at most limit lines (in line ID order, from start_id)
+            which contain all tokens in their contexts (using the full-text indexes of the shards)
+            Raises ValueError if there is no full-text index
+        """
+
+        if not self.has_fts:
+            raise ValueError('No full-text index in all shards, see create_database/create_sqldb.py --fts !')
+
+        return list(islice(merge(*(store.lines_with_tokens(tokens, limit, start_id) for store in self._stores),
+                                 key=itemgetter(0)), limit))
+
+    def all_lines(self):
+        """Yield (line_id, left, word, right, freq) for all lines ordered by word and rank (if present) and line ID"""
+
+        return merge(*(store.all_lines() for store in self._stores), key=itemgetter(2))
+
+
+class _MmapWords:
+    def __init__(self, words_blob, word_offsets):
+        """Sequence of the words of the binary corpus decoded on access (for bisect and indexing)"""
+
+        self._words_blob = words_blob
+        self._word_offsets = word_offsets
 
-        self._left_size = left_size
-        self._right_size = right_size
+    def __len__(self):
+        return len(self._word_offsets) - 1
+
+    def __getitem__(self, word_offset):
+        if not 0 <= word_offset < len(self):
+            raise IndexError('Word offset out of range!')
+        return str(self._words_blob[self._word_offsets[word_offset]:self._word_offsets[word_offset + 1]], 'UTF-8')
+
+
+class MmapLineStore:
+    MAGIC = b'WGGCORP\0'
+    VERSION = 1
+    FLAG_RANKED = 1
+    FLAG_TRUNCATED = 2
+    SECTIONS = (('line_ids', 'q'), ('line_freqs', 'q'), ('context_offsets', 'Q'), ('word_starts', 'Q'),
+                ('word_offsets', 'Q'), ('word_freqs', 'q'), ('word_cum_freqs', 'd'), ('id_to_pos', 'q'),
+                ('id_to_word', 'q'), ('words', 'B'), ('contexts', 'B'))
+    HEADER_FORMAT = f'<8sIIQQQii{len(SECTIONS)}Q'
+
+    def __init__(self, db_config: dict):
+        """
+        Read-only store over the memory-mapped binary corpus file (see create_database/create_mmap_corpus.py)
+
+        The pages of the file are shared by all processes through the OS page cache and nothing is read
+         at startup except the header. The words are sorted, so they are looked up by binary search.
+         The file must not be modified while it is mapped (replace it with a new file instead).
+
+        :param db_config: A dictionary containing the database configuration. Mandatory keys: database_name
+            (the binary corpus file)
+        """
+
+        if sys.byteorder != 'little':
+            raise ValueError('The binary corpus format is supported only on little-endian platforms!')
+
+        self.database_path = Path(db_config['database_name']).resolve()
+        with open(self.database_path, 'rb') as fh:
+            self._mmap = mmap(fh.fileno(), 0, access=ACCESS_READ)
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        magic, version, flags, no_of_lines, no_of_words, no_of_ids, left_size, right_size, *offsets = \
+            struct.unpack(self.HEADER_FORMAT, self._mmap[:header_size])
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f'{self.database_path} is not a binary corpus file (version {self.VERSION}) !')
+
+        lengths = {'line_ids': no_of_lines, 'line_freqs': no_of_lines, 'context_offsets': 2 * no_of_lines + 1,
+                   'word_starts': no_of_words + 1, 'word_offsets': no_of_words + 1, 'word_freqs': no_of_words,
+                   'word_cum_freqs': no_of_words, 'id_to_pos': no_of_ids, 'id_to_word': no_of_ids}
+        buffer = memoryview(self._mmap)
+        sections = {}
+        for (name, typecode), start, end in zip(self.SECTIONS, offsets, offsets[1:] + [len(self._mmap)]):
+            if name in lengths:
+                end = start + lengths[name] * struct.calcsize(typecode)
+            sections[name] = buffer[start:end].cast(typecode)
+
+        self._line_ids = sections['line_ids']
+        self._line_freqs = sections['line_freqs']
+        self._context_offsets = sections['context_offsets']
+        self._word_starts = sections['word_starts']
+        self._word_freqs = sections['word_freqs']
+        self._word_cum_freqs = sections['word_cum_freqs']
+        self._id_to_pos = sections['id_to_pos']
+        self._id_to_word = sections['id_to_word']
+        self._contexts = sections['contexts']
+        self._words = _MmapWords(sections['words'], sections['word_offsets'])
+
+        self.truncated_sizes = (left_size, right_size) if flags & self.FLAG_TRUNCATED else None
+        self.has_rank = bool(flags & self.FLAG_RANKED)
+        self.has_fts = False
+
+    def _pos_for_id(self, line_id):
+        if 0 <= line_id < len(self._id_to_pos):
+            pos = self._id_to_pos[line_id]
+            if pos >= 0:
+                return pos
+        raise NoResultFound(f'No line found for ID {line_id} !')
+
+    def _line_at(self, pos, word):
+        left_start, left_end, right_end = self._context_offsets[2 * pos:2 * pos + 3]
+        return self._line_ids[pos], str(self._contexts[left_start:left_end], 'UTF-8'), word, \
+            str(self._contexts[left_end:right_end], 'UTF-8')
+
+    def _word_range_of(self, line_id):
+        if not 0 <= line_id < len(self._id_to_word) or self._id_to_word[line_id] < 0:
+            return 0, 0
+        word_offset = self._id_to_word[line_id]
+        return self._word_starts[word_offset], self._word_starts[word_offset + 1]
+
+    def lines_for_word(self, word):
+        """Yield (line_id, left, word, right) for all lines of the word"""
+
+        word_offset = bisect_left(self._words, word)
+        if word_offset < len(self._words) and self._words[word_offset] == word:
+            for pos in range(self._word_starts[word_offset], self._word_starts[word_offset + 1]):
+                yield self._line_at(pos, word)
+
+    def line(self, line_id):
+        """Return (line_id, left, word, right) for the line ID
+            Raises sqlalchemy.exc.NoResultFound if there is no such line
+        """
+
+        pos = self._pos_for_id(line_id)
+        return self._line_at(pos, self._words[self._id_to_word[line_id]])
+
+    def lines(self, line_ids):
+        """Return (line_id, left, word, right) for the line IDs in the given order
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+        """
+
+        return [self.line(line_id) for line_id in line_ids]
+
+    def line_ids_for_word_of(self, line_id):
+        """Return the sorted line IDs of the word of the line ID"""
+
+        start, end = self._word_range_of(line_id)
+        return sorted(self._line_ids[start:end])
+
+    def next_ranked_line_id(self, line_id, displayed_line_ids):
+        """Return the line ID of the word of the line ID with the lowest rank which is not displayed
+            (the lines of each word are stored in rank order) or None if all lines are displayed
+        """
+
+        start, end = self._word_range_of(line_id)
+        displayed_line_ids_set = set(displayed_line_ids)
+        for pos in range(start, end):
+            if self._line_ids[pos] not in displayed_line_ids_set:
+                return self._line_ids[pos]
+
+        return None
+
+    def word_and_freq(self, line_id):
+        """Return (word, freq) for the line ID
+            Raises sqlalchemy.exc.NoResultFound if there is no such line
+        """
+
+        pos = self._pos_for_id(line_id)
+        return self._words[self._id_to_word[line_id]], self._line_freqs[pos]
+
+    def lines_with_tokens(self, *_):
+        raise ValueError('No full-text index for the binary corpus (use the sqlite backend)!')
+
+    def sentences(self, *_):
+        raise ValueError('No sentences in the binary corpus (use the sqlite backend)!')
+
+    def sampling_rows(self):
+        """Yield (line_id, word, freq) for all lines ordered by word"""
+
+        for word_offset in range(len(self._words)):
+            word = self._words[word_offset]
+            for pos in range(self._word_starts[word_offset], self._word_starts[word_offset + 1]):
+                yield self._line_ids[pos], word, self._line_freqs[pos]
+
+    def sampling_arrays(self):
+        """Return the arrays of LineSampler directly from the file (see LineSampler._build())"""
+
+        return self._line_ids, self._word_starts, self._word_cum_freqs, self._words, self._word_freqs
+
+
+class LineSampler:
+    def __init__(self, store, mode: str = 'line', database_path: Path = None):
+        """
+        Select random line IDs from the valid IDs of the store without querying it
+
+        The valid IDs are cached in packed arrays, grouped by word. The cache is rebuilt only if
+         the database file (if given) changes on the disk.
+        The words (in sorted order) and their freqs are kept as well to select from the words matching a filter
+         (see word_matches()) without querying the store. The matching words are cached for each filter.
+
+        :param store: The line store (SQLiteLineStore or InMemoryLineStore) to sample from
+        :param mode: line: uniform over lines, word: uniform over words, freq: words weighted by their frequency
+        :param database_path: The database file to watch for changes (None for never refresh)
+        """
+
+        if mode not in {'line', 'word', 'freq'}:
+            raise ValueError(f'Unknown sampling mode: {mode} !')
+        self._store = store
+        self._mode = mode
+        self._database_path = database_path
+        self._lock = Lock()
+        self._file_state = self._get_file_state()
+        self._arrays = self._build()  # Swapped at once to be consistent for concurrent readers
+
+    def _get_file_state(self):
+        if self._database_path is None:
+            return None
+        file_stat = stat(self._database_path)
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def _build(self):
+        if hasattr(self._store, 'sampling_arrays'):  # Precomputed (see MmapLineStore and ShardedLineStore)
+            sampling_arrays = self._store.sampling_arrays()
+            if sampling_arrays is not None:
+                return (*sampling_arrays, {})
+
+        line_ids = array('q')  # Line IDs grouped by word
+        word_starts = array('q')  # Word offset -> first position in line_ids (+ a closing element)
+        cum_weights = array('d')  # Word offset -> cumulative freq of the words up to and including this word
+        words = []  # Word offset -> word (sorted)
+        word_freqs = array('q')  # Word offset -> freq
+        prev_word, total_weight = None, 0.0
+        for line_id, word, freq in self._store.sampling_rows():
+            if word != prev_word:
+                word_starts.append(len(line_ids))
+                total_weight += freq
+                cum_weights.append(total_weight)
+                words.append(word)
+                word_freqs.append(freq)
+                prev_word = word
+            line_ids.append(line_id)
+        word_starts.append(len(line_ids))
+
+        return line_ids, word_starts, cum_weights, words, word_freqs, {}  # The last one caches the filtered words
+
+    def _refresh_if_changed(self):
+        file_state = self._get_file_state()
+        if file_state != self._file_state:
+            with self._lock:
+                if file_state != self._file_state:
+                    self._arrays = self._build()
+                    self._file_state = file_state
+
+    def _filtered_words(self, arrays, word_filter):
+        """Return the offsets of the words matching the filter and their cumulative weights for the sampling mode"""
+
+        _, word_starts, _, words, word_freqs, filter_cache = arrays
+        key = tuple(sorted(word_filter.items()))
+        filtered = filter_cache.get(key)
+        if filtered is None:
+            # The words are sorted (as ordered by SQLite), so the words with the prefix are in one range
+            prefix = word_filter.get('prefix') or ''
+            start = bisect_left(words, prefix)
+            end = bisect_left(words, f'{prefix}\U0010ffff', start) if len(prefix) > 0 else len(words)
+            word_offsets, cum_weights, total_weight = array('q'), array('d'), 0.0
+            for word_offset in range(start, end):
+                if word_matches(word_filter, words[word_offset], word_freqs[word_offset]):
+                    if self._mode == 'line':
+                        total_weight += word_starts[word_offset + 1] - word_starts[word_offset]
+                    elif self._mode == 'word':
+                        total_weight += 1
+                    else:  # freq
+                        total_weight += word_freqs[word_offset]
+                    word_offsets.append(word_offset)
+                    cum_weights.append(total_weight)
+            filtered = (word_offsets, cum_weights)
+            if len(filter_cache) >= 1000:  # Keep the cache bounded
+                filter_cache.clear()
+            filter_cache[key] = filtered
+
+        return filtered
+
+    def random_line_id(self, word_filter=None):
+        """Select a random line ID according to the sampling mode (of the words matching the filter if given)
+            Raises sqlalchemy.exc.NoResultFound if there are no lines to sample from
+        """
+
+        self._refresh_if_changed()
+        arrays = self._arrays
+        line_ids, word_starts, cum_weights = arrays[:3]
+
+        if len(line_ids) == 0:
+            raise NoResultFound('No lines to sample from!')
+
+        if word_filter is not None and len(word_filter) > 0:
+            word_offsets, filtered_cum_weights = self._filtered_words(arrays, word_filter)
+            if len(word_offsets) == 0:
+                raise NoResultFound(f'No words match the filter: {word_filter} !')
+            i = min(bisect(filtered_cum_weights, random() * filtered_cum_weights[-1]), len(word_offsets) - 1)
+            word_offset = word_offsets[i]
+            return line_ids[randrange(word_starts[word_offset], word_starts[word_offset + 1])]
+
+        if self._mode == 'line':
+            return line_ids[randrange(len(line_ids))]
+
+        if self._mode == 'word':
+            word_offset = randrange(len(word_starts) - 1)
+        else:  # freq
+            word_offset = min(bisect(cum_weights, random() * cum_weights[-1]), len(cum_weights) - 1)
+
+        return line_ids[randrange(word_starts[word_offset], word_starts[word_offset + 1])]
+
+
+class ContextBank:
+    def __init__(self, db_config: dict, left_size: int = 5, right_size: int = 5, hide_char: str = '#',
+                 preload: bool = False, sampling: str = 'line', line_order: str = None, boot_cache=None):
+        """
+        Interface for selecting words and appropriate contexts for them
+
+        :param db_config: A dictionary containing the database configuration. Mandatory keys:  database_name,
+            table_name, id_name, left_name, word_name, right_name, freq_name. Optional keys: backend (sqlite: the
+            SQLite database (default), mmap: the binary corpus file, see create_database/create_mmap_corpus.py),
+            shards (the number of shards of the SQLite database, database_name is the pattern of their filenames
+            with {shard}, see ShardedLineStore)
+        :param left_size: the size of left context
+        :param left_size: the size of right context
+        :param hide_char: Character to use when hiding word
+        :param preload: Load the whole table into memory once and serve all reads from there
+        :param sampling: The way of selecting random lines (line, word or freq, see LineSampler)
+        :param line_order: The order of the next lines of a word: seeded (random order fixed by the seed of the game)
+            or rank (see create_database/rank_contexts.py). Default: rank if the database is ranked else seeded
+        :param boot_cache: The BootCache (see boot.py) of the reflected schema of the SQLite database
+        """
+
+        backend = db_config.get('backend', 'sqlite')
+        if db_config.get('shards') is not None:
+            shard_filenames = [db_config['database_name'].format(shard=shard) for shard in range(db_config['shards'])]
+            if backend != 'sqlite' or len(set(shard_filenames)) != len(shard_filenames):
+                raise ValueError('The sharded database needs the sqlite backend and {shard} in database_name!')
+            self._store = ShardedLineStore([SQLiteLineStore(dict(db_config, database_name=shard_filename), boot_cache)
+                                            for shard_filename in shard_filenames])
+        elif backend == 'sqlite':
+            self._store = SQLiteLineStore(db_config, boot_cache)
+        elif backend == 'mmap':
+            self._store = MmapLineStore(db_config)
+            preload = False  # Already in memory (shared by the processes)
+        else:
+            raise ValueError(f'Unknown backend: {backend} !')
+
+        # Contexts truncated when the database was created
+        self._precomputed_truncation = self._store.truncated_sizes is not None
+        if self._precomputed_truncation and \
+                tuple(self._normalize_size(size) for size in self._store.truncated_sizes) != \
+                (self._normalize_size(left_size), self._normalize_size(right_size)):
+            raise ValueError(f'The contexts in the database are truncated to {self._store.truncated_sizes}'
+                             f' (left_size, right_size) which does not match the configured'
+                             f' {(left_size, right_size)} !')
+
+        if line_order is None:
+            line_order = 'rank' if self._store.has_rank else 'seeded'
+        if line_order not in {'seeded', 'rank'}:
+            raise ValueError(f'Unknown line order: {line_order} !')
+        if line_order == 'rank' and not self._store.has_rank:
+            raise ValueError('The rank line order needs a ranked database (see create_database/rank_contexts.py) !')
+        self._line_order = line_order
+
+        self._search_store = self._store  # The full-text index and the sentences are always read from the database
+        if preload:
+            self._store = InMemoryLineStore(self._store.all_lines(), self._store.has_rank)
+            self._sampler = LineSampler(self._store, sampling)  # The index is never refreshed
+        else:
+            self._sampler = LineSampler(self._store, sampling, self._store.database_path)
+
+        self._left_size = self._normalize_size(left_size)
+        self._right_size = self._normalize_size(right_size)
 
         self._hide_char = hide_char
+        self._hidden_forms = {}  # Word length -> hidden form
+
+    @staticmethod
+    def _normalize_size(size):
+        if size < 0:
+            size = 1_000_000  # Extremely big to include full sentence
+        return size
 
     def read_all_lines_for_word(self, word: str = None, displayed_lines: list = (), hide_word=True):
         """Read all lines for the specific word and separate the ones which were already shown from the new ones"""
@@ -57,61 +968,187 @@ class ContextBank:
                            ' if word is None in read_all_lines_for_word !')
         displayed_lines_set = set(displayed_lines)
 
-        with self._engine.connect() as conn:
-            all_lines_for_word_query = conn.execute(select(self._id_obj, self._left_obj, self._word_obj,
-                                                           self._right_obj).
-                                                    where(self._word_obj == word))
+        for line_id, left, word, right in self._store.lines_for_word(word):
+            word_hidden = hide_fun(word)
+            left_truncated, right_truncated = self._truncate_context(left, right)
 
-            for line_id, left, word, right in all_lines_for_word_query:
-                word_hidden = hide_fun(word)
-                left_truncated, right_truncated = self._truncate_context(left, right)
-
-                if line_id in displayed_lines_set:
-                    lines_to_display[line_id] = [line_id, left_truncated, word_hidden, right_truncated]
-                else:
-                    new_lines.append([line_id, left_truncated, word_hidden, right_truncated])
+            if line_id in displayed_lines_set:
+                lines_to_display[line_id] = [line_id, left_truncated, word_hidden, right_truncated]
+            else:
+                new_lines.append([line_id, left_truncated, word_hidden, right_truncated])
 
         lines_to_display = [lines_to_display[line_id] for line_id in displayed_lines]  # In the original order!
         shuffle(new_lines)
 
         return lines_to_display, new_lines
 
+    def read_lines(self, line_ids, hide_word=True):
+        """Read the lines by their IDs (in the given order) and return the word with the (truncated) lines
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+            Raises ValueError if the lines belong to different words
+        """
+
+        if len(line_ids) == 0:
+            raise ValueError('At least one line ID must be given to read_lines !')
+
+        if hide_word:
+            hide_fun = self._hide_word
+        else:
+            hide_fun = self._identity
+
+        lines = []
+        words = set()
+        for line_id, left, word, right in self._store.lines(line_ids):
+            words.add(word)
+            left_truncated, right_truncated = self._truncate_context(left, right)
+            lines.append([line_id, left_truncated, hide_fun(word), right_truncated])
+
+        if len(words) > 1:
+            raise ValueError('The lines in read_lines must belong to the same word!')
+
+        return words.pop(), lines
+
+    def next_line_id(self, word_line_id, displayed_lines, seed):
+        """Select the next line ID for the word of word_line_id which is not yet displayed
+            The lines are ordered by their rank (see create_database/rank_contexts.py) or by the (seeded) shuffle
+             of their IDs, so the order is the same for the same seed
+            Returns None if there are no more lines for the word
+        """
+
+        if self._line_order == 'rank':
+            return self._store.next_ranked_line_id(word_line_id, displayed_lines)
+
+        line_ids = self._store.line_ids_for_word_of(word_line_id)
+        Random(seed).shuffle(line_ids)
+        displayed_lines_set = set(displayed_lines)
+        for line_id in line_ids:
+            if line_id not in displayed_lines_set:
+                return line_id
+
+        return None
+
     def _truncate_context(self, left, right):
         """Truncate contexts if needed"""
 
+        if self._precomputed_truncation:
+            return left, right
+
         left_split = left.split(' ')
         right_split = right.split(' ')
         left_truncated = ' '.join(left_split[max(len(left_split)-self._left_size, 0):])
         right_truncated = ' '.join(right_split[:min(self._right_size, len(right_split))])
         return left_truncated, right_truncated
 
-    def select_one_random_line(self):
+    def checkout(self, version: str = None):
+        """Return the version (None) and the ContextBank (self) for the version of a game (see VersionedContextBank)
+            Raises KeyError if a version is given as the database is not versioned
+        """
+
+        if version is not None:
+            raise KeyError(f'The database is not versioned, unknown version: {version} !')
+
+        return None, self
+
+    def warm_up(self, chunk_size: int = 1 << 20):
+        """Prime the caches before the first request (e.g. before gunicorn --preload forks the workers):
+            read the database file into the page cache of the OS and run the queries of a game once
+        """
+
+        for database_path in self.database_paths:
+            with open(database_path, 'rb') as fh:
+                while len(fh.read(chunk_size)) > 0:
+                    pass
+
+        line_id = self.select_one_random_line()[0][0]
+        self.read_lines([line_id])
+        self.next_line_id(line_id, [line_id], 0)
+
+    @property
+    def database_paths(self):
+        """The database files read by the ContextBank (one for each shard)"""
+
+        return getattr(self._search_store, 'database_paths', [self._search_store.database_path])
+
+    @property
+    def line_order(self):
+        """The order of the next lines of a word: seeded or rank (see next_line_id())"""
+
+        return self._line_order
+
+    @property
+    def has_fts(self):
+        """The contexts can be searched by tokens (see search_lines())"""
+
+        return self._search_store.has_fts
+
+    def sentences(self, line_ids):
+        """Return the full sentences of the line IDs in the given order from the database (never preloaded)
+            Raises sqlalchemy.exc.NoResultFound if any of the line IDs is missing
+            Raises ValueError if the database has no sentences
+        """
+
+        return self._search_store.sentences(line_ids)
+
+    def search_lines(self, tokens, limit: int = 100, word_filter: dict = None, hide_word=True):
+        """Return at most limit (truncated) lines (in line ID order) which contain all tokens in their contexts
+            and their word matches the filter (see word_matches()) using the full-text index
+            Raises ValueError if there is no full-text index
+        """
+
+        if hide_word:
+            hide_fun = self._hide_word
+        else:
+            hide_fun = self._identity
+
+        lines = []
+        for line_id, left, word, right, freq in self._search_store.lines_with_tokens(tokens, limit):
+            if word_filter is None or word_matches(word_filter, word, freq):
+                left_truncated, right_truncated = self._truncate_context(left, right)
+                lines.append([line_id, left_truncated, hide_fun(word), right_truncated])
+
+        return lines
+
+    def select_one_random_line(self, word_filter: dict = None, tokens=()):
         """Select one random line from all available lines
+            or from the lines of the words matching the filter (see word_matches())
+            and from the lines containing the tokens in their contexts (see search_lines())
             Raises sqlalchemy.exc.NoResultFound if the query selects no rows
             Raises sqlalchemy.exc.MultipleResultsFound if multiple rows are returned
         """
 
-        random_line_id = self._get_random_line_id()
+        if len(tokens) > 0:
+            random_line_id = self._get_random_line_id_with_tokens(tokens, word_filter)
+        else:
+            random_line_id = self._get_random_line_id(word_filter)
 
         # Retrieve data for that specific line
-        with self._engine.connect() as conn:
-            entry_query = conn.execute(select(self._id_obj, self._left_obj, self._word_obj, self._right_obj).
-                                       where(self._id_obj == random_line_id))
-            line_id, left, word, right = entry_query.one()
+        line_id, left, word, right = self._store.line(random_line_id)
 
         left_truncated, right_truncated = self._truncate_context(left, right)
 
         return [[line_id, left_truncated, self._hide_word(word), right_truncated]]
 
-    def _get_random_line_id(self):
+    def _get_random_line_id(self, word_filter=None):
         """Select a random id (line_id) from the table"""
 
-        with self._engine.connect() as conn:
-            row_count = conn.execute(select(func.count(self._id_obj))).scalar_one()
+        return self._sampler.random_line_id(word_filter)
 
-        random_line_id = randrange(row_count) + 1
+    def _get_random_line_id_with_tokens(self, tokens, word_filter=None, no_of_candidates=1000):
+        """Select a random id (line_id) from the candidates following a random line ID (cyclically)
+            which contain the tokens and their word matches the filter
+        """
+
+        start_id = self._get_random_line_id()
+        candidates = self._search_store.lines_with_tokens(tokens, no_of_candidates, start_id)
+        if len(candidates) < no_of_candidates:
+            candidates.extend(line for line in self._search_store.lines_with_tokens(tokens, no_of_candidates)
+                              if line[0] < start_id)
+        candidate_ids = [line_id for line_id, _, word, _, freq in candidates
+                         if word_filter is None or word_matches(word_filter, word, freq)]
+        if len(candidate_ids) == 0:
+            raise NoResultFound(f'No lines contain the tokens {tokens} with the filter: {word_filter} !')
 
-        return random_line_id
+        return choice(candidate_ids)
 
     def select_random_word(self):
         """Select one random word from all available lines
@@ -129,10 +1166,7 @@ class ContextBank:
             Raises sqlalchemy.exc.MultipleResultsFound if multiple rows are returned
         """
 
-        with self._engine.connect() as conn:
-            word, freq = conn.execute(select(self._word_obj, self._freq).where(self._id_obj == one_line_id)).one()
-
-        return word, freq
+        return self._store.word_and_freq(one_line_id)
 
     @staticmethod
     def _identity(word):
@@ -140,4 +1174,172 @@ class ContextBank:
 
     def _hide_word(self, word: str):
         """Hide word with required amount of self._hide_char characters to maintain the length"""
-        return self._hide_char * len(word)
+        word_len = len(word)
+        hidden_form = self._hidden_forms.get(word_len)
+        if hidden_form is None:
+            hidden_form = self._hide_char * word_len
+            self._hidden_forms[word_len] = hidden_form
+        return hidden_form
+
+
+class VersionedContextBank:
+    def __init__(self, manifest_filename: str, create_context_bank, reload_interval: float = 10,
+                 keep_versions: int = 2):
+        """
+        The ContextBanks of the versions of the database listed in the manifest (see read_manifest())
+
+        The manifest is checked every reload_interval seconds by a background thread (started in each process on
+         the first checkout(), e.g. after gunicorn forks the workers). When its current version changes the ContextBank
+         of the new version is created (and warmed up) by the thread and swapped in at once, so the new games use it
+         without restarting the workers. A failed reload keeps the previous version until the manifest changes again.
+        The games in progress keep reading their lines from the version they started on (the version is in their
+         state token, see checkout()). The ContextBanks of the older versions are created on demand and only
+         the keep_versions most recently used ones are kept (including the current one, which is never dropped,
+         and the one being checked out).
+         The database files of the versions must not be modified (publish a new file as a new version instead).
+
+        :param manifest_filename: The JSON manifest of the versions (see create_database/publish_db_version.py)
+        :param create_context_bank: Function creating the ContextBank from the database file of a version
+        :param reload_interval: The number of seconds between the checks of the manifest (0 for never)
+        :param keep_versions: The maximal number of ContextBanks (versions) kept at once
+        """
+
+        self._manifest_path = Path(manifest_filename).resolve()
+        self._create_context_bank = create_context_bank
+        self._reload_interval = reload_interval
+        self._keep_versions = keep_versions
+        self._lock = Lock()
+        self._load_lock = Lock()  # One ContextBank is created at a time
+        self._context_banks = {}  # Version -> (database path, ContextBank)
+        self._last_used = {}  # Version -> monotonic time of the last use
+        self._manifest = None  # (current version, version -> database path), swapped at once
+        self._manifest_state = None
+        self._watcher_pid = None
+        self._closed = False
+        self.reload()  # The errors of the first version are raised at startup
+
+    def _get_manifest_state(self):
+        file_stat = stat(self._manifest_path)
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def reload(self):
+        """Read the manifest if it changed and swap in the ContextBank of its current version
+            Returns True if the manifest was read
+        """
+
+        manifest_state = self._get_manifest_state()
+        if manifest_state == self._manifest_state:
+            return False
+        self._manifest_state = manifest_state  # Not retried until the manifest changes again
+
+        current, versions = read_manifest(self._manifest_path)
+        entry = self._load(current, versions)
+        with self._lock:
+            self._context_banks[current] = entry
+            self._last_used[current] = monotonic()
+            self._manifest = (current, versions)
+            self._evict()
+
+        return True
+
+    def _load(self, version, versions):
+        """Return the (database path, ContextBank) of the version (created if it is not loaded)"""
+
+        with self._load_lock:
+            with self._lock:
+                entry = self._context_banks.get(version)
+            if entry is None:
+                entry = (versions[version], self._create_context_bank(versions[version]))
+
+        return entry
+
+    def _evict(self, checked_out=None):
+        """Drop the ContextBanks of the versions removed from the manifest and of the least recently used versions
+            (called with the lock held), the checked out version is kept as its ContextBank is about to be returned
+        """
+
+        current, versions = self._manifest
+        pinned_versions = {current} if checked_out is None else {current, checked_out}
+        by_last_use = sorted((version for version in self._context_banks
+                              if version not in pinned_versions and version in versions),
+                             key=self._last_used.get, reverse=True)
+        kept_versions = {*pinned_versions, *by_last_use[:max(self._keep_versions - len(pinned_versions), 0)]}
+        for version in list(self._context_banks.keys()):
+            if version not in kept_versions:
+                _, context_bank = self._context_banks.pop(version)
+                del self._last_used[version]
+                kept_paths = {database_path for _, kept_context_bank in self._context_banks.values()
+                              for database_path in kept_context_bank.database_paths}
+                for database_path in context_bank.database_paths:
+                    if database_path not in kept_paths:
+                        dispose_engine(database_path)
+
+    def _start_watcher(self):
+        """Start the thread checking the manifest in this process (threads do not survive fork)"""
+
+        if self._reload_interval > 0 and self._watcher_pid != getpid() and not self._closed:
+            with self._lock:
+                if self._watcher_pid != getpid():
+                    self._watcher_pid = getpid()
+                    Thread(target=self._watch, name=f'watch {self._manifest_path.name}', daemon=True).start()
+
+    def _watch(self):
+        while True:
+            sleep(self._reload_interval)
+            if self._closed:
+                return
+            try:
+                if self.reload():
+                    getLogger(__name__).info(f'Database version {self._manifest[0]} of {self._manifest_path} loaded')
+            except Exception:  # E.g. the manifest is being edited
+                getLogger(__name__).exception(f'Reloading {self._manifest_path} failed, keeping the previous version')
+
+    def checkout(self, version: str = None):
+        """Return the version and its ContextBank for the version of a game (None: the current version for new games)
+            Raises KeyError if the version is not in the manifest anymore
+        """
+
+        self._start_watcher()
+        current, versions = self._manifest
+        if version is None:
+            version = current
+        if version not in versions:
+            raise KeyError(f'Unknown version of the database: {version} !')
+
+        with self._lock:
+            entry = self._context_banks.get(version)
+            if entry is not None:
+                self._last_used[version] = monotonic()
+        if entry is None:
+            entry = self._load(version, versions)
+            with self._lock:
+                self._context_banks[version] = entry
+                self._last_used[version] = monotonic()
+                self._evict(version)
+
+        return version, entry[1]
+
+    def close(self):
+        """Stop checking the manifest (e.g. when the corpus is dropped, see CorpusPool), the loaded versions
+            can still be checked out by the requests in progress
+        """
+
+        self._closed = True
+
+    @property
+    def database_paths(self):
+        """The database files read by the ContextBanks of the loaded versions"""
+
+        with self._lock:
+            context_banks = [context_bank for _, context_bank in self._context_banks.values()]
+        return [database_path for context_bank in context_banks for database_path in context_bank.database_paths]
+
+    @property
+    def current_version(self):
+        return self._manifest[0]
+
+    @property
+    def has_fts(self):
+        """The contexts of the current version can be searched by tokens (see ContextBank.search_lines())"""
+
+        return self.checkout()[1].has_fts
@@ -0,0 +1,110 @@
+from time import monotonic
+from threading import Lock
+
+from context_bank import VersionedContextBank, dispose_engine
+
+
+class CorpusPool:
+    def __init__(self, corpus_settings: dict, create_context_bank, default_corpus: str, idle_timeout: float = None,
+                 max_loaded: int = None):
+        """
+        The settings of several corpora served by one app with lazily created ContextBanks
+
+        The ContextBank of a corpus is created on its first request. The ContextBanks of the corpora unused for
+         idle_timeout seconds are dropped and at most max_loaded ContextBanks are kept (the least recently used
+         is dropped first) to bound the memory. The engines of the databases of the dropped ContextBanks are disposed
+         (unless another loaded corpus reads the same database). Requests already holding a dropped ContextBank
+         finish with it (reconnecting to its database).
+
+        :param corpus_settings: Corpus name -> settings (validated config, see main.create_app())
+        :param create_context_bank: Function creating the ContextBank from the settings of a corpus
+        :param default_corpus: The name of the corpus to use if none is selected
+        :param idle_timeout: The number of seconds after the ContextBank of an unused corpus is dropped
+            (None for never)
+        :param max_loaded: The maximal number of ContextBanks kept at once (None for unbounded)
+        """
+
+        if default_corpus not in corpus_settings:
+            raise ValueError(f'The default corpus ({default_corpus}) is not among the corpora!')
+
+        self.default_corpus = default_corpus
+        self._corpus_settings = corpus_settings
+        self._create_context_bank = create_context_bank
+        self._idle_timeout = idle_timeout
+        self._max_loaded = max_loaded
+        self._context_banks = {}  # Corpus name -> ContextBank
+        self._last_used = {}  # Corpus name -> monotonic time of the last use
+        self._next_evict = 0.0  # Monotonic time of the next check of the idle ContextBanks
+        self._lock = Lock()
+        self._load_locks = {corpus_name: Lock() for corpus_name in corpus_settings}  # Load corpora in parallel
+
+    def __contains__(self, corpus_name):
+        return corpus_name in self._corpus_settings
+
+    def names(self):
+        return list(self._corpus_settings.keys())
+
+    def loaded(self):
+        """The names of the corpora with a ContextBank"""
+
+        with self._lock:
+            return list(self._context_banks.keys())
+
+    def get(self, corpus_name):
+        """Return the settings of the corpus with its ContextBank (context_bank key) and create it if needed
+            The loaded ContextBanks are looked up without locking, the locks are taken only to load one
+        """
+
+        now = monotonic()
+        context_bank = self._context_banks.get(corpus_name)  # Atomic
+        if context_bank is not None:
+            self._last_used[corpus_name] = now
+            if self._idle_timeout is not None and now >= self._next_evict:
+                with self._lock:
+                    evicted = self._evict()
+                self._dispose(evicted)
+        else:
+            with self._load_locks[corpus_name]:
+                with self._lock:
+                    context_bank = self._context_banks.get(corpus_name)
+                if context_bank is None:
+                    context_bank = self._create_context_bank(self._corpus_settings[corpus_name])
+
+                with self._lock:
+                    self._context_banks[corpus_name] = context_bank
+                    self._last_used[corpus_name] = monotonic()
+                    evicted = self._evict()
+            self._dispose(evicted)
+
+        # A copy, so eviction does not affect the requests in progress
+        return dict(self._corpus_settings[corpus_name], context_bank=context_bank)
+
+    def _evict(self):
+        """Drop the idle and the least recently used ContextBanks (called with the lock held)
+            Returns the dropped ContextBanks
+        """
+
+        now = monotonic()
+        self._next_evict = now + 1.0  # The idle ones are checked at most once a second on the lock-free path
+        by_last_use = sorted(self._context_banks.keys(), key=self._last_used.get)
+        evicted = []
+        for i, corpus_name in enumerate(by_last_use):
+            if (self._idle_timeout is not None and now - self._last_used[corpus_name] > self._idle_timeout) or \
+                    (self._max_loaded is not None and len(by_last_use) - i > self._max_loaded):
+                evicted.append(self._context_banks.pop(corpus_name))
+        return evicted
+
+    def _dispose(self, evicted):
+        """Dispose the engines of the databases of the dropped ContextBanks which no loaded corpus reads"""
+
+        if len(evicted) == 0:
+            return
+        with self._lock:
+            loaded = list(self._context_banks.values())
+        kept_paths = {database_path for context_bank in loaded for database_path in context_bank.database_paths}
+        for context_bank in evicted:
+            if isinstance(context_bank, VersionedContextBank):
+                context_bank.close()
+            for database_path in context_bank.database_paths:
+                if database_path not in kept_paths:
+                    dispose_engine(database_path)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Ballance the contexts of the words and sample the words in one pass directly into the SQLite database
+ (replaces ballance_freqs.py | random_sampling_filter.py | create_sqldb.py, the database content is the same)
+
+The random draws are the same as of the two scripts with seed(12345) as each of them has its own random generator:
+ random.sample() depends only on the size of the population, so the indices of the selected elements can be drawn
+ when the size is known and the elements can be kept out of the memory until then:
+- The contexts of a word are buffered up to a limit, the rest is spooled into a temporary file
+- The words are selected when the number of words is known: up front (if it is given with -c, e.g. written by
+    count_contexts.py -w as in the Makefile) or at the end. In the latter case the ballanced contexts are staged
+    in a temporary SQLite database
+"""
+
+import sys
+import sqlite3
+from random import Random
+from itertools import groupby
+from tempfile import TemporaryDirectory, TemporaryFile
+from argparse import ArgumentParser, FileType
+
+from create_sqldb import create_db, create_deferred_indexes, create_fts_index, do_insert, gen_rows
+
+SEED = 12345  # As in ballance_freqs.py and random_sampling_filter.py
+
+
+class WordContexts:
+    def __init__(self, max_buffered=100000):
+        """Collect the contexts of one word in the memory up to max_buffered contexts, then in a temporary file"""
+
+        self._max_buffered = max_buffered
+        self._buffer = []
+        self._spool = None
+        self.count = 0
+
+    def append(self, line):
+        if len(self._buffer) == self._max_buffered:
+            if self._spool is None:
+                self._spool = TemporaryFile('w+', encoding='UTF-8')
+            self._spool.writelines(f'{elem}\n' for elem in self._buffer)
+            self._buffer.clear()
+        self._buffer.append(line)
+        self.count += 1
+
+    def select(self, indices):
+        """Return the contexts at the indices (in the order of the indices)"""
+
+        if self._spool is None:
+            return [self._buffer[i] for i in indices]
+
+        wanted = set(indices)
+        selected = {}
+        self._spool.seek(0)
+        for i, line in enumerate(self._spool):
+            if i in wanted:
+                selected[i] = line.rstrip('\n')
+        spooled_count = self.count - len(self._buffer)
+        for i, line in enumerate(self._buffer, start=spooled_count):
+            if i in wanted:
+                selected[i] = line
+
+        return [selected[i] for i in indices]
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+
+
+def ballance(inp_fh, no_of_elements=30, max_buffered=100000):
+    """Yield (word_no, [line, ...]) for each word where the lines are at most no_of_elements randomly selected
+        contexts of the word extended with the number of contexts of the word (as ballance_freqs.py)
+    """
+
+    rng = Random(SEED)
+    lines = (line.rstrip() for line in inp_fh)
+    for word_no, (_, word_lines) in enumerate(groupby(lines, key=lambda line: line.split('\t', maxsplit=1)[0])):
+        word_contexts = WordContexts(max_buffered)
+        for line in word_lines:
+            word_contexts.append(line)
+        freq = word_contexts.count
+        if freq > no_of_elements:
+            indices = rng.sample(range(freq), no_of_elements)  # The same draws as sample(conc_list, ...)
+        else:
+            indices = range(freq)
+        yield word_no, [f'{line}\t{freq}' for line in word_contexts.select(indices)]
+        word_contexts.close()
+
+
+def sample_words(ballanced_words, keep=None, count=None, tmp_dir=None):
+    """Yield the lines of the randomly selected words (as random_sampling_filter.py)"""
+
+    if keep is None:  # No sampling
+        for _, lines in ballanced_words:
+            yield from lines
+    elif count is not None:  # Known number of words: select up front and stream
+        sampled = set(Random(SEED).sample(range(count), keep))
+        for word_no, lines in ballanced_words:
+            if word_no in sampled:
+                yield from lines
+    else:  # Stage the lines until the number of words is known
+        with TemporaryDirectory(dir=tmp_dir) as staging_dir:
+            conn = sqlite3.connect(f'{staging_dir}/staged.db')
+            conn.execute('PRAGMA journal_mode=OFF')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE staged (word_no INTEGER, line TEXT)')
+            count = 0
+            for word_no, lines in ballanced_words:
+                conn.executemany('INSERT INTO staged VALUES (?, ?)', ((word_no, line) for line in lines))
+                count = word_no + 1
+            conn.commit()
+            conn.execute('CREATE INDEX ix_staged_word_no ON staged (word_no)')
+
+            for word_no in sorted(Random(SEED).sample(range(count), keep)):
+                for line, in conn.execute('SELECT line FROM staged WHERE word_no = ? ORDER BY rowid', (word_no,)):
+                    yield line
+            conn.close()
+
+
+def main():
+    parser = ArgumentParser(description='Select random contexts for each word to ballance frequent and rare words,'
+                                        ' use random sampling to limit the number of words to be guessed'
+                                        ' and write the result into an SQLite database')
+    parser.add_argument('-i', '--input', help='Input text file name (omit for STDIN)', required=False,
+                        default=sys.stdin, type=FileType(encoding='UTF-8'))
+    parser.add_argument('-f', '--db-filename', dest='db_filename', required=True,
+                        help='The filename of the SQLite database', metavar='DBNAME.db')
+    parser.add_argument('-n', '--no-of-conts', help='Number of context for each word to keep', required=True, type=int)
+    parser.add_argument('-k', '--keep', help='Count of words to keep after sampling (omit to keep all words)',
+                        required=False, type=int, default=None)
+    parser.add_argument('-c', '--count', help='Count of words in the input (if known, no staging is needed)',
+                        required=False, type=int, default=None)
+    parser.add_argument('-b', '--max-buffered', help='Number of contexts of a word kept in the memory'
+                                                     ' (the rest is spooled to a temporary file)',
+                        type=int, default=100000)
+    parser.add_argument('-T', '--tmp-dir', help='Directory for staging (default: system temp dir)', default=None)
+    parser.add_argument('-l', '--left-size', dest='left_size', type=int, default=None,
+                        help='Store the left contexts truncated to this size (see create_sqldb.py)')
+    parser.add_argument('-r', '--right-size', dest='right_size', type=int, default=None,
+                        help='Store the right contexts truncated to this size (see create_sqldb.py)')
+    parser.add_argument('--fts', dest='fts', action='store_true',
+                        help='Create an FTS5 full-text index over the contexts (see create_sqldb.py)')
+    args = parser.parse_args()
+    if (args.left_size is None) != (args.right_size is None):
+        parser.error('Both or none of --left-size and --right-size must be set!')
+
+    db_engine, sqlite_table = create_db(args.db_filename, args.left_size, args.right_size, fast_load=True)
+    lines = sample_words(ballance(args.input, args.no_of_conts, args.max_buffered), args.keep, args.count,
+                         args.tmp_dir)
+    do_insert(gen_rows(lines, args.left_size, args.right_size), db_engine, sqlite_table)
+    create_deferred_indexes(db_engine, sqlite_table)
+    if args.fts:
+        create_fts_index(db_engine, sqlite_table)
+
+
+if __name__ == '__main__':
+    main()
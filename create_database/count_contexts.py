@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Create word contexts, deduplicate them and filter rare words in parallel
+ (replaces create_and_count_contexts.sh, the output is byte-identical)
+
+1. The input is split into blocks of lines and the contexts are created (see create_word_contexts.py) in parallel.
+    The contexts are written into shards (temporary files) by the hash of the word
+2. The shards are processed in parallel. The contexts of each shard are sorted (as sort with LC_ALL=C.UTF-8),
+    deduplicated on (word, left) then on (word, right) with hashed sets for each word (as uniq_2nd_field.sh and
+    uniq_3rd_field.sh) and the words with less contexts than the limit are dropped (as uniq_c_1st_field.sh)
+3. The sorted shards are merged into the output
+
+NOTE: uniq_c_1st_field.sh prints the first (limit - 1) contexts of each word with a for (i in prev_line) loop,
+ so their order is the iteration order of mawk's hash table. This order is reproduced by mawk_loop_order()
+"""
+
+import os
+import sys
+from io import BytesIO, TextIOWrapper
+from zlib import crc32
+from heapq import merge
+from pathlib import Path
+from functools import partial
+from itertools import groupby
+from string import ascii_lowercase
+from multiprocessing import Pool
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser, FileType
+
+from create_word_contexts import read_non_words, line_contexts
+
+
+def mawk_loop_order(no_of_keys):
+    """The order of the keys 1..no_of_keys in a for (i in arr) loop of mawk 1.3.4 (as in uniq_c_1st_field.sh)
+
+    The integer keys are stored in a hash table of 64 lists (key & 63, new nodes at the front of the list).
+     The loop converts them to strings in the order of that table and puts them into the string hash table
+     (FNV-1a hash & 63, new nodes at the front of the list) which is then iterated list by list.
+     The table is doubled above 768 keys which is not reproduced here.
+    """
+
+    if no_of_keys > 768:
+        raise ValueError('The order of mawk is reproduced only up to 768 keys!')
+
+    int_lists = [[] for _ in range(64)]
+    for key in range(1, no_of_keys + 1):
+        int_lists[key & 63].insert(0, key)
+
+    str_lists = [[] for _ in range(64)]
+    for int_list in int_lists:
+        for key in int_list:
+            fnv1a_hash = 2166136261
+            for char in str(key).encode('ASCII'):
+                fnv1a_hash = ((fnv1a_hash ^ char) * 16777619) & 0xFFFFFFFF
+            str_lists[fnv1a_hash & 63].insert(0, key)
+
+    return [key for str_list in str_lists for key in str_list]
+
+
+def read_blocks(inp_fh, block_size):
+    """Read the binary input in blocks of about block_size bytes that end on a line boundary"""
+
+    remainder = b''
+    while True:
+        block = inp_fh.read(block_size)
+        if len(block) == 0:
+            break
+        block = remainder + block
+        last_newline = block.rfind(b'\n')
+        if last_newline == -1:
+            remainder = block
+            continue
+        remainder = block[last_newline + 1:]
+        yield block[:last_newline + 1]
+    if len(remainder) > 0:
+        yield remainder
+
+
+def create_contexts(block_and_no, tmp_dir, no_of_shards, context_params):
+    """Create contexts for the lines of the block and append them to the shard files by the hash of the word"""
+
+    block, block_no = block_and_no
+    shards = [[] for _ in range(no_of_shards)]
+    seen_contexts = set()  # Duplicate contexts are removed by the deduplication anyway
+
+    # Decode as python3 create_word_contexts.py does from the STDIN: on POSIX sys.stdin splits lines only at '\n'
+    #  (a lone '\r' stays in the line, no universal newlines) and read_blocks() cuts the blocks at '\n' too
+    for line in TextIOWrapper(BytesIO(block), encoding='UTF-8', errors='surrogateescape', newline='\n'):
+        line_stripped = line.rstrip()
+        for word, left, right in line_contexts(line_stripped, *context_params):
+            context = '\t'.join((word, left, right, line_stripped)).encode('UTF-8', errors='surrogateescape')
+            if context not in seen_contexts:
+                seen_contexts.add(context)
+                shards[crc32(word.encode('UTF-8', errors='surrogateescape')) % no_of_shards].append(context)
+
+    for shard_no, shard in enumerate(shards):
+        if len(shard) > 0:
+            with open(Path(tmp_dir) / f'shard{shard_no}_{os.getpid()}_{block_no}', 'wb') as fh:
+                fh.write(b'\n'.join(shard))
+                fh.write(b'\n')
+
+
+def dedup_and_count_shard(shard_no, tmp_dir, min_count):
+    """Sort, deduplicate and filter the contexts of one shard. Return the name of the sorted output file
+        and the number of words kept
+    """
+
+    first_contexts_order = [key - 1 for key in mawk_loop_order(min_count - 1)]
+    contexts = []
+    for fragment in Path(tmp_dir).glob(f'shard{shard_no}_*'):
+        with open(fragment, 'rb') as fh:
+            contexts.extend(fh.read().split(b'\n')[:-1])
+        fragment.unlink()
+    contexts.sort()  # Bytewise as sort with LC_ALL=C.UTF-8
+
+    out_filename = Path(tmp_dir) / f'sorted{shard_no}'
+    no_of_words = 0
+    with open(out_filename, 'wb') as out_fh:
+        for _, word_contexts in groupby(contexts, key=lambda context: context.split(b'\t', 1)[0]):
+            # Keep the first context for each left, then the first context for each remaining right
+            seen_lefts, seen_rights, kept_contexts = set(), set(), []
+            for context in word_contexts:
+                _, left, right, _ = context.split(b'\t', 3)
+                if left not in seen_lefts:
+                    seen_lefts.add(left)
+                    if right not in seen_rights:
+                        seen_rights.add(right)
+                        kept_contexts.append(context)
+            if len(kept_contexts) >= min_count:
+                no_of_words += 1
+                for i in first_contexts_order:
+                    out_fh.write(kept_contexts[i])
+                    out_fh.write(b'\n')
+                for context in kept_contexts[min_count - 1:]:
+                    out_fh.write(context)
+                    out_fh.write(b'\n')
+
+    return out_filename, no_of_words
+
+
+def count_contexts_main(inp_fh=sys.stdin.buffer, out_fh=sys.stdout.buffer, word_min_len=4, word_max_len=15,
+                        left_cont_len=5, right_cont_len=5, min_count=30, extra_letters_to_ascii='',
+                        non_words_filename=None, processes=None, no_of_shards=256, tmp_dir=None,
+                        block_size=16 * 1024 * 1024):
+    """Write the contexts of the words kept (sorted by word) and return the number of the words kept"""
+
+    if not 2 <= min_count <= 769:
+        raise ValueError('min_count must be between 2 and 769 (see mawk_loop_order())!')
+
+    lowercase_letters = set(ascii_lowercase + extra_letters_to_ascii)
+    non_words = read_non_words(non_words_filename)
+    context_params = (lowercase_letters, non_words, word_min_len, word_max_len, left_cont_len, right_cont_len)
+
+    with TemporaryDirectory(dir=tmp_dir) as shards_dir, Pool(processes) as pool:
+        # 1. Create contexts into shards
+        for _ in pool.imap_unordered(partial(create_contexts, tmp_dir=shards_dir, no_of_shards=no_of_shards,
+                                             context_params=context_params),
+                                     ((block, block_no) for block_no, block in
+                                      enumerate(read_blocks(inp_fh, block_size)))):
+            pass
+
+        # 2. Deduplicate and count the shards
+        sorted_filenames, shard_word_counts = zip(*pool.map(partial(dedup_and_count_shard, tmp_dir=shards_dir,
+                                                                    min_count=min_count),
+                                                            range(no_of_shards), chunksize=1))
+
+        # 3. Merge the sorted shards (the words are disjoint, so the merged lines are in sorted order)
+        sorted_fhs = [open(sorted_filename, 'rb') for sorted_filename in sorted_filenames]
+        try:
+            out_fh.writelines(merge(*sorted_fhs))
+        finally:
+            for fh in sorted_fhs:
+                fh.close()
+    out_fh.flush()
+
+    return sum(shard_word_counts)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Create word contexts for sentence per line (SPL) formatted sentences,'
+                                        ' deduplicate them and keep only words with enough contexts')
+    parser.add_argument('-i', '--input', help='Input text file name (omit for STDIN)', required=False,
+                        default=sys.stdin.buffer, type=FileType('rb'))
+    parser.add_argument('-o', '--output', help='Output text file name (omit for STDOUT)', required=False,
+                        default=sys.stdout.buffer, type=FileType('wb'))
+    parser.add_argument('-s', '--word-min-len', help='Minimum (inclusive) word length in characters', required=True,
+                        type=int)
+    parser.add_argument('-m', '--word-max-len', help='Maximum (inclusive) word length in characters', required=True,
+                        type=int)
+    parser.add_argument('-l', '--left-cont-len', help='Length of left context in words', required=True, type=int)
+    parser.add_argument('-r', '--right-cont-len', help='Length of right context in words', required=True, type=int)
+    parser.add_argument('-c', '--min-count', help='Minimum (inclusive) number of contexts for a word to keep it',
+                        required=True, type=int)
+    parser.add_argument('-e', '--extra-letters-to-ascii', help='Extra (accented) lowercase letters'
+                                                               ' to the latin (ASCII) alphabet', required=True)
+    parser.add_argument('-n', '--non-words', help='The filename for the non-words to be filtered (one per line)',
+                        required=True)
+    parser.add_argument('-j', '--processes', help='Number of processes (default: number of CPUs)', type=int,
+                        default=None)
+    parser.add_argument('--shards', help='Number of shards (more shards need less memory, default: 256)', type=int,
+                        default=256)
+    parser.add_argument('-T', '--tmp-dir', help='Directory for the temporary shards (default: system temp dir)',
+                        default=None)
+    parser.add_argument('-w', '--word-count', dest='word_count', default=None, type=FileType('w'),
+                        help='Write the number of words kept into this file (e.g. for ballance_and_sample.py -c)')
+    args = parser.parse_args()
+    no_of_words = count_contexts_main(args.input, args.output, args.word_min_len, args.word_max_len,
+                                      args.left_cont_len, args.right_cont_len, args.min_count,
+                                      args.extra_letters_to_ascii, args.non_words, args.processes, args.shards,
+                                      args.tmp_dir)
+    if args.word_count is not None:
+        print(no_of_words, file=args.word_count)
+        args.word_count.close()
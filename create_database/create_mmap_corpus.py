@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Export an SQLite lines database (see create_sqldb.py) into a read-only binary corpus file
+ which the game memory-maps instead of querying SQLite (db_config: backend: mmap, see MmapLineStore in context_bank.py)
+
+The file consists of a header and sections (little-endian, each section starts at a multiple of 8 bytes).
+ Lines are ordered by word (then rank if the table has a rank column, see rank_contexts.py) and line ID,
+ the position of a line in this order indexes the line arrays.
+
+Header (HEADER_FORMAT): magic, version, flags (1: ranked, 2: truncated contexts), number of lines,
+ number of words, number of line IDs (maximal line ID + 1), left_size and right_size of the truncated contexts,
+ then the byte offset of each section in SECTIONS order:
+- line_ids (int64, lines): position -> line ID
+- line_freqs (int64, lines): position -> freq
+- context_offsets (uint64, 2 * lines + 1): the left and right contexts of the line at position i are
+    contexts[context_offsets[2 * i]:context_offsets[2 * i + 1]] and
+    contexts[context_offsets[2 * i + 1]:context_offsets[2 * i + 2]]
+- word_starts (uint64, words + 1): word offset -> first position of the word (the last element is the number of lines)
+- word_offsets (uint64, words + 1): word offset -> the word in words (as context_offsets)
+- word_freqs (int64, words): word offset -> freq
+- word_cum_freqs (float64, words): word offset -> cumulative freq of the words up to and including this word
+- id_to_pos (int64, line IDs): line ID -> position (-1 for missing IDs)
+- id_to_word (int64, line IDs): line ID -> word offset (-1 for missing IDs)
+- words (UTF-8): the words in sorted order
+- contexts (UTF-8): the contexts
+"""
+
+import sys
+import struct
+from array import array
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from argparse import ArgumentParser
+
+from sqlalchemy import create_engine, select, inspect, Table, MetaData
+
+from create_sqldb import truncate_context
+
+MAGIC = b'WGGCORP\0'
+VERSION = 1
+FLAG_RANKED = 1
+FLAG_TRUNCATED = 2
+SECTIONS = ('line_ids', 'line_freqs', 'context_offsets', 'word_starts', 'word_offsets', 'word_freqs',
+            'word_cum_freqs', 'id_to_pos', 'id_to_word', 'words', 'contexts')
+HEADER_FORMAT = f'<8sIIQQQii{len(SECTIONS)}Q'
+
+
+def read_lines(db_filename, table_name='lines', left_size=None, right_size=None):
+    """Yield (line_id, left, word, right, freq) ordered by word, rank (if present) and line ID
+        and return the (left_size, right_size) of the contexts if they are truncated (else None)
+    """
+
+    engine = create_engine(f'sqlite:///{db_filename}')
+    sqlite_table = Table(table_name, MetaData(), autoload_with=engine)
+    truncated_sizes = None
+    left_col, right_col = sqlite_table.c.left, sqlite_table.c.right
+    if 'left_trunc' in sqlite_table.c and inspect(engine).has_table('meta') and left_size is None:
+        meta_table = Table('meta', MetaData(), autoload_with=engine)
+        with engine.connect() as conn:
+            meta = dict(conn.execute(select(meta_table.c.key, meta_table.c.value)).all())
+        truncated_sizes = (int(meta['left_size']), int(meta['right_size']))
+        left_col, right_col = sqlite_table.c.left_trunc, sqlite_table.c.right_trunc
+    elif left_size is not None:
+        truncated_sizes = (left_size, right_size)
+
+    order = [sqlite_table.c.word, sqlite_table.c.id]
+    if 'rank' in sqlite_table.c:
+        order.insert(1, sqlite_table.c.rank)
+
+    def gen_lines():
+        with engine.connect() as conn:
+            for line_id, left, word, right, freq in \
+                    conn.execute(select(sqlite_table.c.id, left_col, sqlite_table.c.word, right_col,
+                                        sqlite_table.c.freq).order_by(*order)):
+                if left_size is not None:
+                    left, right = truncate_context(left, right, left_size, right_size)
+                yield line_id, left, word, right, freq
+
+    return gen_lines(), truncated_sizes, 'rank' in sqlite_table.c
+
+
+def write_corpus(lines, out_filename, truncated_sizes=None, ranked=False):
+    """Write the (line_id, left, word, right, freq) lines ordered by word into the binary corpus file"""
+
+    line_ids, line_freqs, context_offsets = array('q'), array('q'), array('Q', [0])
+    word_starts, word_offsets, word_freqs, word_cum_freqs = array('Q'), array('Q', [0]), array('q'), array('d')
+    words = bytearray()
+    prev_word, total_freq = None, 0.0
+    with TemporaryFile() as contexts_fh:
+        contexts_len = 0
+        for line_id, left, word, right, freq in lines:
+            if word != prev_word:
+                word_starts.append(len(line_ids))
+                words.extend(word.encode('UTF-8'))
+                word_offsets.append(len(words))
+                word_freqs.append(freq)
+                total_freq += freq
+                word_cum_freqs.append(total_freq)
+                prev_word = word
+            line_ids.append(line_id)
+            line_freqs.append(freq)
+            for context in (left, right):
+                context_bytes = context.encode('UTF-8')
+                contexts_fh.write(context_bytes)
+                contexts_len += len(context_bytes)
+                context_offsets.append(contexts_len)
+        word_starts.append(len(line_ids))
+
+        n_ids = max(line_ids, default=-1) + 1
+        id_to_pos, id_to_word = array('q', [-1]) * n_ids, array('q', [-1]) * n_ids
+        for word_offset in range(len(word_freqs)):
+            for pos in range(word_starts[word_offset], word_starts[word_offset + 1]):
+                id_to_pos[line_ids[pos]] = pos
+                id_to_word[line_ids[pos]] = word_offset
+
+        sections = [line_ids, line_freqs, context_offsets, word_starts, word_offsets, word_freqs, word_cum_freqs,
+                    id_to_pos, id_to_word, words]
+        if sys.byteorder == 'big':
+            for section in sections[:-1]:
+                section.byteswap()
+
+        # Compute the offsets of the sections (aligned to 8 bytes)
+        offsets = []
+        offset = struct.calcsize(HEADER_FORMAT)
+        for size in [len(section) * getattr(section, 'itemsize', 1) for section in sections] + [contexts_len]:
+            offset += -offset % 8
+            offsets.append(offset)
+            offset += size
+
+        flags = (FLAG_RANKED if ranked else 0) | (FLAG_TRUNCATED if truncated_sizes is not None else 0)
+        left_size, right_size = truncated_sizes or (-1, -1)
+        with open(out_filename, 'wb') as out_fh:
+            out_fh.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, flags, len(line_ids), len(word_freqs), n_ids,
+                                     left_size, right_size, *offsets))
+            for section, offset in zip(sections, offsets):
+                out_fh.write(b'\0' * (offset - out_fh.tell()))
+                out_fh.write(section)
+            out_fh.write(b'\0' * (offsets[-1] - out_fh.tell()))
+            contexts_fh.seek(0)
+            copyfileobj(contexts_fh, out_fh)
+
+    return len(line_ids), len(word_freqs)
+
+
+def main():
+    parser = ArgumentParser(description='Export the SQLite lines database into a memory-mappable binary corpus file')
+    parser.add_argument('-f', '--db-filename', dest='db_filename', required=True,
+                        help='The filename of the SQLite database', metavar='DBNAME.db')
+    parser.add_argument('-o', '--output', required=True, help='The filename of the binary corpus',
+                        metavar='DBNAME.corpus')
+    parser.add_argument('-t', '--table-name', dest='table_name', default='lines',
+                        help='The name of the lines table (default: lines)')
+    parser.add_argument('-l', '--left-size', dest='left_size', type=int, default=None,
+                        help='Store the left contexts truncated to this size (left_size in config.yaml)')
+    parser.add_argument('-r', '--right-size', dest='right_size', type=int, default=None,
+                        help='Store the right contexts truncated to this size (right_size in config.yaml)')
+    args = parser.parse_args()
+    if (args.left_size is None) != (args.right_size is None):
+        parser.error('Both or none of --left-size and --right-size must be set!')
+
+    lines, truncated_sizes, ranked = read_lines(args.db_filename, args.table_name, args.left_size, args.right_size)
+    no_of_lines, no_of_words = write_corpus(lines, args.output, truncated_sizes, ranked)
+    print(f'{no_of_lines} lines of {no_of_words} words written to {args.output}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,28 +2,77 @@
 # -*- coding: utf-8, vim: expandtab:ts=4 -*-
 
 import sys
+from pathlib import Path
+from time import perf_counter
+from functools import partial
 from itertools import chain, islice
+from multiprocessing import Pool
+from tempfile import TemporaryDirectory
 from argparse import ArgumentParser
 
-from sqlalchemy import Column, Integer, String, MetaData, Table, create_engine
+from sqlalchemy import Column, Integer, String, MetaData, Table, Index, create_engine, event, text
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-def create_db(db_fn):
+from context_bank import word_shard, sharded_line_id  # noqa: E402
+from cold_sentences import sent_tables, SentenceBlockWriter  # noqa: E402
+
+
+def set_fast_load_pragmas(dbapi_connection, _, cache_size_mb=1024):
+    # No rollback journal and no fsync: a crashed load must be restarted from scratch anyway
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=OFF')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.execute('PRAGMA locking_mode=EXCLUSIVE')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute(f'PRAGMA cache_size=-{cache_size_mb * 1024}')  # Negative value is in KiB
+    cursor.close()
+
+
+def create_db(db_fn, left_size=None, right_size=None, fast_load=False, cache_size_mb=1024, meta=None):
     engine = create_engine(f'sqlite:///{db_fn}')
+    if fast_load:
+        event.listen(engine, 'connect', lambda dbapi_conn, conn_record:
+                     set_fast_load_pragmas(dbapi_conn, conn_record, cache_size_mb))
     metadata = MetaData()
 
-    sqlite_table = Table('lines', metadata,
-                         Column('id', Integer, primary_key=True),
-                         Column('left', String),
-                         Column('word', String, index=True),
-                         Column('right', String),
-                         Column('freq', Integer),
-                         Column('sent', String))
+    columns = [Column('id', Integer, primary_key=True),
+               Column('left', String),
+               Column('word', String, index=not fast_load),  # Deferred until the end of the load (see below)
+               Column('right', String),
+               Column('freq', Integer)]  # The sentences are in the cold storage (see cold_sentences.py)
+    meta = dict(meta or {})
+    if left_size is not None and right_size is not None:
+        # Contexts truncated to the sizes used by the game (contextbank_config in config.yaml)
+        columns.extend([Column('left_trunc', String), Column('right_trunc', String)])
+        meta.update(left_size=left_size, right_size=right_size)
+    if len(meta) > 0:
+        meta_table = Table('meta', metadata,
+                           Column('key', String, primary_key=True),
+                           Column('value', String))
+    sqlite_table = Table('lines', metadata, *columns)
+    sent_tables(metadata)
     metadata.create_all(engine)
 
+    if len(meta) > 0:
+        with engine.begin() as conn:
+            conn.execute(meta_table.insert(), [{'key': key, 'value': str(value)} for key, value in meta.items()])
+
     return engine, sqlite_table
 
 
+def truncate_context(left, right, left_size, right_size):
+    """Truncate contexts as ContextBank does (negative size means the full context)"""
+
+    left_split = left.split(' ')
+    right_split = right.split(' ')
+    if left_size >= 0:
+        left = ' '.join(left_split[max(len(left_split) - left_size, 0):])
+    if right_size >= 0:
+        right = ' '.join(right_split[:min(right_size, len(right_split))])
+    return left, right
+
+
 def chunked_iterator(iterable, chunksize):
     # Original source:
     # https://stackoverflow.com/questions/8991506/iterate-an-iterator-by-chunks-of-n-in-python/29524877#29524877
@@ -35,35 +84,156 @@ def chunked_iterator(iterable, chunksize):
         return
 
 
-def do_insert(row_gen, engine, sqlite_table, chunksize=100000):
-    with engine.connect() as conn:
-        for i, batch in enumerate(chunked_iterator(row_gen, chunksize), start=1):
-            with conn.begin():
-                for table_vals in batch:
-                    conn.execute(sqlite_table.insert(), table_vals)
-            print(i * chunksize, flush=True)
+def create_deferred_indexes(engine, sqlite_table):
+    # Same name as with Column(..., index=True)
+    Index(f'ix_{sqlite_table.name}_word', sqlite_table.c.word).create(engine)
+
+
+def create_fts_index(engine, sqlite_table):
+    """Create an FTS5 full-text index (TABLE_NAME_fts) over the contexts (the truncated ones if present)
+        It is an external content table: the contexts are not stored twice, only the index
+    """
 
+    if 'left_trunc' in sqlite_table.c:
+        columns = 'left_trunc, right_trunc'
+    else:
+        columns = '"left", "right"'
+    fts_name = f'{sqlite_table.name}_fts'
+    with engine.begin() as conn:
+        # Keep the accents (e.g. Hungarian a and á are different letters)
+        conn.execute(text(f'CREATE VIRTUAL TABLE "{fts_name}" USING fts5({columns}, content="{sqlite_table.name}",'
+                          f' content_rowid="id", tokenize="unicode61 remove_diacritics 0")'))
+        conn.execute(text(f'INSERT INTO "{fts_name}"("{fts_name}") VALUES (\'rebuild\')'))
 
-def gen_rows(inp_fh=sys.stdin):
-    for line in inp_fh:
+
+def do_insert(row_gen, engine, sqlite_table, chunksize=100000, log_prefix=''):
+    """Insert the rows into the table and their sentences (the 'sent' key) into the cold storage
+        The rows without ID get consecutive IDs from 1 as SQLite would assign them in the new table
+    """
+
+    start_time = perf_counter()
+    rows = 0
+    with engine.connect() as conn:
+        sent_writer = SentenceBlockWriter(conn)
+        for batch in chunked_iterator(row_gen, chunksize):
+            batch = list(batch)
+            with conn.begin():
+                for row_no, row in enumerate(batch, start=rows + 1):
+                    sent_writer.add(row.setdefault('id', row_no), row.pop('sent'))
+                conn.execute(sqlite_table.insert(), batch)  # executemany
+            rows += len(batch)
+            elapsed = perf_counter() - start_time
+            print(f'{log_prefix}{rows} rows in {elapsed:.1f} s ({rows / elapsed:.0f} rows/s)', flush=True)
+        with conn.begin():
+            sent_writer.flush()
+        print(f'{log_prefix}{sent_writer.compressed_size} bytes of compressed sentences in {sent_writer.no_of_blocks}'
+              f' blocks', flush=True)
+
+
+def gen_rows(inp_fh=sys.stdin, left_size=None, right_size=None, shard=None, no_of_shards=None):
+    """Yield the rows of the TSV lines (the IDs of the lines of a shard are set by sharded_line_id())"""
+
+    for local_id, line in enumerate(inp_fh, start=1):
         line = line.rstrip()
         word, left, right, sent, freq = line.split('\t', maxsplit=4)
-        yield {'left': left, 'word': word, 'right': right, 'freq': int(freq), 'sent': sent}
+        row = {'left': left, 'word': word, 'right': right, 'freq': int(freq), 'sent': sent}
+        if shard is not None:
+            row['id'] = sharded_line_id(local_id, shard, no_of_shards)
+        if left_size is not None and right_size is not None:
+            row['left_trunc'], row['right_trunc'] = truncate_context(left, right, left_size, right_size)
+        yield row
+
+
+def create_indexes(db_engine, table_name, opts, log_prefix=''):
+    if opts['fast_load']:
+        start_time = perf_counter()
+        create_deferred_indexes(db_engine, table_name)
+        print(f'{log_prefix}Index created in {perf_counter() - start_time:.1f} s', flush=True)
+    if opts['fts']:
+        start_time = perf_counter()
+        create_fts_index(db_engine, table_name)
+        print(f'{log_prefix}Full-text index created in {perf_counter() - start_time:.1f} s', flush=True)
+
+
+def split_into_shards(inp_fh, tmp_dir, no_of_shards):
+    """Write the TSV lines into one file for each shard by the hash of the word (see word_shard())
+        keeping their order. Returns the filenames
+    """
+
+    shard_filenames = [Path(tmp_dir) / f'shard{shard}.tsv' for shard in range(no_of_shards)]
+    shard_fhs = [open(shard_filename, 'w', encoding='UTF-8') for shard_filename in shard_filenames]
+    try:
+        for line in inp_fh:
+            shard_fhs[word_shard(line.split('\t', maxsplit=1)[0], no_of_shards)].write(line)
+    finally:
+        for fh in shard_fhs:
+            fh.close()
+
+    return shard_filenames
+
+
+def create_shard(shard_and_filename, db_filename_pattern, no_of_shards, opts):
+    """Create the database of one shard from its TSV file"""
+
+    shard, shard_filename = shard_and_filename
+    db_engine, table_name = create_db(db_filename_pattern.format(shard=shard), opts['left_size'], opts['right_size'],
+                                      opts['fast_load'], opts['cache_size_mb'],
+                                      meta={'shard': shard, 'shards': no_of_shards})
+    with open(shard_filename, encoding='UTF-8') as inp_fh:
+        do_insert(gen_rows(inp_fh, opts['left_size'], opts['right_size'], shard, no_of_shards), db_engine, table_name,
+                  opts['chunksize'], f'Shard {shard}: ')
+    create_indexes(db_engine, table_name, opts, f'Shard {shard}: ')
 
 
 def parse_args():
     parser = ArgumentParser(description='Create SQLite concordance database from TSV file (word, left, right, freq)')
     parser.add_argument('-f', '--db-filename', dest='db_filename', required=True,
-                        help='The filename of the SQLite database', metavar='DBNAME.db')
+                        help='The filename of the SQLite database (the pattern of the filenames with {shard}'
+                             ' if --shards is set, e.g. DBNAME.{shard}.db)', metavar='DBNAME.db')
+    parser.add_argument('-l', '--left-size', dest='left_size', type=int, default=None,
+                        help='Store the left contexts truncated to this size (left_size in config.yaml)')
+    parser.add_argument('-r', '--right-size', dest='right_size', type=int, default=None,
+                        help='Store the right contexts truncated to this size (right_size in config.yaml)')
+    parser.add_argument('--fast-load', dest='fast_load', action='store_true',
+                        help='Load without journal and fsync and create the index on word after the load'
+                             ' (the database is unusable if the load is interrupted)')
+    parser.add_argument('--cache-size', dest='cache_size_mb', type=int, default=1024,
+                        help='The page cache size of SQLite in MB when --fast-load is set (default: 1024)')
+    parser.add_argument('--fts', dest='fts', action='store_true',
+                        help='Create an FTS5 full-text index over the contexts (for searching them by tokens)')
+    parser.add_argument('--chunksize', dest='chunksize', type=int, default=100000,
+                        help='The number of rows inserted in one transaction (default: 100000)')
+    parser.add_argument('--shards', dest='shards', type=int, default=None,
+                        help='Shard the database by the hash of the words into this many files created in parallel'
+                             ' (shards in db_config, the cache size is for each shard)')
+    parser.add_argument('-j', '--processes', dest='processes', type=int, default=None,
+                        help='Number of processes creating the shards (default: number of CPUs)')
+    parser.add_argument('-T', '--tmp-dir', dest='tmp_dir', default=None,
+                        help='Directory for the temporary shards (default: system temp dir)')
     options = vars(parser.parse_args())
+    if (options['left_size'] is None) != (options['right_size'] is None):
+        parser.error('Both or none of --left-size and --right-size must be set!')
+    if options['shards'] is not None and \
+            options['db_filename'].format(shard=0) == options['db_filename'].format(shard=1):
+        parser.error('The database filename must contain {shard} if --shards is set!')
 
     return options
 
 
 def main():
     opts = parse_args()
-    db_engine, table_name = create_db(opts['db_filename'])
-    do_insert(gen_rows(), db_engine, table_name)
+    if opts['shards'] is not None:
+        # The lines are split into shards by word (in input order) and the shards are created in parallel
+        with TemporaryDirectory(dir=opts['tmp_dir']) as shards_dir, Pool(opts['processes']) as pool:
+            shard_filenames = split_into_shards(sys.stdin, shards_dir, opts['shards'])
+            pool.map(partial(create_shard, db_filename_pattern=opts['db_filename'], no_of_shards=opts['shards'],
+                             opts=opts), enumerate(shard_filenames), chunksize=1)
+        return
+
+    db_engine, table_name = create_db(opts['db_filename'], opts['left_size'], opts['right_size'], opts['fast_load'],
+                                      opts['cache_size_mb'])
+    do_insert(gen_rows(sys.stdin, opts['left_size'], opts['right_size']), db_engine, table_name, opts['chunksize'])
+    create_indexes(db_engine, table_name, opts)
 
 
 if __name__ == '__main__':
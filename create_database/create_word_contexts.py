@@ -12,11 +12,7 @@ def n_gram_iter(input_iterator, n):
     return zip(*(islice(it, i, None) for i, it in enumerate(tee(iter(input_iterator), n))))
 
 
-def create_context_main(inp_fh=sys.stdin, out_fh=sys.stdout,
-                        word_min_len=4, word_max_len=15,
-                        left_cont_len=5, right_cont_len=5, extra_letters_to_ascii='', non_words_filename=None):
-    lowercase_letters = set(ascii_lowercase + extra_letters_to_ascii)
-
+def read_non_words(non_words_filename=None):
     non_words = set()
     if non_words_filename is not None:
         if Path(non_words_filename).is_file():
@@ -28,18 +24,37 @@ def create_context_main(inp_fh=sys.stdin, out_fh=sys.stdout,
             print(f'{non_words_filename} is not a file with the taboo words!', file=sys.stderr)
             exit(1)
 
+    return non_words
+
+
+def line_contexts(line_stripped, lowercase_letters, non_words, word_min_len=4, word_max_len=15,
+                  left_cont_len=5, right_cont_len=5):
+    """Yield (word, left, right) for the words to be guessed in the (stripped) line"""
+
     ngram_len = left_cont_len + 1 + right_cont_len
     right_cont_index = left_cont_len + 1
+    line_splitted = line_stripped.split(' ')
+    for entry in n_gram_iter(line_splitted, ngram_len):
+        pre = entry[:left_cont_len]
+        word = entry[left_cont_len]
+        post = entry[right_cont_index:]
+        if word_min_len <= len(word) <= word_max_len and lowercase_letters.issuperset(word) and \
+                word not in non_words:
+            yield word, ' '.join(pre), ' '.join(post)
+
+
+def create_context_main(inp_fh=sys.stdin, out_fh=sys.stdout,
+                        word_min_len=4, word_max_len=15,
+                        left_cont_len=5, right_cont_len=5, extra_letters_to_ascii='', non_words_filename=None):
+    lowercase_letters = set(ascii_lowercase + extra_letters_to_ascii)
+
+    non_words = read_non_words(non_words_filename)
+
     for line in inp_fh:
         line_stripped = line.rstrip()
-        line_splitted = line_stripped.split(' ')
-        for entry in n_gram_iter(line_splitted, ngram_len):
-            pre = entry[:left_cont_len]
-            word = entry[left_cont_len]
-            post = entry[right_cont_index:]
-            if word_min_len <= len(word) <= word_max_len and lowercase_letters.issuperset(word) and \
-                    word not in non_words:
-                print(word, ' '.join(pre), ' '.join(post), line_stripped, sep='\t', file=out_fh)
+        for word, left, right in line_contexts(line_stripped, lowercase_letters, non_words, word_min_len,
+                                               word_max_len, left_cont_len, right_cont_len):
+            print(word, left, right, line_stripped, sep='\t', file=out_fh)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Export word embeddings (word2vec text or binary format) into the memory-mappable files of the local similarity
+ (see EmbeddingSimilarity in local_similarity.py, embeddings and embeddings_vocab in guesser_config):
+- PREFIX.vocab.npy: the words sorted by their UTF-8 encoding (fixed-length bytes)
+- PREFIX.vectors.npy: the L2-normalized vectors (float32) in the order of the words
+
+The word2vec files list the most frequent words first, --max-words keeps only the first ones.
+"""
+
+import sys
+import gzip
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+def read_word2vec(filename, binary=False, max_words=None, max_word_bytes=64):
+    """Return the words (UTF-8 encoded) and the vectors of the first max_words words
+        (the words longer than max_word_bytes are skipped)
+    """
+
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as fh:
+        no_of_words, dim = map(int, fh.readline().split())
+        if max_words is not None:
+            no_of_words = min(no_of_words, max_words)
+        words, vectors = [], np.empty((no_of_words, dim), dtype=np.float32)
+        for _ in range(no_of_words):
+            if binary:
+                word = bytearray()
+                while True:
+                    char = fh.read(1)
+                    if char == b' ' or char == b'':
+                        break
+                    if char != b'\n':  # Some writers put a newline after each vector
+                        word.extend(char)
+                vector = np.frombuffer(fh.read(4 * dim), dtype='<f4')
+            else:
+                word, *values = fh.readline().rstrip(b'\n').split(b' ')
+                vector = np.array(values[:dim], dtype=np.float32)
+            if len(word) <= max_word_bytes:
+                vectors[len(words)] = vector
+                words.append(bytes(word))
+
+    return words, vectors[:len(words)]
+
+
+def export_embeddings(words, vectors, out_prefix):
+    """Sort the words, normalize the vectors and write them into PREFIX.vocab.npy and PREFIX.vectors.npy"""
+
+    words = np.array(words, dtype=f'S{max(map(len, words))}')
+    order = np.argsort(words, kind='stable')
+    words, vectors = words[order], vectors[order]
+    if len(words) > 1 and np.any(words[1:] == words[:-1]):
+        # Keep the first (the most frequent) occurrence of the duplicate words
+        first = np.sort(np.unique(words, return_index=True)[1])
+        words, vectors = words[first], vectors[first]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms > 0, norms, 1)
+
+    np.save(f'{out_prefix}.vocab.npy', words)
+    np.save(f'{out_prefix}.vectors.npy', vectors)
+    return vectors.shape
+
+
+def main():
+    parser = ArgumentParser(description='Export word2vec embeddings into memory-mappable files for the local'
+                                        ' similarity of the game')
+    parser.add_argument('-i', '--input', required=True, help='The word2vec file (optionally gzipped)',
+                        metavar='MODEL.txt')
+    parser.add_argument('-b', '--binary', action='store_true', help='The word2vec file is in the binary format')
+    parser.add_argument('-o', '--output-prefix', dest='output_prefix', required=True,
+                        help='The prefix of the output files (PREFIX.vocab.npy and PREFIX.vectors.npy)',
+                        metavar='PREFIX')
+    parser.add_argument('-n', '--max-words', dest='max_words', type=int, default=200000,
+                        help='The number of words to keep (the first ones in the file, default: 200000)')
+    parser.add_argument('-m', '--max-word-bytes', dest='max_word_bytes', type=int, default=64,
+                        help='Skip the words longer than this many bytes in UTF-8 (default: 64)')
+    args = parser.parse_args()
+
+    words, vectors = read_word2vec(args.input, args.binary, args.max_words, args.max_word_bytes)
+    (no_of_words, dim) = export_embeddings(words, vectors, args.output_prefix)
+    print(f'{no_of_words} words with {dim} dimensional vectors written to {args.output_prefix}.vocab.npy and'
+          f' {args.output_prefix}.vectors.npy', file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
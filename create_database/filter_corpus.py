@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Filter, deduplicate and sort the sentences of the corpus in one pass per line and in parallel
+ (replaces filter_corpus_hun.sh and filter_corpus_pl.sh, the output is byte-identical)
+
+1. The input is split into blocks of lines which are filtered in parallel: the whitespace is normalized (as awk),
+    the length bounds are checked and the patterns of all other rules (see language_rules()) are searched at once.
+    The kept lines are written into shards (temporary files) by their hash
+2. The shards are deduplicated with hashed sets and sorted (as sort -u with LC_ALL=C.UTF-8) in parallel
+3. The sorted shards are merged into the output (the shards are disjoint, so the merged lines are unique)
+
+NOTE: The regular expressions of the rules are the same as the ones of the grep commands. As they do not contain
+ backreferences, a line is matched by Python's re exactly when it is matched by grep.
+ Invalid UTF-8 and NUL bytes are not handled as grep does (it treats such input as binary),
+ the corpora do not contain them.
+"""
+
+import os
+import re
+import sys
+from zlib import crc32
+from heapq import merge
+from pathlib import Path
+from functools import partial, lru_cache
+from multiprocessing import Pool
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser, FileType
+
+from count_contexts import read_blocks
+
+# The extra (accented) uppercase and lowercase letters of the languages
+LANGUAGES = {'hun': ('ÍŰÁÉÚŐÓÜÖ', 'íűáéúőóüö'),
+             'pl': ('ĄĆĘŁŃÓŚŹŻ', 'ąćęłńóśźż'),
+             }
+
+
+def language_rules(extra_upper, extra_lower):
+    """Return the minimal and maximal number of words, the maximal word length and the patterns of the rejected lines
+        (as in filter_corpus_hun.sh)
+    """
+
+    upper = f'A-Z{extra_upper}'
+    letters = f'a-z{extra_lower}{upper}'
+    reject_patterns = {'proper_names': f'(^| )([{upper}][^ ]* ){{2}}[{upper}][^ ]*',
+                       'shouting': f'(^| )[{upper}]{{4,}}.* [{upper}]{{4,}}( |$)',
+                       'non_words': f'(^| )([^{letters} ]+ ){{2}}[^{letters} ]+( |$)',
+                       'typewriter_style': r'(^| )([^ ] ){2}[^ ]( |$)',
+                       'bad_escaping': r'(\\[^\\]*){3,}',
+                       'replacement_char': '\N{REPLACEMENT CHARACTER}',
+                       'bad_encoding': '[õû]',
+                       'html_escapes': '&[a-z#0-9]{2,8};',
+                       }
+    return 11, 50, 25, reject_patterns
+
+
+@lru_cache(maxsize=None)
+def compiled_rules(language):
+    """Return the length bounds and the patterns of the language compiled into one regular expression"""
+
+    min_words, max_words, max_word_len, reject_patterns = language_rules(*LANGUAGES[language])
+    reject_regex = re.compile('|'.join(f'(?:{pattern})' for pattern in reject_patterns.values()))
+    return min_words, max_words, max_word_len, reject_regex
+
+
+def filter_lines(lines, language):
+    """Yield the normalized lines which are kept by the rules of the language"""
+
+    min_words, max_words, max_word_len, reject_regex = compiled_rules(language)
+    for line in lines:
+        words = [word for word in line.replace('\t', ' ').split(' ') if len(word) > 0]  # As awk '{$1=$1;print $0}'
+        if min_words <= len(words) <= max_words and max(map(len, words)) <= max_word_len:
+            line = ' '.join(words)
+            if reject_regex.search(line) is None:
+                yield line
+
+
+def filter_block(block_and_no, tmp_dir, no_of_shards, language):
+    """Filter the lines of the block and append the kept ones to the shard files by their hash"""
+
+    block, block_no = block_and_no
+    shards = [set() for _ in range(no_of_shards)]
+
+    lines = block.decode('UTF-8', errors='surrogateescape').split('\n')
+    for line in filter_lines(lines, language):
+        line = line.encode('UTF-8', errors='surrogateescape')
+        shards[crc32(line) % no_of_shards].add(line)
+
+    for shard_no, shard in enumerate(shards):
+        if len(shard) > 0:
+            with open(Path(tmp_dir) / f'shard{shard_no}_{os.getpid()}_{block_no}', 'wb') as fh:
+                fh.write(b'\n'.join(shard))
+                fh.write(b'\n')
+
+
+def dedup_and_sort_shard(shard_no, tmp_dir):
+    """Deduplicate and sort the lines of one shard. Return the name of the sorted output file"""
+
+    lines = set()
+    for fragment in Path(tmp_dir).glob(f'shard{shard_no}_*'):
+        with open(fragment, 'rb') as fh:
+            lines.update(fh.read().split(b'\n')[:-1])
+        fragment.unlink()
+
+    out_filename = Path(tmp_dir) / f'sorted{shard_no}'
+    with open(out_filename, 'wb') as out_fh:
+        for line in sorted(lines):  # Bytewise as sort with LC_ALL=C.UTF-8
+            out_fh.write(line)
+            out_fh.write(b'\n')
+
+    return out_filename
+
+
+def filter_corpus_main(inp_fh=sys.stdin.buffer, out_fh=sys.stdout.buffer, language='hun', processes=None,
+                       no_of_shards=256, tmp_dir=None, block_size=16 * 1024 * 1024):
+    if language not in LANGUAGES:
+        raise ValueError(f'Unknown language ({language}), the known ones are: {", ".join(LANGUAGES)}!')
+
+    with TemporaryDirectory(dir=tmp_dir) as shards_dir, Pool(processes) as pool:
+        # 1. Filter the lines into shards
+        for _ in pool.imap_unordered(partial(filter_block, tmp_dir=shards_dir, no_of_shards=no_of_shards,
+                                             language=language),
+                                     ((block, block_no) for block_no, block in
+                                      enumerate(read_blocks(inp_fh, block_size)))):
+            pass
+
+        # 2. Deduplicate and sort the shards
+        sorted_filenames = pool.map(partial(dedup_and_sort_shard, tmp_dir=shards_dir), range(no_of_shards),
+                                    chunksize=1)
+
+        # 3. Merge the sorted shards
+        sorted_fhs = [open(sorted_filename, 'rb') for sorted_filename in sorted_filenames]
+        try:
+            out_fh.writelines(merge(*sorted_fhs))
+        finally:
+            for fh in sorted_fhs:
+                fh.close()
+    out_fh.flush()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Filter the sentence per line (SPL) formatted sentences by their length and'
+                                        ' by the patterns of bad sentences, deduplicate and sort them')
+    parser.add_argument('-i', '--input', help='Input text file name (omit for STDIN)', required=False,
+                        default=sys.stdin.buffer, type=FileType('rb'))
+    parser.add_argument('-o', '--output', help='Output text file name (omit for STDOUT)', required=False,
+                        default=sys.stdout.buffer, type=FileType('wb'))
+    parser.add_argument('-l', '--language', help='The language of the rules (the extra letters)', required=True,
+                        choices=sorted(LANGUAGES))
+    parser.add_argument('-j', '--processes', help='Number of processes (default: number of CPUs)', type=int,
+                        default=None)
+    parser.add_argument('--shards', help='Number of shards (more shards need less memory, default: 256)', type=int,
+                        default=256)
+    parser.add_argument('-T', '--tmp-dir', help='Directory for the temporary shards (default: system temp dir)',
+                        default=None)
+    args = parser.parse_args()
+    filter_corpus_main(args.input, args.output, args.language, args.processes, args.shards, args.tmp_dir)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Move the sentences (the sent column, never read by the game) of a database created by an earlier create_sqldb.py
+ into the compressed cold storage (see cold_sentences.py) in place, so the lines table holds only what the game reads
+
+The sentences are copied in line ID order into blocks compressed with a shared dictionary, the sent column is dropped
+ and the database is vacuumed to reclaim the space. The sentences can be read by ContextBank.sentences() afterwards.
+ Migrate a copy of the database (and publish it as a new version) when the game is running.
+"""
+
+import sys
+from pathlib import Path
+from time import perf_counter
+from argparse import ArgumentParser
+
+from sqlalchemy import create_engine, inspect, select, text, Table, MetaData
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cold_sentences import sent_tables, SentenceBlockWriter, SENT_BLOCKS_TABLE  # noqa: E402
+
+
+def migrate_cold_sent(db_filename, table_name='lines', block_size=64, sample_size=10000, vacuum=True):
+    """Move the sent column of the table into the cold storage. Returns the size of the database before and after"""
+
+    db_path = Path(db_filename).resolve()
+    if not db_path.is_file():  # SQLite would create an empty database
+        raise FileNotFoundError(f'The database ({db_path}) does not exist!')
+    size_before = db_path.stat().st_size
+
+    engine = create_engine(f'sqlite:///{db_path}')
+    inspector = inspect(engine)
+    if inspector.has_table(SENT_BLOCKS_TABLE):
+        raise ValueError(f'The sentences of the database ({db_path}) are already in the cold storage!')
+    sqlite_table = Table(table_name, MetaData(), autoload_with=engine)
+    if 'sent' not in sqlite_table.c:
+        raise ValueError(f'No sent column in the {table_name} table of the database ({db_path}) !')
+
+    start_time = perf_counter()
+    metadata = MetaData()
+    sent_tables(metadata)
+    with engine.begin() as conn:  # One transaction: the database is left unchanged if the migration fails
+        metadata.create_all(conn)
+        sent_writer = SentenceBlockWriter(conn, block_size, sample_size)
+        # Streamed in chunks, only the pending blocks of the writer are kept in the memory
+        for line_id, sent in conn.execute(select(sqlite_table.c.id, sqlite_table.c.sent).order_by(sqlite_table.c.id),
+                                          execution_options={'yield_per': 10000}):
+            sent_writer.add(line_id, sent)
+        sent_writer.flush()
+        conn.execute(text(f'ALTER TABLE "{table_name}" DROP COLUMN sent'))
+    print(f'{sent_writer.compressed_size} bytes of compressed sentences in {sent_writer.no_of_blocks} blocks'
+          f' in {perf_counter() - start_time:.1f} s', file=sys.stderr, flush=True)
+
+    if vacuum:
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text('VACUUM'))
+    engine.dispose()
+
+    return size_before, db_path.stat().st_size
+
+
+def main():
+    parser = ArgumentParser(description='Move the sentences of the database into the compressed cold storage')
+    parser.add_argument('-f', '--db-filename', dest='db_filename', required=True,
+                        help='The filename of the SQLite database (modified in place)', metavar='DBNAME.db')
+    parser.add_argument('-t', '--table-name', dest='table_name', default='lines',
+                        help='The name of the table of the lines (default: lines)')
+    parser.add_argument('--block-size', dest='block_size', type=int, default=64,
+                        help='The number of sentences compressed into one block (default: 64)')
+    parser.add_argument('--sample-size', dest='sample_size', type=int, default=10000,
+                        help='The number of sentences to build the shared dictionary from (default: 10000)')
+    parser.add_argument('--no-vacuum', dest='vacuum', action='store_false',
+                        help='Do not vacuum the database (the freed space is reused but the file does not shrink)')
+    args = parser.parse_args()
+
+    try:
+        size_before, size_after = migrate_cold_sent(args.db_filename, args.table_name, args.block_size,
+                                                    args.sample_size, args.vacuum)
+    except (FileNotFoundError, ValueError) as e:
+        print(e, file=sys.stderr)
+        exit(1)
+    print(f'{args.db_filename}: {size_before} bytes -> {size_after} bytes', file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
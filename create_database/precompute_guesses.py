@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Precompute the guesses of the opponent and the word similarities into side tables (see PrecomputedGuesses in
+ guesser_helper.py) which the game consults before the guesser service (precomputed_db in guesser_config),
+ so the game can be played against the opponent without the guesser service running
+
+For a fixed corpus the guesses of the opponent depend only on the displayed lines and its previous guesses.
+ The games are simulated for each word (the most frequent ones first) starting with each of its lines:
+ the opponent guesses (possibly several times) after each displayed line as in game_logic() in main.py
+ up to --max-lines displayed lines and --max-guesses guesses. The next lines are known in advance only with
+ the rank line order (see rank_contexts.py), otherwise only the guesses for the first line are precomputed.
+ The similarities of the wrong guesses of the opponent and of the most frequent guesses of the players
+ (optional TSV file of word and guess, e.g. extracted from the log) to the word are stored as well.
+"""
+
+import sys
+import sqlite3
+from json import dumps
+from operator import itemgetter
+from pathlib import Path
+from itertools import groupby, islice
+from collections import Counter, defaultdict, deque
+from argparse import ArgumentParser, FileType
+from concurrent.futures import ThreadPoolExecutor
+
+from yaml import safe_load as yaml_load
+from sqlalchemy import create_engine, select, Table, MetaData
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from context_bank import ContextBank, read_manifest  # noqa: E402
+from guesser_helper import GuesserClient, PRECOMPUTED_TABLES, opponent_guess_key  # noqa: E402
+from guesser_helper import raw_word_similarities, guess  # noqa: E402
+
+
+def words_with_line_ids(db_config, max_words=None):
+    """Yield (word, [line_id, ...]) for the words in decreasing frequency order"""
+
+    engine = create_engine(f'sqlite:///{db_config["database_name"]}')
+    sqlite_table = Table(db_config['table_name'], MetaData(), autoload_with=engine)
+    id_col, word_col = sqlite_table.c[db_config['id_name']], sqlite_table.c[db_config['word_name']]
+    query = select(word_col, id_col).order_by(sqlite_table.c[db_config['freq_name']].desc(), word_col, id_col)
+    with engine.connect() as conn:
+        word_lines = groupby(conn.execute(query), key=lambda row: row[0])
+        for word, rows in islice(word_lines, max_words):
+            yield word, [line_id for _, line_id in rows]
+
+
+def simulate_games(context_bank, guesser_settings, word, start_line_id, max_lines=3, max_guesses=3, ranked=False):
+    """Return the {opponent guess key: guesses} of the games starting with the line and the error message"""
+
+    results = {}
+
+    def explore(displayed_lines, prev_guesses):
+        _, lines_to_display = context_bank.read_lines(displayed_lines)
+        guesses, msg = guess(guesser_settings, lines_to_display, word, prev_guesses)
+        if len(msg) > 0:
+            return msg
+        results[opponent_guess_key(displayed_lines, prev_guesses)] = guesses
+
+        other_guess = guesses[0]
+        if other_guess not in {word, '_'} and len(prev_guesses) + 1 < max_guesses:  # Guess again
+            msg = explore(displayed_lines, prev_guesses + [other_guess])
+        if len(msg) == 0 and ranked and len(displayed_lines) < max_lines:  # Show the next line (seed is not used)
+            new_line_id = context_bank.next_line_id(start_line_id, displayed_lines, None)
+            if new_line_id is not None:
+                msg = explore([new_line_id] + displayed_lines, prev_guesses)
+        return msg
+
+    return results, explore([start_line_id], [])
+
+
+def read_player_guesses(guesses_fh, top_k=10):
+    """Read the word and guess TSV and return the {word: [guess, ...]} of the top_k most frequent wrong guesses"""
+
+    guess_counts = defaultdict(Counter)
+    for line in guesses_fh:
+        word, player_guess = line.rstrip('\n').split('\t', maxsplit=1)
+        if player_guess != word:
+            guess_counts[word][player_guess] += 1
+    return {word: [player_guess for player_guess, _ in counts.most_common(top_k)]
+            for word, counts in guess_counts.items()}
+
+
+def bounded_map(executor, fun, iterable, window):
+    """Yield fun(item) for the items in order as Executor.map() does, but with at most window items submitted
+        at once (the items are read as the results are consumed, not all in advance)
+    """
+
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(fun, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while len(futures) > 0:
+        yield futures.popleft().result()
+
+
+def precompute_guesses(config, out_filename, max_words=None, max_lines=3, max_guesses=3, player_guesses=None,
+                       jobs=8):
+    contextbank_config = config['contextbank_config']
+    context_bank = ContextBank(config['db_config'], contextbank_config['left_size'], contextbank_config['right_size'],
+                               contextbank_config['hide_char'], line_order=contextbank_config.get('line_order'))
+    ranked = context_bank.line_order == 'rank'
+    if not ranked and max_lines > 1:
+        print('The lines are not in rank order, only the guesses for the first line are precomputed!',
+              file=sys.stderr, flush=True)
+
+    guesser_settings = {key: value for key, value in config['guesser_config'].items() if key != 'precomputed_db'}
+    guesser_settings['pool_size'] = max(guesser_settings.get('pool_size') or 10, jobs)
+    guesser_settings['client'] = GuesserClient(guesser_settings)
+
+    with sqlite3.connect(out_filename) as conn:
+        for create_table in PRECOMPUTED_TABLES:
+            conn.execute(create_table)
+
+    def process_line(word_and_start_line_id):
+        word, start_line_id = word_and_start_line_id
+        results, msg = simulate_games(context_bank, guesser_settings, word, start_line_id, max_lines, max_guesses,
+                                      ranked)
+        if len(msg) > 0:
+            print(f'Skipping the games of line {start_line_id}: {msg}', file=sys.stderr, flush=True)
+        return word, results
+
+    def process_similarities(word, words2):
+        word_sims, msg = raw_word_similarities(guesser_settings, word, words2)
+        if len(msg) > 0:
+            print(f'Skipping the similarities of {word}: {msg}', file=sys.stderr, flush=True)
+        return word, word_sims
+
+    def write_similarities(conn, future):
+        word, word_sims = future.result()
+        conn.executemany('INSERT OR REPLACE INTO word_similarities VALUES (?, ?, ?, ?)',
+                         [(guesser_settings['similarity'], word, word2, word_sim)
+                          for word2, word_sim in word_sims.items()])
+        return len(word_sims)
+
+    # The games of the lines are simulated in parallel, the similarities after all games of the word are known.
+    #  At most window tasks are queued at once and the results are written as they are done (in word order)
+    window = 4 * jobs
+    tasks = ((word, line_id) for word, line_ids in words_with_line_ids(config['db_config'], max_words)
+             for line_id in line_ids)
+    no_of_words = no_of_guesses = no_of_similarities = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor, sqlite3.connect(out_filename) as conn:
+        similarity_futures = deque()
+        for word, word_results in groupby(bounded_map(executor, process_line, tasks, window), key=itemgetter(0)):
+            wrong_guesses = dict.fromkeys((player_guesses or {}).get(word, ()))
+            for _, results in word_results:
+                conn.executemany('INSERT OR REPLACE INTO opponent_guesses VALUES (?, ?, ?, ?)',
+                                 [(guesser_settings['guesser'], line_ids, prev_guesses,
+                                   dumps(guesses, ensure_ascii=False))
+                                  for (line_ids, prev_guesses), guesses in results.items()])
+                wrong_guesses.update((guesses[0], None) for guesses in results.values()
+                                     if guesses[0] not in {word, '_'})
+                no_of_guesses += len(results)
+            similarity_futures.append(executor.submit(process_similarities, word, list(wrong_guesses)))
+            while len(similarity_futures) > 0 and (similarity_futures[0].done() or len(similarity_futures) > window):
+                no_of_similarities += write_similarities(conn, similarity_futures.popleft())
+            no_of_words += 1
+            if no_of_words % 100 == 0:
+                conn.commit()
+                print(f'{no_of_words} words: {no_of_guesses} guesses', flush=True)
+
+        for future in similarity_futures:
+            no_of_similarities += write_similarities(conn, future)
+
+    print(f'{no_of_guesses} guesses and {no_of_similarities} similarities of {no_of_words} words'
+          f' written to {out_filename}', flush=True)
+
+
+def main():
+    parser = ArgumentParser(description='Precompute the guesses of the opponent and the word similarities'
+                                        ' with the guesser service (or a local stub) into side tables')
+    parser.add_argument('-c', '--config', default=str(REPO_DIR / 'config.yaml'),
+                        help='The config of the game (default: ../config.yaml)', metavar='config.yaml')
+    parser.add_argument('-f', '--db-filename', dest='db_filename', default=None,
+                        help='The filename of the SQLite database (default: database_name in the config)',
+                        metavar='DBNAME.db')
+    parser.add_argument('-o', '--output', default=None,
+                        help='The SQLite file of the side tables (default: the database)', metavar='GUESSES.db')
+    parser.add_argument('-u', '--baseurl', default=None,
+                        help='The URL of the guesser service (default: baseurl in the config)')
+    parser.add_argument('-w', '--max-words', dest='max_words', type=int, default=None,
+                        help='Precompute the games of this many most frequent words (default: all)')
+    parser.add_argument('-l', '--max-lines', dest='max_lines', type=int, default=3,
+                        help='The maximal number of displayed lines in the simulated games (default: 3)')
+    parser.add_argument('-g', '--max-guesses', dest='max_guesses', type=int, default=3,
+                        help='The maximal number of guesses of the opponent in the simulated games (default: 3)')
+    parser.add_argument('-p', '--player-guesses', dest='player_guesses', type=FileType(encoding='UTF-8'),
+                        default=None, help='TSV file of word and the guess of a player (e.g. from the log)')
+    parser.add_argument('-k', '--top-k', dest='top_k', type=int, default=10,
+                        help='The number of the most frequent guesses of the players per word (default: 10)')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='The number of words processed in parallel (default: 8)')
+    args = parser.parse_args()
+
+    with open(args.config, encoding='UTF-8') as fh:
+        config = yaml_load(fh)
+    if (config['db_config'].get('backend', 'sqlite') != 'sqlite' or config['db_config'].get('shards') is not None) \
+            and args.db_filename is None:
+        parser.error('The database must be an SQLite database without shards (use --db-filename)!')
+    if args.db_filename is not None:
+        config['db_config']['database_name'] = args.db_filename
+        config['db_config']['backend'] = 'sqlite'
+    elif config['db_config'].get('database_name') is None:  # The current version of the versioned database
+        current, versions = read_manifest(config['db_config']['manifest'])
+        config['db_config']['database_name'] = str(versions[current])
+    if args.baseurl is not None:
+        config['guesser_config']['baseurl'] = args.baseurl
+    if config['guesser_config'].get('baseurl') is None or config['guesser_config'].get('guesser') is None:
+        parser.error('The guesser service must be configured (baseurl and guesser in guesser_config)!')
+
+    player_guesses = None
+    if args.player_guesses is not None:
+        player_guesses = read_player_guesses(args.player_guesses, args.top_k)
+
+    precompute_guesses(config, args.output or config['db_config']['database_name'], args.max_words, args.max_lines,
+                       args.max_guesses, player_guesses, args.jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Publish a new version of the database (or roll back to an earlier one) in the manifest of the versions
+ (manifest in db_config, see VersionedContextBank in context_bank.py). The running game loads the current version
+ in the background and switches the new games to it, the games in progress keep using their version.
+
+The manifest is a JSON file: {"current": VERSION, "versions": {VERSION: DATABASE_FILE, ...}} with the database files
+ relative to the manifest in the order of publishing. It is replaced atomically. The database files are never
+ modified or deleted, so publish each version as a new file (e.g. webcorpus1_conts.20240501.db).
+"""
+
+import os
+import sys
+import json
+from pathlib import Path
+from datetime import datetime
+from argparse import ArgumentParser
+
+
+def publish_db_version(manifest_filename, version=None, database_filename=None, keep=None):
+    """Add the database as the version and make it current (or make the already published version current)
+        and keep only the keep last published versions in the manifest. Returns the current version
+    """
+
+    manifest_path = Path(manifest_filename)
+    if manifest_path.is_file():
+        with open(manifest_path, encoding='UTF-8') as fh:
+            manifest = json.load(fh)
+    else:
+        manifest = {'current': None, 'versions': {}}
+
+    if database_filename is not None:
+        database_path = Path(database_filename).resolve()
+        if not database_path.is_file():
+            raise FileNotFoundError(f'The database ({database_path}) does not exist!')
+        if version is None:
+            version = datetime.now().strftime('%Y%m%d%H%M%S')
+        if version in manifest['versions']:
+            raise ValueError(f'The version ({version}) is already published, use a new version!')
+        manifest['versions'][version] = os.path.relpath(database_path, manifest_path.resolve().parent)
+    elif version not in manifest['versions']:
+        raise ValueError(f'The version ({version}) is not published in {manifest_filename} !')
+    manifest['current'] = version
+
+    if keep is not None:
+        # The current version is always kept
+        old_versions = [old_version for old_version in manifest['versions'] if old_version != version]
+        for old_version in old_versions[:max(len(old_versions) - keep + 1, 0)]:
+            del manifest['versions'][old_version]
+
+    tmp_path = manifest_path.with_name(f'.{manifest_path.name}.tmp{os.getpid()}')
+    with open(tmp_path, 'w', encoding='UTF-8') as fh:
+        json.dump(manifest, fh, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, manifest_path)  # The game never reads a partially written manifest
+
+    return version
+
+
+def main():
+    parser = ArgumentParser(description='Publish a new version of the database for the running game'
+                                        ' or roll back to an earlier version')
+    parser.add_argument('-m', '--manifest', required=True,
+                        help='The manifest of the versions (manifest in db_config, created if missing)',
+                        metavar='VERSIONS.json')
+    parser.add_argument('-v', '--version', default=None,
+                        help='The version of the database (default: the current time) or the published version to'
+                             ' roll back to (without the database)')
+    parser.add_argument('-k', '--keep', type=int, default=None,
+                        help='Keep only this many most recently published versions (default: all)')
+    parser.add_argument('database', nargs='?', default=None, help='The database file of the new version',
+                        metavar='DBNAME.db')
+    args = parser.parse_args()
+    if args.database is None and args.version is None:
+        parser.error('The database or the version to roll back to must be given!')
+    if args.keep is not None and args.keep < 1:
+        parser.error('At least one version must be kept!')
+
+    version = publish_db_version(args.manifest, args.version, args.database, args.keep)
+    print(f'The current version in {args.manifest} is {version}', file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
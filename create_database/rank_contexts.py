@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Rank the contexts of each word by difficulty and store the rank of each line in the rank column of the database
+ (ContextBank shows the next lines of a word in rank order, see ContextBank.next_line_id())
+
+Scoring methods (the lower score is shown earlier, i.e. the harder contexts come first):
+- tokens: The information content of the displayed context: the sum of -log(relative frequency) of its tokens
+    counted in all sentences of the database. Contexts of frequent function words give few clues.
+- scores: External scores from a TSV file (line ID, score), e.g. the prior confidence of a guesser for the word
+    in the context. Lines missing from the file are shown last.
+
+The ties are broken by the line ID to be reproducible.
+"""
+
+import sys
+from math import log
+from array import array
+from pathlib import Path
+from time import perf_counter
+from itertools import groupby
+from collections import Counter
+from argparse import ArgumentParser, FileType
+
+from sqlalchemy import create_engine, inspect, select, text, bindparam, Table, MetaData, Index
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from create_sqldb import truncate_context, chunked_iterator  # noqa: E402
+from cold_sentences import iter_sentences  # noqa: E402
+
+
+def count_tokens(conn, sqlite_table):
+    """Count the (lowercased) tokens of all sentences (from the sent column of the databases created before
+        the cold storage of the sentences, see cold_sentences.py)
+    """
+
+    if 'sent' in sqlite_table.c:
+        sentences = conn.execute(select(sqlite_table.c.sent)).scalars()
+    else:
+        sentences = (sent for _, sent in iter_sentences(conn))
+    token_freqs = Counter()
+    for sent in sentences:
+        if sent is not None:
+            token_freqs.update(sent.lower().split(' '))
+    return token_freqs
+
+
+def token_scores(conn, sqlite_table, left_size, right_size):
+    """Yield (line_id, word, score) ordered by word where score is the information content of the displayed context
+        (the truncated contexts are used if present, else the contexts are truncated to left_size and right_size)
+    """
+
+    token_freqs = count_tokens(conn, sqlite_table)
+    total = sum(token_freqs.values())
+    neg_log_probs = {token: log(total / freq) for token, freq in token_freqs.items()}
+    max_neg_log_prob = log(total)  # For tokens not in any sentence (not expected)
+
+    if 'left_trunc' in sqlite_table.c:
+        left_col, right_col = sqlite_table.c.left_trunc, sqlite_table.c.right_trunc
+    else:
+        left_col, right_col = sqlite_table.c.left, sqlite_table.c.right
+
+    query = select(sqlite_table.c.id, sqlite_table.c.word, left_col, right_col).order_by(sqlite_table.c.word)
+    for line_id, word, left, right in conn.execute(query):
+        if 'left_trunc' not in sqlite_table.c:
+            left, right = truncate_context(left, right, left_size, right_size)
+        tokens = f'{left} {right}'.lower().split()
+        yield line_id, word, sum(neg_log_probs.get(token, max_neg_log_prob) for token in tokens)
+
+
+def external_scores(conn, sqlite_table, scores_fh):
+    """Yield (line_id, word, score) ordered by word where score is read from the TSV file (line ID, score)"""
+
+    scores = {}
+    for line in scores_fh:
+        line_id, score = line.rstrip().split('\t', maxsplit=1)
+        scores[int(line_id)] = float(score)
+
+    for line_id, word in conn.execute(select(sqlite_table.c.id, sqlite_table.c.word).order_by(sqlite_table.c.word)):
+        yield line_id, word, scores.get(line_id, float('inf'))
+
+
+def ranks(scored_lines):
+    """Return the line IDs and their ranks (the place of the line in its word) in two packed arrays"""
+
+    line_ids, line_ranks = array('q'), array('l')
+    for _, word_lines in groupby(scored_lines, key=lambda scored_line: scored_line[1]):
+        for rank, (_, line_id) in enumerate(sorted((score, line_id) for line_id, _, score in word_lines)):
+            line_ids.append(line_id)
+            line_ranks.append(rank)
+    return line_ids, line_ranks
+
+
+def rank_contexts(db_filename, table_name='lines', method='tokens', scores_fh=None, left_size=5, right_size=5,
+                  chunksize=100000):
+    engine = create_engine(f'sqlite:///{db_filename}')
+    if 'rank' not in {col['name'] for col in inspect(engine).get_columns(table_name)}:
+        with engine.begin() as conn:
+            conn.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN rank INTEGER'))
+    sqlite_table = Table(table_name, MetaData(), autoload_with=engine)
+
+    start_time = perf_counter()
+    with engine.connect() as read_conn:
+        if method == 'tokens':
+            scored_lines = token_scores(read_conn, sqlite_table, left_size, right_size)
+        else:
+            scored_lines = external_scores(read_conn, sqlite_table, scores_fh)
+        # Read all ranks before writing them as the table is not updated while reading it
+        line_ids, line_ranks = ranks(scored_lines)
+    print(f'{len(line_ids)} lines ranked in {perf_counter() - start_time:.1f} s', flush=True)
+
+    update = sqlite_table.update().where(sqlite_table.c.id == bindparam('b_id')).values(rank=bindparam('b_rank'))
+    with engine.connect() as conn:
+        for batch in chunked_iterator(zip(line_ids, line_ranks), chunksize):
+            with conn.begin():
+                conn.execute(update, [{'b_id': line_id, 'b_rank': rank} for line_id, rank in batch])  # executemany
+
+    # The next line of a word is looked up by this index (see SQLiteLineStore.next_ranked_line_id())
+    index = Index(f'ix_{table_name}_word_rank', sqlite_table.c.word, sqlite_table.c.rank)
+    index.create(engine, checkfirst=True)
+    print(f'Ranks stored in {perf_counter() - start_time:.1f} s', flush=True)
+
+
+def main():
+    parser = ArgumentParser(description='Rank the contexts of each word by difficulty (the harder ones first)'
+                                        ' and store the ranks in the database')
+    parser.add_argument('-f', '--db-filename', dest='db_filename', required=True,
+                        help='The filename of the SQLite database', metavar='DBNAME.db')
+    parser.add_argument('-t', '--table-name', dest='table_name', default='lines',
+                        help='The name of the lines table (default: lines)')
+    parser.add_argument('-m', '--method', choices=('tokens', 'scores'), default='tokens',
+                        help='Score the contexts by the frequencies of their tokens or read the scores from a file'
+                             ' (default: tokens)')
+    parser.add_argument('-s', '--scores', type=FileType(encoding='UTF-8'), default=sys.stdin,
+                        help='TSV file of line ID and score (the higher is the easier) for the scores method'
+                             ' (omit for STDIN)')
+    parser.add_argument('-l', '--left-size', dest='left_size', type=int, default=5,
+                        help='The size of the displayed left context (left_size in config.yaml, default: 5)')
+    parser.add_argument('-r', '--right-size', dest='right_size', type=int, default=5,
+                        help='The size of the displayed right context (right_size in config.yaml, default: 5)')
+    args = parser.parse_args()
+
+    rank_contexts(args.db_filename, args.table_name, args.method, args.scores, args.left_size, args.right_size)
+
+
+if __name__ == '__main__':
+    main()
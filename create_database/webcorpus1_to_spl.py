@@ -1,20 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Extract the untokenized sentences (the lines starting with <s>) of the Webcorpus 1.0 archives in SPL format
+
+The archives are processed in parallel, each into a temporary file. The members are read and decoded (latin2)
+ in large blocks and split into lines as codecs.getreader('latin2') does (str.splitlines() also splits on
+ e.g. \\r and \\x85). The temporary files are copied to the output in the order of the archives (as glob() lists
+ them), optionally through a compress program (e.g. pigz -n), so the output is the same as of the sequential version.
+"""
+
+import os
+import sys
+import shlex
 from glob import glob
-from sys import stderr
-from codecs import getreader
+from pathlib import Path
+from functools import partial
+from shutil import copyfileobj
+from subprocess import Popen, PIPE
+from multiprocessing import Pool
+from tempfile import TemporaryDirectory
 from tarfile import open as tarfile_open
+from argparse import ArgumentParser, FileType
+
+
+def member_lines(member_fh, block_size=16 * 1024 * 1024):
+    """Yield the lines of the (latin2 encoded) member read in blocks"""
 
-for filename in glob('orig_webcorpus1/web2-4p-*.tar.gz'):
+    remainder = ''
+    while True:
+        block = member_fh.read(block_size)
+        if len(block) == 0:
+            break
+        # The last line is kept as it may continue in the next block (or be a \r followed by \n)
+        *lines, remainder = (remainder + block.decode('latin2')).splitlines(keepends=True)
+        yield from lines
+    if len(remainder) > 0:
+        yield remainder
+
+
+def extract_archive(filename_and_no, tmp_dir):
+    """Write the sentences of the archive into a temporary file and return its name"""
+
+    filename, archive_no = filename_and_no
     fnames = set()
-    with tarfile_open(filename, 'r:gz', encoding='latin2') as inp_tarfile:
+    out_filename = Path(tmp_dir) / f'archive{archive_no}'
+    with tarfile_open(filename, 'r:gz', encoding='latin2') as inp_tarfile, \
+            open(out_filename, 'w', encoding='UTF-8', newline='') as out_fh:
         for member in inp_tarfile:
             if not member.isfile():
-                print(f'ERROR: Not file {member.name} !', file=stderr)
-                exit(1)
+                raise ValueError(f'ERROR: Not file {member.name} !')
             elif member.name in fnames:
-                print(f'ERROR: Duplicate filename {member.name} !', file=stderr)
-                exit(1)
+                raise ValueError(f'ERROR: Duplicate filename {member.name} !')
             else:
                 fnames.add(member.name)
-            for line in getreader('latin2')(inp_tarfile.extractfile(member)):
-                if line.startswith('<s>'):
-                    print(line[3:], end='')  # Untokenized sentences in SPL format
+            out_fh.writelines(line[3:] for line in member_lines(inp_tarfile.extractfile(member))
+                              if line.startswith('<s>'))  # Untokenized sentences in SPL format
+
+    return out_filename
+
+
+def webcorpus1_to_spl(input_pattern='orig_webcorpus1/web2-4p-*.tar.gz', out_fh=sys.stdout.buffer,
+                      compress_program=None, processes=None, tmp_dir=None):
+    compress_proc = None
+    if compress_program is not None:
+        compress_proc = Popen(shlex.split(compress_program), stdin=PIPE, stdout=out_fh)
+        out_fh = compress_proc.stdin
+
+    try:
+        with TemporaryDirectory(dir=tmp_dir) as archives_dir, Pool(processes) as pool:
+            # The results are in the order of the archives, the later archives are processed meanwhile
+            for archive_filename in pool.imap(partial(extract_archive, tmp_dir=archives_dir),
+                                              ((filename, archive_no) for archive_no, filename in
+                                               enumerate(glob(input_pattern))), chunksize=1):
+                with open(archive_filename, 'rb') as archive_fh:
+                    copyfileobj(archive_fh, out_fh, 16 * 1024 * 1024)
+                os.unlink(archive_filename)
+        out_fh.flush()
+    finally:
+        if compress_proc is not None:
+            compress_proc.stdin.close()
+            if compress_proc.wait() != 0:
+                raise OSError(f'{compress_program} exited with {compress_proc.returncode}!')
+
+
+def main():
+    parser = ArgumentParser(description='Extract the sentences of the Webcorpus 1.0 archives in SPL format')
+    parser.add_argument('-i', '--input', default='orig_webcorpus1/web2-4p-*.tar.gz',
+                        help='The glob pattern of the archives (default: orig_webcorpus1/web2-4p-*.tar.gz)')
+    parser.add_argument('-o', '--output', help='Output file name (omit for STDOUT)', required=False,
+                        default=sys.stdout.buffer, type=FileType('wb'))
+    parser.add_argument('-c', '--compress-program', dest='compress_program', default=None,
+                        help='Compress the output with this command (e.g. "pigz -n", default: no compression)')
+    parser.add_argument('-j', '--processes', help='Number of processes (default: number of CPUs)', type=int,
+                        default=None)
+    parser.add_argument('-T', '--tmp-dir', help='Directory for the temporary files (default: system temp dir)',
+                        default=None)
+    args = parser.parse_args()
+
+    try:
+        webcorpus1_to_spl(args.input, args.output, args.compress_program, args.processes, args.tmp_dir)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
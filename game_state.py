@@ -0,0 +1,54 @@
+from random import getrandbits
+
+from itsdangerous import URLSafeSerializer, BadSignature
+
+
+class GameStateSerializer:
+    def __init__(self, secret_key: str, salt: str = 'game-state'):
+        """
+        Sign and verify the compact game state token carried in the URL instead of the displayed line IDs
+
+        The state is (word_line_id, displayed_line_ids, seed, version) where word_line_id identifies the word to be
+         guessed by one of its lines, displayed_line_ids are the lines shown (newest first), seed fixes the order of
+         the remaining lines (see ContextBank.next_line_id()) and version is the version of the database the IDs
+         belong to (see VersionedContextBank, None if the database is not versioned and then it is left out of
+         the token). The token contains only IDs, never the word itself.
+
+        :param secret_key: The secret key of the app to sign the tokens with
+        :param salt: Namespace for the signature to keep the tokens different from other signed values of the app
+        """
+
+        self._serializer = URLSafeSerializer(secret_key, salt=salt)
+
+    @staticmethod
+    def new_seed():
+        """Generate a random seed for the order of the lines"""
+
+        return getrandbits(32)
+
+    def dumps(self, game_state):
+        """Serialize and sign the game state"""
+
+        word_line_id, displayed_line_ids, seed, version = game_state
+        if version is None:
+            return self._serializer.dumps([word_line_id, list(displayed_line_ids), seed])
+
+        return self._serializer.dumps([word_line_id, list(displayed_line_ids), seed, version])
+
+    def loads(self, token):
+        """Verify and deserialize the game state
+            Returns None if the token is invalid
+        """
+
+        try:
+            word_line_id, displayed_line_ids, seed, *version = self._serializer.loads(token)
+        except (BadSignature, ValueError, TypeError):
+            return None
+
+        if not isinstance(word_line_id, int) or not isinstance(seed, int) or \
+                not isinstance(displayed_line_ids, list) or len(displayed_line_ids) == 0 or \
+                not all(isinstance(line_id, int) for line_id in displayed_line_ids) or \
+                len(version) > 1 or not all(isinstance(version_tag, str) for version_tag in version):
+            return None
+
+        return word_line_id, displayed_line_ids, seed, (version[0] if len(version) > 0 else None)
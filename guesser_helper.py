@@ -1,36 +1,501 @@
+import os
+import sqlite3
+from time import time
+from threading import Lock, Event, local
+from collections import OrderedDict
 from urllib.parse import urlencode
+from json import dumps, loads
 from json.decoder import JSONDecodeError
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, Future
 
-from requests import get as requests_get, post as requests_post
-from requests.exceptions import ConnectionError
 
+class ResultCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 3600, db_filename: str = None, max_db_size: int = None,
+                 cleanup_interval: int = 1000):
+        """
+        Bounded LRU cache with time-to-live (TTL) for the results of the guesser service shared by all threads
 
-def word_similarity(guesser_settings, context_bank, displayed_lines, previous_guesses):
-    new_previous_guesses = []
-    if len(displayed_lines) > 0 and len(previous_guesses) > 0:
-        word, _ = context_bank.identify_word_from_id(displayed_lines[0][0])
-        for prev_guess in previous_guesses:
-            params = {'word1': word, 'word2': prev_guess, 'guesser': guesser_settings['similarity']}
-            word_sim, msg = request_helper(guesser_settings['baseurl'], 'word_similarity', params, 'word_similarity')
+        Optionally backed by an SQLite file, so the worker processes (e.g. gunicorn workers) share their results.
+         Entries are looked up in the memory first, then in the file. Expired entries count as misses.
+         The expired entries are deleted from the file when it is opened and after every cleanup_interval writes
+         (of this process), when the entries expiring first are also deleted above max_db_size entries.
+
+        :param max_size: The maximal number of entries kept in the memory
+        :param ttl: The number of seconds an entry is valid for
+        :param db_filename: The SQLite file to share the entries between processes (None for memory only)
+        :param max_db_size: The maximal number of entries kept in the file (default: 10 * max_size)
+        :param cleanup_interval: The number of writes between two cleanups of the file
+        """
+
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()  # Key -> (expiration time, value) in least recently used first order
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db_filename = db_filename
+        self._max_db_size = max_db_size if max_db_size is not None else 10 * max_size
+        self._cleanup_interval = cleanup_interval
+        self._writes = 0
+        self._local = local()  # sqlite3 connections can not be shared between threads
+        if db_filename is not None:
+            with self._connect() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires)')
+            self._cleanup()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():  # Not shared with the forked workers
+            conn = sqlite3.connect(self._db_filename, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        """Return the cached value for the key or None if it is missing or expired"""
+
+        now = time()
+        with self._lock:
+            expires, value = self._entries.get(key, (0.0, None))
+            if expires > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self._db_filename is not None:
+            with self._connect() as conn:
+                row = conn.execute('SELECT value, expires FROM cache WHERE key = ? AND expires > ?',
+                                   (key, now)).fetchone()
+            if row is not None:
+                value, expires = loads(row[0]), row[1]
+                with self._lock:
+                    self._put_in_memory(key, value, expires)
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store the value (JSON serializable, not None) for the key"""
+
+        expires = time() + self._ttl
+        with self._lock:
+            self._put_in_memory(key, value, expires)
+
+        if self._db_filename is not None:
+            with self._connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, dumps(value), expires))
+            with self._lock:
+                self._writes += 1
+                cleanup = self._writes % self._cleanup_interval == 0
+            if cleanup:
+                self._cleanup()
+
+    def _cleanup(self):
+        """Delete the expired entries from the file and the entries expiring first above max_db_size entries"""
+
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache WHERE expires <= ?', (time(),))
+            conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires LIMIT'
+                         ' max((SELECT count(*) FROM cache) - ?, 0))', (self._max_db_size,))
+
+    def _put_in_memory(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return the hit and miss counters (of this process)"""
+
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+PRECOMPUTED_TABLES = ('CREATE TABLE IF NOT EXISTS opponent_guesses (guesser TEXT, line_ids TEXT, prev_guesses TEXT,'
+                      ' guesses TEXT, PRIMARY KEY (guesser, line_ids, prev_guesses))',
+                      'CREATE TABLE IF NOT EXISTS word_similarities (similarity TEXT, word1 TEXT, word2 TEXT,'
+                      ' word_similarity TEXT, PRIMARY KEY (similarity, word1, word2))')
+
+
+def opponent_guess_key(line_ids, prev_guesses):
+    """The key of the opponent guesses for the displayed lines (in the displayed order) and the previous guesses"""
+
+    return ' '.join(str(line_id) for line_id in line_ids), dumps(list(prev_guesses), ensure_ascii=False)
+
+
+class PrecomputedGuesses:
+    def __init__(self, db_filename: str):
+        """
+        Read-only lookup of the opponent guesses and word similarities precomputed by
+         create_database/precompute_guesses.py (consulted before the guesser service)
+
+        :param db_filename: The SQLite file with the opponent_guesses and word_similarities tables
+        """
+
+        self._db_filename = db_filename
+        self._local = local()  # sqlite3 connections can not be shared between threads
+        self.hits = 0
+        self.misses = 0
+        self._connect()  # Fail early if the file is missing
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():  # Not shared with the forked workers
+            conn = sqlite3.connect(f'file:{self._db_filename}?mode=ro', uri=True, check_same_thread=False)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def guesses(self, guesser, line_ids, prev_guesses):
+        """Return the guesses of the guesser for the displayed lines and its previous guesses or None if missing"""
+
+        row = self._connect().execute('SELECT guesses FROM opponent_guesses WHERE guesser = ? AND line_ids = ? AND'
+                                      ' prev_guesses = ?', (guesser, *opponent_guess_key(line_ids, prev_guesses))
+                                      ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return loads(row[0])
+
+    def similarities(self, similarity, word, words2):
+        """Return the {word2: similarity} of the words found for the word (as returned by the guesser service)"""
+
+        words2 = list(words2)
+        rows = self._connect().execute(f'SELECT word2, word_similarity FROM word_similarities WHERE similarity = ? AND'
+                                       f' word1 = ? AND word2 IN ({", ".join("?" * len(words2))})',
+                                       (similarity, word, *words2)).fetchall()
+        self.hits += len(rows)
+        self.misses += len(set(words2)) - len(rows)
+        return dict(rows)
+
+    def stats(self):
+        """Return the hit and miss counters (of this process)"""
+
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class RequestBatcher:
+    def __init__(self, client, query, out_key, batch_size: int = 16, max_wait: float = 0.005):
+        """
+        Micro-batching of the concurrent requests of one query into {query}_batch requests to the guesser service
+
+        The first request of a batch waits max_wait seconds (or until batch_size requests arrive) for the requests of
+         the other threads, then sends the batch as a JSON POST with the list of the parameters in the requests key
+         and fans out the results (the list in out_key of the response in the order of the requests).
+         Identical requests (same parameters) in flight are coalesced: they share one slot and result.
+
+        :param client: The GuesserClient sending the batches (its request() method)
+        :param query: The query to batch (the batches are sent to {query}_batch)
+        :param out_key: The key of the results in the response
+        :param batch_size: The maximal number of (distinct) requests in a batch
+        :param max_wait: The maximal number of seconds a request waits for the others before sending the batch
+        """
+
+        self._client = client
+        self._query = query
+        self._out_key = out_key
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._lock = Lock()
+        self._batch = None  # The batch open for new requests: ([(params, Future), ...], Event set when full)
+        self._in_flight = {}  # Key of the parameters -> Future of the requests waiting or being sent
+        self.batches = 0
+        self.requests = 0
+        self.coalesced = 0
+
+    def request(self, params):
+        """Send the request in a batch and return (result, error message) as GuesserClient.request()"""
+
+        key = self._client.cache_key(self._query, params)
+        with self._lock:
+            self.requests += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = Future()
+                self._in_flight[key] = future
+                if self._batch is None:
+                    self._batch = ([], Event())
+                batch, full = self._batch
+                batch.append((key, params, future))
+                leader = len(batch) == 1
+                if len(batch) >= self._batch_size:
+                    self._batch = None  # Closed, the next request starts a new batch
+                    full.set()
+
+        if leader:  # Collect the requests of the others and send the batch
+            full.wait(self._max_wait)
+            with self._lock:
+                if self._batch is not None and self._batch[0] is batch:
+                    self._batch = None
+            self._send(batch)
+
+        return future.result()
+
+    def _send(self, batch):
+        results = None
+        msg = 'RuntimeError: batch request failed!'
+        try:
+            params = {'requests': [params for _, params, _ in batch]}
+            results, msg = self._client.request(f'{self._query}_batch', params, self._out_key, post=True)
+            if len(msg) == 0 and (not isinstance(results, list) or len(results) != len(batch)):
+                results, msg = None, 'ValueError: response is not a list or has wrong length!'
+        finally:  # Never leave the waiting requests hanging
+            with self._lock:
+                self.batches += 1
+                for i, (key, _, future) in enumerate(batch):
+                    del self._in_flight[key]
+                    future.set_result((results[i], '') if results is not None else (None, msg))
+
+    def stats(self):
+        """Return the counters of the requests, the batches sent and the coalesced requests (of this process)"""
+
+        return {'requests': self.requests, 'batches': self.batches, 'coalesced': self.coalesced}
+
+
+class GuesserClient:
+    def __init__(self, guesser_settings):
+        """
+        Client for the guesser service with a persistent pooled session and timeouts
+
+        :param guesser_settings: The guesser_config dictionary. Used keys: baseurl, timeout (seconds, default 10),
+            pool_size (parallel connections and requests, default 10), batch_similarity (send all word pairs in one
+            word_similarity_batch call instead of one word_similarity call for each pair, default False),
+            cache_size (maximal number of cached word_similarity and no_of_subwords results, 0 to disable,
+            default 10000), cache_ttl (seconds, default 3600), cache_db (SQLite file to share the cache between the
+            worker processes, default None), cache_db_size (maximal number of entries in cache_db, default
+            10 * cache_size), batch_size (send the concurrent no_of_subwords and guess requests
+            in no_of_subwords_batch and guess_batch requests of at most this many requests, see RequestBatcher,
+            default 1: no batching), max_wait (seconds a request waits for the others to fill a batch, default 0.005)
+        """
+
+        from requests import Session  # Imported only if the guesser service is used
+        from requests.adapters import HTTPAdapter
+
+        self._base_url = guesser_settings['baseurl']
+        self._timeout = guesser_settings.get('timeout') or 10
+        pool_size = guesser_settings.get('pool_size') or 10
+        self.batch_similarity = guesser_settings.get('batch_similarity') or False
+
+        self._session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='guesser')
+
+        cache_size = guesser_settings.get('cache_size')
+        if cache_size is None:
+            cache_size = 10000
+        cache_ttl = guesser_settings.get('cache_ttl')
+        if cache_ttl is None:
+            cache_ttl = 3600
+        if cache_size > 0:
+            self.cache = ResultCache(cache_size, cache_ttl, guesser_settings.get('cache_db'),
+                                     guesser_settings.get('cache_db_size'))
+        else:
+            self.cache = None
+
+        batch_size = guesser_settings.get('batch_size') or 1
+        max_wait = guesser_settings.get('max_wait')
+        if max_wait is None:
+            max_wait = 0.005
+        if batch_size > 1:
+            self.batchers = {query: RequestBatcher(self, query, out_key, batch_size, max_wait)
+                             for query, out_key in (('no_of_subwords', 'no_of_subwords'), ('guess', 'guesses'))}
+        else:
+            self.batchers = {}
+
+    def request(self, query, params, out_key, post=False):
+        return request_helper(self._session, self._base_url, query, params, out_key, self._timeout, post)
+
+    def batched_request(self, query, params, out_key):
+        """Same as request(), but sends the request in a batch with the concurrent ones if batching is enabled"""
+
+        batcher = self.batchers.get(query)
+        if batcher is None:
+            return self.request(query, params, out_key)
+        return batcher.request(params)
+
+    def cache_key(self, query, params):
+        """The key of the cached result for the query with the parameters"""
+
+        return dumps([query, params], sort_keys=True, ensure_ascii=False)
+
+    def cached_request(self, query, params, out_key):
+        """Same as request(), but answers repeated requests from the cache (only successful results are cached)"""
+
+        if self.cache is None:
+            return self.batched_request(query, params, out_key)
+
+        key = self.cache_key(query, params)
+        ret = self.cache.get(key)
+        if ret is not None:
+            return ret, ''
+
+        ret, msg = self.batched_request(query, params, out_key)
+        if len(msg) == 0:
+            self.cache.put(key, ret)
+
+        return ret, msg
+
+    def map_requests(self, requests):
+        """Send (query, params, out_key) requests concurrently and return the results in the same order
+            The requests run in the context of the caller (e.g. to be measured as part of its request, see metrics.py)
+        """
+
+        context = copy_context()
+        return list(self._executor.map(lambda req: context.copy().run(self.request, *req), requests))
+
+
+def request_helper(session, base_url, query, params, out_key, timeout=None, post=False):
+    from requests.exceptions import ConnectionError, Timeout  # Already imported by GuesserClient
+
+    # Use POST if query string is too long (or the parameters are nested)
+    query_str = f'{base_url}/{query}?{urlencode(params, doseq=True)}' if not post else ''
+    try:
+        if not post and len(query_str) < 2048:
+            resp = session.get(query_str, timeout=timeout)
+        else:
+            resp = session.post(f'{base_url}/{query}', json=params, timeout=timeout)
+    except Timeout:
+        # The URL is omitted to hide the word to be guessed
+        return None, f'Timeout: {query} did not respond in {timeout} seconds'
+    except ConnectionError as err:
+        # Try to hide the word to be quessed
+        err_str = str(err).split(':')
+        err_str[2] = '('.join(err_str[2].split('(')[1:])
+        err_str = ':'.join(err_str)
+        return None, f'ConnectionError: {err_str}'
+
+    # Handle errors... Raise exceptions...
+    if resp.status_code > 200:
+        return None, f'Status code: {resp.status_code}'
+
+    try:
+        resp_json = resp.json()
+    except JSONDecodeError as err:
+        return None, f'JSONDecodeError: {err}'
+
+    ret_json = resp_json.get(out_key)
+    if ret_json is None:
+        return None, f'KeyError: {out_key} missing from JSON!'
+
+    return ret_json, ''
+
+
+def opponent_available(guesser_settings):
+    """The opponent can play: the guesser service is configured or its guesses are precomputed"""
+
+    return guesser_settings.get('client') is not None or guesser_settings.get('precomputed') is not None
+
+
+def raw_word_similarities(guesser_settings, word, words2):
+    """Return the {word2: similarity} of the words to the word as returned by the guesser service
+        The similarities are looked up in the precomputed table, in the cache, then the missing ones are requested
+        (without guesser service the missing ones are omitted)
+    """
+
+    client = guesser_settings.get('client')
+    precomputed = guesser_settings.get('precomputed')
+
+    word_sims = {}
+    if precomputed is not None:
+        word_sims.update(precomputed.similarities(guesser_settings['similarity'], word, words2))
+    if client is None:
+        return word_sims, ''
+
+    # Pairs are cached one by one, only the missing ones are requested
+    all_params = {word2: {'word1': word, 'word2': word2, 'guesser': guesser_settings['similarity']}
+                  for word2 in words2 if word2 not in word_sims}
+    if client.cache is not None:
+        for word2, params in all_params.items():
+            word_sim = client.cache.get(client.cache_key('word_similarity', params))
+            if word_sim is not None:
+                word_sims[word2] = word_sim
+    missing_words = [word2 for word2 in all_params.keys() if word2 not in word_sims]
+
+    if len(missing_words) == 0:
+        pass
+    elif client.batch_similarity:
+        params = {'word1': word, 'words2[]': missing_words, 'guesser': guesser_settings['similarity']}
+        new_word_sims, msg = client.request('word_similarity_batch', params, 'word_similarities')
+        if len(msg) == 0 and (not isinstance(new_word_sims, list) or len(new_word_sims) != len(missing_words)):
+            msg = 'ValueError: response is not a list or has wrong length!'
+        if len(msg) > 0:
+            return {}, msg
+        word_sims.update(zip(missing_words, new_word_sims))
+    else:
+        results = client.map_requests([('word_similarity', all_params[word2], 'word_similarity')
+                                       for word2 in missing_words])
+        for _, msg in results:
             if len(msg) > 0:
-                return [], msg
+                return {}, msg
+        word_sims.update((word2, word_sim) for word2, (word_sim, _) in zip(missing_words, results))
+
+    if client.cache is not None:
+        for word2 in missing_words:
+            client.cache.put(client.cache_key('word_similarity', all_params[word2]), word_sims[word2])
+
+    return word_sims, ''
+
+
+def word_similarity(guesser_settings, word, *previous_guesses_lists):
+    """Compute the similarity of all previous guesses (of all players) to the word at once
+        Returns the [(prev_guess, similarity), ...] lists in the order of previous_guesses_lists
+    """
 
+    all_guesses = [prev_guess for previous_guesses in previous_guesses_lists for prev_guess in previous_guesses]
+    if word is None or len(all_guesses) == 0:
+        return dummy_similarity_fun(None, None, *previous_guesses_lists)
+
+    word_sims, msg = raw_word_similarities(guesser_settings, word, dict.fromkeys(all_guesses))
+    if len(msg) > 0:
+        return [], msg
+
+    new_previous_guesses_lists = []
+    for previous_guesses in previous_guesses_lists:
+        new_previous_guesses = []
+        for prev_guess in previous_guesses:
+            word_sim = word_sims.get(prev_guess, '-1.0')  # Missing without guesser service
             if word_sim != '-1.0':  # TODO omit or not omit similarity for unknown words?
                 new_previous_guesses.append((prev_guess, word_sim))
             else:
                 new_previous_guesses.append((prev_guess, ''))
-    
-    return new_previous_guesses, ''
+        new_previous_guesses_lists.append(new_previous_guesses)
 
+    return new_previous_guesses_lists, ''
 
-def dummy_similarity_fun(_=None, __=None, ___=None, previous_guesses=()):
-    return [(prev_guess, '') for prev_guess in previous_guesses], ''
+
+def dummy_similarity_fun(_=None, __=None, *previous_guesses_lists):
+    return [[(prev_guess, '') for prev_guess in previous_guesses] for previous_guesses in previous_guesses_lists], ''
 
 
 def guess(guesser_settings, input_contexts, word, prev_guesses):
+    """Return the guesses of the opponent for the displayed lines (the precomputed ones if present)
+        Without guesser service the opponent gives up if the guesses are not precomputed
+    """
+
+    precomputed = guesser_settings.get('precomputed')
+    if precomputed is not None:
+        guesses = precomputed.guesses(guesser_settings['guesser'], [line[0] for line in input_contexts], prev_guesses)
+        if guesses is not None:
+            return guesses, ''
+
+    client = guesser_settings.get('client')
+    if client is None:
+        return ['_'], ''
+
     # Get number of subwords for word
     params = {'guesser': guesser_settings['guesser'], 'word': word}
-    no_of_subwords, msg = request_helper(guesser_settings['baseurl'], 'no_of_subwords', params, 'no_of_subwords')
+    no_of_subwords, msg = client.cached_request('no_of_subwords', params, 'no_of_subwords')
     if len(msg) > 0:
         return [], msg
 
@@ -48,42 +513,11 @@ def guess(guesser_settings, input_contexts, word, prev_guesses):
               'top_n': guesser_settings['top_n']
               }
 
-    resp, msg = request_helper(guesser_settings['baseurl'], 'guess', params, 'guesses')
+    resp, msg = client.batched_request('guess', params, 'guesses')
     if len(msg) > 0:
         return [], msg
 
     if not isinstance(resp, list) or len(resp) == 0:
         return [], 'ValueError: response is not a list or empty!'
-    
-    return resp, ''
-
 
-def request_helper(base_url, query, params, out_key):
-    # Use POST if query string is too long
-    query_str = f'{base_url}/{query}?{urlencode(params, doseq=True)}'
-    try:
-        if len(query_str) < 2048:
-            resp = requests_get(query_str)
-        else:
-            resp = requests_post(f'{base_url}/{query}', json=params)
-    except ConnectionError as err:
-        # Try to hide the word to be quessed
-        err_str = str(err).split(':')
-        err_str[2] = '('.join(err_str[2].split('(')[1:])
-        err_str = ':'.join(err_str)
-        return None, f'ConnectionError: {err_str}'
-
-    # Handle errors... Raise exceptions...
-    if resp.status_code > 200:
-        return None, f'Status code: {resp.status_code}'
-
-    try:
-        resp_json = resp.json()
-    except JSONDecodeError as err:
-        return None, f'JSONDecodeError: {err}'
-
-    ret_json = resp_json.get(out_key)
-    if ret_json is None:
-        return None, f'KeyError: {out_key} missing from JSON!'
-
-    return ret_json, ''
+    return resp, ''
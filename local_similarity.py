@@ -0,0 +1,60 @@
+np = None  # Optional dependency, imported only if the local similarity is used (see EmbeddingSimilarity)
+
+
+class EmbeddingSimilarity:
+    def __init__(self, vectors_filename: str, vocabulary_filename: str):
+        """
+        Word similarity computed locally from a memory-mapped embedding matrix (needs numpy)
+
+        The files are created by create_database/export_embeddings.py (e.g. from a word2vec model): the vocabulary
+         is a sorted array of UTF-8 encoded words and the vectors are the L2-normalized rows in the same order,
+         so the similarities of all guesses to the word are computed by one matrix-vector product.
+         Only the rows of the looked up words are read from the files (shared by the worker processes).
+
+        :param vectors_filename: The .npy file of the (float32, normalized) embedding matrix
+        :param vocabulary_filename: The .npy file of the sorted words (fixed-length bytes)
+        """
+
+        global np
+        if np is None:
+            try:
+                import numpy as np
+            except ImportError:
+                raise ImportError('The local similarity needs numpy (pip install numpy)!')
+
+        self._vectors = np.load(vectors_filename, mmap_mode='r')
+        self._vocabulary = np.load(vocabulary_filename, mmap_mode='r')
+        if self._vectors.shape[0] != self._vocabulary.shape[0]:
+            raise ValueError(f'The number of vectors ({self._vectors.shape[0]}) and words'
+                             f' ({self._vocabulary.shape[0]}) differ in {vectors_filename} and {vocabulary_filename}!')
+
+    def _positions(self, words):
+        """Return the rows of the words and the mask of the words in the vocabulary"""
+
+        max_len = self._vocabulary.dtype.itemsize
+        encoded = [word.encode('UTF-8') for word in words]
+        keys = np.array([word if len(word) <= max_len else b'' for word in encoded], dtype=self._vocabulary.dtype)
+        positions = np.minimum(np.searchsorted(self._vocabulary, keys), len(self._vocabulary) - 1)
+        found = (self._vocabulary[positions] == keys) & (keys != b'')
+        return positions, found
+
+    def similarities(self, word, words2):
+        """Return the {word2: cosine similarity} of the words (in the vocabulary) to the word"""
+
+        words2 = list(dict.fromkeys(words2))
+        positions, found = self._positions([word] + words2)
+        if len(words2) == 0 or not found[0]:
+            return {}
+
+        sims = self._vectors[positions[1:][found[1:]]] @ self._vectors[positions[0]]
+        return dict(zip((word2 for word2, word2_found in zip(words2, found[1:]) if word2_found), sims.tolist()))
+
+    def word_similarity(self, _, word, *previous_guesses_lists):
+        """Same as guesser_helper.word_similarity() (word_similarity_fun in guesser_config) without the service"""
+
+        all_guesses = [prev_guess for previous_guesses in previous_guesses_lists for prev_guess in previous_guesses]
+        word_sims = self.similarities(word, all_guesses) if word is not None else {}
+
+        # Unknown words have no similarity
+        return [[(prev_guess, f'{word_sims[prev_guess]:.4f}' if prev_guess in word_sims else '')
+                 for prev_guess in previous_guesses] for previous_guesses in previous_guesses_lists], ''
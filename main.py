@@ -1,22 +1,53 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8, vim: expandtab:ts=4 -*-
 
+import gc
 import sys
+from os import environ
 from uuid import uuid4
+from secrets import token_hex
 from pathlib import Path
 from logging.config import dictConfig
 
-from yaml import safe_load as yaml_load
-from yamale import make_schema, make_data, validate, YamaleError
-from flask import request, flash, session, Flask, render_template, current_app
+from yaml import load as yaml_load
+try:
+    from yaml import CSafeLoader as SafeLoader  # LibYAML is much faster if available
+except ImportError:
+    from yaml import SafeLoader
+from flask import request, flash, session, abort, Flask, Response, render_template, current_app
 
-from context_bank import ContextBank
-from guesser_helper import word_similarity, dummy_similarity_fun, guess
+from sqlalchemy.exc import NoResultFound
+
+from context_bank import ContextBank, VersionedContextBank, WORD_FILTER_KEYS
+from corpus_pool import CorpusPool
+from game_state import GameStateSerializer
+from metrics import Metrics
+from boot import BootCache, BootTimer
+from local_similarity import EmbeddingSimilarity
+from guesser_helper import GuesserClient, PrecomputedGuesses, word_similarity, dummy_similarity_fun, guess, \
+    opponent_available
+
+
+def load_yaml(filename, boot_cache=None):
+    """Load the YAML file (from the boot cache if given)"""
+
+    if boot_cache is not None:
+        return boot_cache.cached('yaml', boot_cache.files_key(filename), lambda: load_yaml(filename))
+
+    with open(filename, encoding='UTF-8') as fh:
+        return yaml_load(fh, Loader=SafeLoader)
 
 
 def load_and_validate_config(config_filename=Path(__file__).resolve().parent / 'confg.yaml',
-                             config_schema_filename=Path(__file__).resolve().parent / 'config_schema.yaml'):
-    """Load YAML config and validate it with the given schema"""
+                             config_schema_filename=Path(__file__).resolve().parent / 'config_schema.yaml',
+                             boot_cache=None):
+    """Load YAML config and validate it with the given schema (the validated config is cached in the boot cache)"""
+
+    if boot_cache is not None:
+        return boot_cache.cached('config', boot_cache.files_key(config_filename, config_schema_filename),
+                                 lambda: load_and_validate_config(config_filename, config_schema_filename))
+
+    from yamale import make_schema, make_data, validate, YamaleError  # Only needed if the config is not cached
 
     # Load Schema
     with open(config_schema_filename, encoding='UTF-8') as fh:
@@ -43,67 +74,236 @@ def load_and_validate_config(config_filename=Path(__file__).resolve().parent / '
 
 def validate_config_special(config):
     config['ui_strings']['footer'] = config['ui_strings']['footer'].replace(r':\ ', ': ')
+    config['ui_strings'].setdefault('state_invalid', config['ui_strings']['error'])
+    config['ui_strings'].setdefault('game_filter_invalid', config['ui_strings']['error'])
+    config['ui_strings'].setdefault('no_word_for_filter', config['ui_strings']['error'])
     if config['guesser_config']['baseurl'] is not None:
+        config['guesser_config']['client'] = GuesserClient(config['guesser_config'])
+    if config['guesser_config'].get('precomputed_db') is not None:
+        # Consulted first, the opponent can play even without the guesser service
+        config['guesser_config']['precomputed'] = PrecomputedGuesses(config['guesser_config']['precomputed_db'])
+    # The local similarity is used without the guesser service or if it fails
+    if (config['guesser_config'].get('embeddings') is None) != \
+            (config['guesser_config'].get('embeddings_vocab') is None):
+        raise ValueError('Both or none of guesser_config/embeddings and guesser_config/embeddings_vocab must be set!')
+    if config['guesser_config'].get('embeddings') is not None:
+        local_similarity = EmbeddingSimilarity(config['guesser_config']['embeddings'],
+                                               config['guesser_config']['embeddings_vocab'])
+        config['guesser_config']['fallback_similarity_fun'] = local_similarity.word_similarity
+    else:
+        config['guesser_config']['fallback_similarity_fun'] = dummy_similarity_fun
+    if opponent_available(config['guesser_config']):
         config['guesser_config']['word_similarity_fun'] = word_similarity
     else:
-        config['guesser_config']['word_similarity_fun'] = dummy_similarity_fun
-    if (config['guesser_config']['baseurl'] is not None and
+        config['guesser_config']['word_similarity_fun'] = config['guesser_config']['fallback_similarity_fun']
+    if (opponent_available(config['guesser_config']) and
         config['guesser_config']['guesser'] is None) or \
-            (config['guesser_config']['baseurl'] is None and
+            (not opponent_available(config['guesser_config']) and
              config['guesser_config']['guesser'] is not None):
-        raise ValueError('Both or none of guesser_config/guesser_baseurl and guesser_config/guesser_name must be null!')
-
-
-def create_app(config_filename=Path('config.yaml')):
-    """Create and configure the app (and avoid globals as possible)"""
-
-    # Read configuration
-    config = load_and_validate_config(config_filename)
-    validate_config_special(config)
+        raise ValueError('Both or none of guesser_config/guesser_baseurl (or guesser_config/precomputed_db)'
+                         ' and guesser_config/guesser_name must be null!')
+    if (config['db_config'].get('database_name') is None) == (config['db_config'].get('manifest') is None):
+        raise ValueError('Exactly one of db_config/database_name and db_config/manifest must be set!')
+    config.setdefault('metrics_config', {'enabled': False})
+
+
+def load_corpora_config(config_filename,
+                        corpora_schema_filename=Path(__file__).resolve().parent / 'corpora_schema.yaml',
+                        boot_cache=None):
+    """Load the config of one corpus (see config.yaml) or of several corpora (see example_databases/corpora.yaml)
+        Returns the corpus name -> validated config dictionary (None is the name of the only corpus)
+        and the validated corpora config (None for one corpus)
+    """
+
+    if 'corpora' not in (load_yaml(config_filename, boot_cache) or {}):
+        config = load_and_validate_config(config_filename, boot_cache=boot_cache)
+        validate_config_special(config)
+        return {None: config}, None
+
+    corpora_config = load_and_validate_config(config_filename, corpora_schema_filename, boot_cache)
+    corpus_configs = {}
+    for corpus_name, corpus_config_filename in corpora_config['corpora'].items():
+        # The paths are relative to the file they are written in
+        corpus_config_filename = Path(config_filename).parent / corpus_config_filename
+        config = load_and_validate_config(corpus_config_filename, boot_cache=boot_cache)
+        for key in ('database_name', 'manifest'):
+            if config['db_config'].get(key) is not None:
+                config['db_config'][key] = str(corpus_config_filename.parent / config['db_config'][key])
+        for key in ('precomputed_db', 'embeddings', 'embeddings_vocab'):
+            if config['guesser_config'].get(key) is not None:
+                config['guesser_config'][key] = str(corpus_config_filename.parent / config['guesser_config'][key])
+        validate_config_special(config)
+        corpus_configs[corpus_name] = config
+
+    return corpus_configs, corpora_config
+
+
+def create_app(config_filename=Path(environ.get('GAME_CONFIG', 'config.yaml')),
+               boot_cache_dir=environ.get('GAME_BOOT_CACHE')):
+    """Create and configure the app (and avoid globals as possible)
+
+    :param config_filename: The config of one corpus (see config.yaml) or of several corpora
+        (see example_databases/corpora.yaml)
+    :param boot_cache_dir: The directory to cache the validated configs and the reflected database schemas in
+        between the starts (see BootCache in boot.py, None for no caching)
+    """
+
+    boot_timer = BootTimer()
+    boot_cache = BootCache(boot_cache_dir)
+
+    # Read configuration (one corpus or several corpora)
+    with boot_timer.phase('config'):
+        corpus_configs, corpora_config = load_corpora_config(config_filename, boot_cache=boot_cache)
 
     # Read logging configuration
-    with open('logging.cfg') as fh:
-        dictConfig(yaml_load(fh))
+    with boot_timer.phase('logging'):
+        dictConfig(load_yaml('logging.cfg', boot_cache))
 
     # Setup Flask application
     flask_app = Flask('word-guessing-game')
 
-    flask_app.config.from_mapping(APP_SETTINGS=config,
-                                  SECRET_KEY='any random string',
+    secret_key = environ.get('SECRET_KEY')
+    if secret_key is None:
+        # A public constant would let anyone forge the signed game states
+        secret_key = token_hex(32)
+        flask_app.logger.warning('SECRET_KEY is not set, using a random key: the game states do not survive restarts'
+                                 ' and are not shared by the workers (unless the app is created before the fork)')
+    flask_app.config.from_mapping(SECRET_KEY=secret_key,
                                   # JSONIFY_PRETTYPRINT_REGULAR=True,
                                   # JSON_AS_ASCII=False,
                                   )
-    app_settings = flask_app.config['APP_SETTINGS']
 
-    with flask_app.app_context():
+    # Timing spans of the hot path (ContextBank methods, guesser requests, template rendering, whole request)
+    if corpora_config is None:
+        metrics_config = corpus_configs[None]['metrics_config']
+    else:
+        metrics_config = corpora_config.get('metrics_config') or {'enabled': False}
+    metrics = Metrics(metrics_config['enabled'], metrics_config.get('snapshot_dir'))
+    flask_app.config['METRICS'] = metrics
+
+    for corpus_name, config in corpus_configs.items():
+        config['metrics'] = metrics
+        config['metrics_config'] = metrics_config
+        if corpus_name is None:
+            config['state_serializer'] = GameStateSerializer(flask_app.config['SECRET_KEY'])
+        else:
+            # The line IDs of one corpus are meaningless for the others
+            config['state_serializer'] = GameStateSerializer(flask_app.config['SECRET_KEY'],
+                                                             salt=f'game-state:{corpus_name}')
+        corpus_labels = {} if corpus_name is None else {'corpus': corpus_name}
+        if 'client' in config['guesser_config']:
+            client = config['guesser_config']['client']
+            client.request = metrics.timed(client.request, lambda query, *_, **__: f'guesser.{query}')
+            if client.cache is not None:
+                metrics.add_counters('guesser_cache', client.cache.stats, **corpus_labels)
+            for query, batcher in client.batchers.items():
+                metrics.add_counters('guesser_batch', batcher.stats, query=query, **corpus_labels)
+        if 'precomputed' in config['guesser_config']:
+            metrics.add_counters('precomputed_guesses', config['guesser_config']['precomputed'].stats, **corpus_labels)
+
+    def create_context_bank(config, database_name=None):
+        if config['db_config'].get('manifest') is not None and database_name is None:
+            # One ContextBank for each version of the database (the new versions are loaded in the background)
+            return VersionedContextBank(config['db_config']['manifest'],
+                                        lambda database_path: create_context_bank(config, str(database_path)),
+                                        config['contextbank_config'].get('reload_interval', 10),
+                                        config['contextbank_config'].get('keep_versions', 2))
+
+        db_config = config['db_config']
+        if database_name is not None:
+            db_config = dict(db_config, database_name=database_name)
         left_size = config['contextbank_config']['left_size']
         right_size = config['contextbank_config']['right_size']
         hide_char = config['contextbank_config']['hide_char']
-        app_settings['context_bank'] = ContextBank(config['db_config'], left_size, right_size, hide_char)
-
-    @flask_app.route('/')  # So one can create permalink for states!
+        preload = config['contextbank_config'].get('preload', False)
+        sampling = config['contextbank_config'].get('sampling', 'line')
+        line_order = config['contextbank_config'].get('line_order')
+        context_bank = ContextBank(db_config, left_size, right_size, hide_char, preload, sampling, line_order,
+                                   boot_cache)
+        if config['contextbank_config'].get('warm_up', False):
+            with metrics.span('context_bank.warm_up'):
+                context_bank.warm_up()
+        metrics.instrument(context_bank, ('read_lines', 'next_line_id', 'select_one_random_line',
+                                          'select_random_word', 'identify_word_from_id', 'read_all_lines_for_word'),
+                           'context_bank.')
+        return context_bank
+
+    if corpora_config is None:
+        corpora = CorpusPool(corpus_configs, create_context_bank, None)
+        with boot_timer.phase('context_bank'), flask_app.app_context():
+            corpora.get(None)  # The only corpus is loaded (and warmed up) at startup and never dropped
+    else:
+        # The corpora are loaded on their first request and dropped when idle
+        corpora = CorpusPool(corpus_configs, create_context_bank, corpora_config['default_corpus'],
+                             corpora_config.get('idle_timeout'), corpora_config.get('max_loaded'))
+    flask_app.config['CORPORA'] = corpora
+
+    flask_app.config['BOOT_TIMER'] = boot_timer
+    for phase, seconds in boot_timer.timings:
+        metrics.record(f'boot.{phase}', seconds)
+    flask_app.logger.info(f'Boot timings: {boot_timer}')
+
+    @flask_app.before_request
+    def start_request_timing():
+        if request.endpoint == 'index':
+            current_app.config['METRICS'].start_request()
+
+    @flask_app.teardown_request
+    def end_request_timing(_):
+        current_app.config['METRICS'].end_request()
+
+    if metrics.enabled:
+        @flask_app.route('/metrics')
+        def metrics_endpoint():
+            """Export the timing histograms (of all worker processes) in the Prometheus text format"""
+
+            return Response(current_app.config['METRICS'].render(), mimetype='text/plain; version=0.0.4')
+
+    @flask_app.route('/', defaults={'corpus_name': None})  # So one can create permalink for states!
+    @flask_app.route('/<corpus_name>/')  # Several corpora: by URL prefix or by the corpus query parameter
     # @auth.login_required
-    def index():
+    def index(corpus_name):
         """Control the query in a stateless manner"""
 
-        settings = current_app.config['APP_SETTINGS']
+        corpora = current_app.config['CORPORA']
+        corpus_param = None
+        if corpus_name is None and corpora.default_corpus is not None:
+            corpus_param = request.args.get('corpus')
+            corpus_name = corpus_param or corpora.default_corpus
+        if corpus_name not in corpora:
+            abort(404)
+        settings = corpora.get(corpus_name)
+        metrics = settings['metrics']
         # Parse parameters and put errors into messages if necessary
-        messages, next_action, displayed_line_ids, this_player, other_player = parse_params(settings['ui_strings'])
+        messages, next_action, game_state, this_player, other_player, game_filter = \
+            parse_params(settings['ui_strings'], settings['state_serializer'], settings['context_bank'].has_fts)
+        metrics.set_action(next_action)
+
+        # The lines of a game are read from the version of the database it started on, new games use the current one
+        try:
+            version, context_bank = settings['context_bank'].checkout(None if next_action == 'new_game'
+                                                                      else game_state[3])
+        except KeyError:  # The version is not served anymore
+            messages.append(settings['ui_strings']['state_invalid'])
+            version, context_bank = settings['context_bank'].checkout()
+            game_state = (None, [], None, None)
+        game_state = (*game_state[:3], version)
 
         # Create random session id to identify users
         if 'id' not in session:
             session['id'] = uuid4()
-        # Log parameters and URL query string
+        # Log parameters and URL query string (with the timings if needed)
         all_guesses = this_player[0][:]
         all_guesses.append(this_player[1])
-        current_app.logger.info(
-            '\t'.join(map(str, (session['id'], next_action, displayed_line_ids, all_guesses,
-                                request.query_string.decode()))))
+        log_fields = [session['id'], next_action, game_state[1], all_guesses, request.query_string.decode()]
+        if not settings['metrics_config'].get('log_timings', False):
+            current_app.logger.info('\t'.join(map(str, log_fields)))
 
         # Execute one step in the game if there were no errors, else do nothing
-        messages, displayed_lines, buttons_enabled, prev_guesses_this, prev_guesses_other, other_guess_state = \
-            game_logic(messages, next_action, displayed_line_ids, this_player, other_player,
-                       settings['guesser_config'], settings['ui_strings'], settings['context_bank'])
+        messages, displayed_lines, buttons_enabled, prev_guesses_this, prev_guesses_other, other_guess_state, \
+            game_state = game_logic(messages, next_action, game_state, this_player, other_player,
+                                    settings['guesser_config'], settings['ui_strings'], context_bank,
+                                    game_filter)
 
         # Display messages (errors and informational ones)
         for m in messages:
@@ -116,20 +316,55 @@ def create_app(config_filename=Path('config.yaml')):
             word_length = 0
             word_length_str = ''
 
+        if len(game_state[1]) > 0:
+            state = settings['state_serializer'].dumps(game_state)
+        else:
+            state = ''
+
         # Render output HTML
-        out_content = render_template('layout.html', ui_strings=settings['ui_strings'], buttons_enabled=buttons_enabled,
-                                      previous_guesses=prev_guesses_this, previous_guesses_other=prev_guesses_other,
-                                      displayed_lines=displayed_lines, other_guess_state=other_guess_state,
-                                      word_length_str=word_length_str, word_length=word_length)
+        with metrics.span('render_template'):
+            out_content = render_template('layout.html', ui_strings=settings['ui_strings'],
+                                          buttons_enabled=buttons_enabled, previous_guesses=prev_guesses_this,
+                                          previous_guesses_other=prev_guesses_other, displayed_lines=displayed_lines,
+                                          other_guess_state=other_guess_state, word_length_str=word_length_str,
+                                          word_length=word_length, state=state, corpus=corpus_param,
+                                          game_filter={key: value for key, value in request.args.items()
+                                                       if key in game_filter})
+
+        if settings['metrics_config'].get('log_timings', False):
+            spans, elapsed = metrics.request_timings()
+            log_fields.append(' '.join(f'{span}={seconds * 1000:.2f}ms' for span, seconds in spans))
+            log_fields.append(f'request={elapsed * 1000:.2f}ms')
+            current_app.logger.info('\t'.join(map(str, log_fields)))
+
         return out_content
 
     return flask_app
 
 
-def parse_params(ui_strings):
+def parse_params(ui_strings, state_serializer, has_fts=False):
     """Parse input parameters (Flask-specific)"""
     messages = []
 
+    # Restrict the new games to words by length, freq or prefix and to contexts containing tokens (if indexed)
+    game_filter = {}
+    for key in WORD_FILTER_KEYS:
+        value = request.args.get(key, '')
+        if len(value) == 0:
+            continue
+        if key == 'prefix':
+            game_filter[key] = value
+        elif value.isdecimal():
+            game_filter[key] = int(value)
+        else:
+            messages.append(ui_strings['game_filter_invalid'])
+    tokens = request.args.get('tokens', '').split()
+    if len(tokens) > 0:
+        if has_fts:
+            game_filter['tokens'] = tokens
+        else:
+            messages.append(ui_strings['game_filter_invalid'])
+
     prev_guesses = request.args.getlist('previous_guesses[]')
     prev_guesses_other = request.args.getlist('previous_guesses_other[]')
     other_guess_state = request.args.get('other_guess_state', '0')
@@ -140,9 +375,23 @@ def parse_params(ui_strings):
     if 'guess' in request.args and guessed_word is None:
         messages.append(ui_strings['no_guessed_word_specified'])
 
-    displayed_line_ids = request.args.getlist('displayed_lines[]', int)
+    # The signed state token or the displayed line IDs (for old permalinks) with a new seed
+    state_token = request.args.get('state')
+    if state_token is not None:
+        game_state = state_serializer.loads(state_token)
+        if game_state is None:
+            messages.append(ui_strings['state_invalid'])
+            game_state = (None, [], None, None)
+    else:
+        displayed_line_ids = request.args.getlist('displayed_lines[]', int)
+        if len(displayed_line_ids) > 0:
+            # The oldest line is the first line of the game
+            game_state = (displayed_line_ids[-1], displayed_line_ids, state_serializer.new_seed(), None)
+        else:
+            game_state = (None, [], None, None)
 
-    if len({'guess', 'give_up', 'next_line'}.intersection(request.args.keys())) > 0 and len(displayed_line_ids) == 0:
+    if len({'guess', 'give_up', 'next_line'}.intersection(request.args.keys())) > 0 and len(game_state[1]) == 0 \
+            and state_token is None:
         messages.append(ui_strings['no_displayed_lines_specified'])
 
     for action in ('guess', 'next_line', 'give_up', 'new_game', 'new_game_vs_other'):
@@ -152,7 +401,7 @@ def parse_params(ui_strings):
     else:
         next_action = None
 
-    if len(request.args) > 0 and next_action is None:
+    if len(request.args.keys() - {'corpus'}) > 0 and next_action is None:
         messages.append(ui_strings['no_action_specified'])
 
     if next_action == 'new_game':
@@ -161,39 +410,39 @@ def parse_params(ui_strings):
         next_action = 'new_game'
         other_guess_state = '0'
 
-    return messages, next_action, displayed_line_ids, (prev_guesses, guessed_word), \
-        (prev_guesses_other, other_guess_state)
+    return messages, next_action, game_state, (prev_guesses, guessed_word), \
+        (prev_guesses_other, other_guess_state), game_filter
 
 
-def game_logic(messages, action, displayed_lines, this_player, other_player, guesser_config, ui_strings, context_bank):
+def game_logic(messages, action, game_state, this_player, other_player, guesser_config, ui_strings, context_bank,
+               game_filter=None):
     """The main logic of the game"""
+    word_line_id, displayed_lines, seed, version = game_state
     previous_guesses, guessed_word = this_player
     previous_guesses_other, other_guess_state = other_player
 
     buttons_enabled = {'guess': True, 'next_line': True, 'give_up': True, 'new_game': False}
+    word = None  # Known after reading the displayed lines
 
     if len(messages) > 0 or action is None:
         # There were errors
         lines_to_display = []
         buttons_enabled = {'guess': False, 'next_line': False, 'give_up': False, 'new_game': True}
     elif action == 'guess':
-        # Get the word for ID and check it. If matches reveal word in displayed lines
-        word, _ = context_bank.identify_word_from_id(displayed_lines[0])  # Empty list is handled in parse_params()
+        # Get the word with the lines and check it. If matches reveal word in displayed lines
+        word, lines_to_display = context_bank.read_lines(displayed_lines)  # Empty list is handled in parse_params()
         if word == guessed_word:
-            hide_word = False
+            lines_to_display = [[line_id, left, word, right] for line_id, left, _, right in lines_to_display]
             messages.append(ui_strings['win'])
             buttons_enabled = {'guess': False, 'next_line': False, 'give_up': False, 'new_game': True}
         else:
-            hide_word = True
             messages.append(ui_strings['incorrect_guess'])
             previous_guesses.append(guessed_word)
 
-        lines_to_display, _ = context_bank.read_all_lines_for_word(word, displayed_lines, hide_word=hide_word)
-
-        if guesser_config.get('baseurl') is not None and other_guess_state == '0':
+        if opponent_available(guesser_config) and other_guess_state == '0':
             other_guesses, msg = guess(guesser_config, lines_to_display, word, previous_guesses_other)
-            other_guess = other_guesses[0]  # Always padded to top_n with '_' characters
             if len(msg) == 0:
+                other_guess = other_guesses[0]  # Always padded to top_n with '_' characters
                 if word == other_guess:
                     messages.append(ui_strings['other_win'])
                     other_guess_state = '1'
@@ -206,46 +455,57 @@ def game_logic(messages, action, displayed_lines, this_player, other_player, gue
                 messages.append(f'{ui_strings["error"]}: {msg}')
 
     elif action == 'next_line':
-        # Read lines for the word, display already shown and select a new one
-        lines_to_display, new_lines = context_bank.read_all_lines_for_word(None, displayed_lines, hide_word=True)
-
-        # Select a new line to display and insert it to the top
-        if len(new_lines) > 0:
-            lines_to_display.insert(0, new_lines[0])
+        # Select the next line (in the order fixed by the seed) to display and insert it to the top
+        new_line_id = context_bank.next_line_id(word_line_id, displayed_lines, seed)
+        if new_line_id is not None:
+            displayed_lines = [new_line_id] + displayed_lines
         else:
             buttons_enabled['next_line'] = False
             messages.append(ui_strings['no_more_line_for_word'])
+        word, lines_to_display = context_bank.read_lines(displayed_lines, hide_word=True)
     elif action == 'give_up':
         # Reveal word in already displayed lines
         buttons_enabled = {'guess': False, 'next_line': False, 'give_up': False, 'new_game': True}
-        lines_to_display, _ = context_bank.read_all_lines_for_word(None, displayed_lines, hide_word=False)
+        word, lines_to_display = context_bank.read_lines(displayed_lines, hide_word=False)
     elif action == 'new_game' or action == 'new_game_vs_bert':
-        # Select a random line
+        # Select a random line (of the words matching the filter)
         previous_guesses.clear()
         previous_guesses_other.clear()
-        lines_to_display = context_bank.select_one_random_line()
+        word_filter = {key: value for key, value in (game_filter or {}).items() if key != 'tokens'}
+        try:
+            lines_to_display = context_bank.select_one_random_line(word_filter, (game_filter or {}).get('tokens', ()))
+            word_line_id, seed = lines_to_display[0][0], GameStateSerializer.new_seed()
+        except NoResultFound:
+            lines_to_display = []
+            messages.append(ui_strings['no_word_for_filter'])
+            buttons_enabled = {'guess': False, 'next_line': False, 'give_up': False, 'new_game': True}
     else:
         raise NotImplementedError('Nonsense state!')
 
-    # Similarity helper
-    if guesser_config.get('baseurl') is not None:
-        for pg in (previous_guesses, previous_guesses_other):
-            new_pg, msg = guesser_config['word_similarity_fun'](guesser_config, context_bank, lines_to_display, pg)
-            if len(msg) > 0:
-                new_pg, _ = dummy_similarity_fun(previous_guesses=pg)  # Use dummy similarity instead
-                messages.append(f'{ui_strings["error"]}: {msg}')
-            pg[:] = new_pg  # Overwrite list!
+    # Similarity helper (for both players at once)
+    new_pgs, msg = guesser_config['word_similarity_fun'](guesser_config, word, previous_guesses, previous_guesses_other)
+    if len(msg) > 0:
+        # Use the local (or dummy) similarity instead
+        new_pgs, _ = guesser_config['fallback_similarity_fun'](guesser_config, word, previous_guesses,
+                                                               previous_guesses_other)
+        messages.append(f'{ui_strings["error"]}: {msg}')
+    for pg, new_pg in zip((previous_guesses, previous_guesses_other), new_pgs):
+        pg[:] = new_pg  # Overwrite list!
+    if opponent_available(guesser_config):
         buttons_enabled['new_game_vs_other'] = buttons_enabled['new_game']
     else:
-        new_pg, _ = dummy_similarity_fun(previous_guesses=previous_guesses)  # Use dummy similarity instead
-        previous_guesses = new_pg
         buttons_enabled['new_game_vs_other'] = False
 
-    return messages, lines_to_display, buttons_enabled, previous_guesses, previous_guesses_other, other_guess_state
+    game_state = (word_line_id, [line[0] for line in lines_to_display], seed, version)
+
+    return messages, lines_to_display, buttons_enabled, previous_guesses, previous_guesses_other, other_guess_state, \
+        game_state
 
 
 # Create an app instance for later usage
 app = create_app()
+# The objects of the app are never collected, so the forked workers (gunicorn --preload) keep sharing their pages
+gc.freeze()
 
 if __name__ == '__main__':
     app.run()
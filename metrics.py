@@ -0,0 +1,240 @@
+import os
+import json
+import atexit
+from time import perf_counter, time
+from pathlib import Path
+from bisect import bisect_left
+from threading import Lock
+from functools import wraps
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from tempfile import NamedTemporaryFile
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    def __init__(self, enabled: bool = True, snapshot_dir: str = None, snapshot_interval: float = 1.0,
+                 buckets=DEFAULT_BUCKETS, prefix: str = 'word_game'):
+        """
+        Timing spans of the hot path aggregated into histograms by span name and game action
+
+        The spans of a request are collected (also from the threads of the guesser client, see
+         GuesserClient.map_requests()) and aggregated with the action of the request when the request ends.
+         Spans can be nested (e.g. a ContextBank method calling another one), each is measured inclusively.
+         For multiple worker processes (e.g. gunicorn workers) each process writes its histograms into
+         snapshot_dir/metrics_PID_ID.json and render() merges the snapshots of all processes.
+         The snapshots of finished processes are kept (as counters), clear the directory before starting the server.
+
+        :param enabled: If False, spans are not measured and nothing is recorded
+        :param snapshot_dir: The directory shared by the worker processes (None for this process only)
+        :param snapshot_interval: The minimal number of seconds between two snapshots of this process
+        :param buckets: The upper bounds of the histogram buckets in seconds
+        :param prefix: The prefix of the exported metric names
+        """
+
+        self.enabled = enabled
+        self._buckets = tuple(buckets)
+        self._prefix = prefix
+        self._histograms = {}  # (span, action) -> [counts of the buckets and +Inf, sum, count]
+        self._counter_sources = []  # (name, labels, function returning the {counter: value} of this process)
+        self._lock = Lock()
+        self._current = ContextVar('current_request_spans', default=None)
+
+        self._snapshot_dir = None
+        self._snapshot_interval = snapshot_interval
+        self._last_snapshot = 0.0
+        if enabled and snapshot_dir is not None:
+            self._snapshot_dir = Path(snapshot_dir)
+            self._snapshot_dir.mkdir(parents=True, exist_ok=True)
+            atexit.register(self.write_snapshot)  # Keep the last requests of the process
+
+    def start_request(self, action=None):
+        """Start collecting the spans of a new request (in this context)"""
+
+        if self.enabled:
+            self._current.set({'action': action, 'start': perf_counter(), 'spans': []})
+
+    def set_action(self, action):
+        """Set the action of the current request which labels its spans"""
+
+        current = self._current.get()
+        if current is not None:
+            current['action'] = action
+
+    def request_timings(self):
+        """Return the [(span, seconds), ...] of the current request so far and the elapsed seconds"""
+
+        current = self._current.get()
+        if current is None:
+            return [], 0.0
+        return list(current['spans']), perf_counter() - current['start']
+
+    def end_request(self, span='request'):
+        """Record the spans of the current request and the whole request (as span) with the action of the request"""
+
+        current = self._current.get()
+        if current is None:
+            return
+        self._current.set(None)
+
+        elapsed = perf_counter() - current['start']
+        action = str(current['action'])
+        snapshot_due = False
+        with self._lock:
+            for span_name, seconds in current['spans']:
+                self._observe(span_name, action, seconds)
+            self._observe(span, action, elapsed)
+            # Only one of the concurrent requests (threads) writes the snapshot
+            if self._snapshot_dir is not None and time() - self._last_snapshot >= self._snapshot_interval:
+                self._last_snapshot = time()
+                snapshot_due = True
+
+        if snapshot_due:
+            self.write_snapshot()
+
+    def span(self, name):
+        """Context manager measuring the enclosed block as span"""
+
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name)
+
+    @contextmanager
+    def _span(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def record(self, name, seconds):
+        """Add a measured span to the current request (or record it immediately without action outside requests)"""
+
+        current = self._current.get()
+        if current is not None:
+            current['spans'].append((name, seconds))  # Append is atomic, threads may share the list
+        else:
+            with self._lock:
+                self._observe(name, '', seconds)
+
+    def timed(self, fun, name):
+        """Wrap the function to measure its calls as span (name can be a function of the arguments)"""
+
+        if not self.enabled:
+            return fun
+
+        @wraps(fun)
+        def wrapper(*args, **kwargs):
+            span_name = name(*args, **kwargs) if callable(name) else name
+            with self._span(span_name):
+                return fun(*args, **kwargs)
+
+        return wrapper
+
+    def instrument(self, obj, method_names, prefix):
+        """Replace the methods of the object (instance only) with measured ones named prefix + method name"""
+
+        for method_name in method_names:
+            setattr(obj, method_name, self.timed(getattr(obj, method_name), f'{prefix}{method_name}'))
+
+    def add_counters(self, name, stats_fun, **labels):
+        """Export the counters returned by stats_fun() (e.g. ResultCache.stats()) as NAME_COUNTER with the labels
+            (the values of the processes are summed)
+        """
+
+        if self.enabled:
+            self._counter_sources.append((name, labels, stats_fun))
+
+    def _counters(self):
+        """The current values of the counters of this process by metric name and labels"""
+
+        counters = {}
+        for name, labels, stats_fun in self._counter_sources:
+            label_str = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+            for counter, value in stats_fun().items():
+                key = f'{self._prefix}_{name}_{counter}\t{label_str}'
+                counters[key] = counters.get(key, 0) + value
+        return counters
+
+    def _observe(self, span, action, seconds):
+        histogram = self._histograms.get((span, action))
+        if histogram is None:
+            histogram = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            self._histograms[(span, action)] = histogram
+        histogram[0][bisect_left(self._buckets, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            return {f'{span}\t{action}': [list(counts), seconds, count]
+                    for (span, action), (counts, seconds, count) in self._histograms.items()}
+
+    def _snapshot_name(self):
+        return f'metrics_{os.getpid()}_{id(self):x}.json'  # More apps (Metrics) can run in one process
+
+    def write_snapshot(self):
+        """Write the histograms of this process into the snapshot directory (atomically, through a temporary file
+            unique to the call, so the concurrent writers of the process never share it)
+        """
+
+        with NamedTemporaryFile('w', encoding='UTF-8', dir=self._snapshot_dir, prefix='.metrics_', suffix='.tmp',
+                                delete=False) as fh:
+            json.dump({'buckets': self._buckets, 'histograms': self._snapshot(), 'counters': self._counters()}, fh)
+        os.replace(fh.name, self._snapshot_dir / self._snapshot_name())
+
+    def _merged_snapshots(self):
+        """The histograms and the counters of this process merged with the snapshots of the other processes"""
+
+        merged, merged_counters = self._snapshot(), self._counters()
+        if self._snapshot_dir is None:
+            return merged, merged_counters
+
+        own_snapshot_name = self._snapshot_name()
+        for snapshot_filename in self._snapshot_dir.glob('metrics_*.json'):
+            if snapshot_filename.name == own_snapshot_name:
+                continue
+            try:
+                with open(snapshot_filename, encoding='UTF-8') as fh:
+                    snapshot = json.load(fh)
+            except (OSError, ValueError):
+                continue  # Removed or being replaced
+            if tuple(snapshot['buckets']) != self._buckets:
+                continue
+            for key, (counts, seconds, count) in snapshot['histograms'].items():
+                histogram = merged.setdefault(key, [[0] * len(counts), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += seconds
+                histogram[2] += count
+            for key, value in snapshot.get('counters', {}).items():
+                merged_counters[key] = merged_counters.get(key, 0) + value
+
+        return merged, merged_counters
+
+    def render(self):
+        """Export the histograms and the counters (of all processes) in the Prometheus text format"""
+
+        name = f'{self._prefix}_span_seconds'
+        out = [f'# HELP {name} Duration of the spans of the requests by span and game action',
+               f'# TYPE {name} histogram']
+        histograms, counters = self._merged_snapshots()
+        for key, (counts, seconds, count) in sorted(histograms.items()):
+            span, action = key.split('\t')
+            labels = f'span="{span}",action="{action}"'
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self._buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                out.append(f'{name}_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+            out.append(f'{name}_sum{{{labels}}} {seconds}')
+            out.append(f'{name}_count{{{labels}}} {count}')
+
+        prev_name = None
+        for key, value in sorted(counters.items()):
+            counter_name, labels = key.split('\t')
+            if counter_name != prev_name:
+                out.append(f'# TYPE {counter_name} gauge')  # Counters of the processes summed (sizes too)
+                prev_name = counter_name
+            out.append(f'{counter_name}{{{labels}}} {value}' if len(labels) > 0 else f'{counter_name} {value}')
+
+        return '\n'.join(out) + '\n'